@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the message hot path.
+#
+# Drives Slack.message and HipChat.message with synthetic events while
+# transports are stubbed out, and measures throughput, latency of
+# Base.respond and memory allocated per message for each combination of
+# registered command count, concurrent user count and max_workers.
+# Throughput and latency are measured without tracing, and allocation is
+# measured in a separate pass under tracemalloc, which slows every
+# allocation down.
+#
+#   $ PYTHONPATH=. python benchmarks/message_hot_path.py \
+#         --output benchmark.json
+#
+# Results are written as JSON so they can be compared between revisions.
+import argparse
+import gc
+import itertools
+import json
+import logging
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, Optional
+
+from sarah.bot import Base
+
+
+class StubWebSocket(object):
+    def __init__(self, expected: int) -> None:
+        self.sent = 0
+        self.expected = expected
+        self.done = threading.Event()
+        self.condition = threading.Condition()
+
+    def send(self, _: str) -> None:
+        with self.condition:
+            self.sent += 1
+            if self.sent >= self.expected:
+                self.done.set()
+            self.condition.notify_all()
+
+    def wait_sent(self, count: int, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.sent >= count,
+                                           timeout)
+
+    def close(self) -> None:
+        pass
+
+
+# Messages dispatched one at a time under tracemalloc for each case
+ALLOCATION_SAMPLES = 200
+
+
+class StubJID(str):
+    @property
+    def bare(self) -> str:
+        return self.split('/')[0]
+
+
+class StubXMPPMessage(dict):
+    def __init__(self, sender: str, body: str, ws: StubWebSocket) -> None:
+        super().__init__({'delay': {'stamp': None},
+                          'type': 'chat',
+                          'from': StubJID(sender),
+                          'body': body})
+        self.ws = ws
+
+    def reply(self, body: str):
+        return self
+
+    def send(self) -> None:
+        self.ws.send('')
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def register_commands(bot_class, count: int) -> None:
+    for i in range(count):
+        # noinspection PyUnusedLocal
+        def command(msg, config):
+            return msg.text
+
+        bot_class.command('.bench%04d' % i)(command)
+
+
+def setup_slack(commands: int, max_workers: Optional[int]):
+    from sarah.bot.slack import Slack
+
+    bot = Slack(token='benchmark',
+                max_workers=max_workers,
+                rate_limit_config={})
+    # Stub websocket is always open
+    bot.connected.set()
+    register_commands(Slack, commands)
+
+    def event(i: int, user: int) -> Any:
+        return json.dumps({'type': 'message',
+                           'channel': 'C%04d' % user,
+                           'user': 'U%04d' % user,
+                           'text': '.bench%04d spam ham' % (i % commands),
+                           'ts': '1438477080.%06d' % i})
+
+    def dispatch(payload: Any) -> None:
+        bot.message(None, payload)
+
+    return bot, event, dispatch
+
+
+def setup_hipchat(commands: int, max_workers: Optional[int]):
+    from sarah.bot.hipchat import HipChat
+
+    bot = HipChat(jid='benchmark@localhost',
+                  password='benchmark',
+                  max_workers=max_workers)
+    register_commands(HipChat, commands)
+
+    def event(i: int, user: int) -> Any:
+        return ('%04d_user@localhost/benchmark' % user,
+                '.bench%04d spam ham' % (i % commands))
+
+    def dispatch(payload: Any) -> None:
+        bot.message(StubXMPPMessage(payload[0], payload[1], bot.ws))
+
+    return bot, event, dispatch
+
+
+ADAPTERS = {'slack': setup_slack,
+            'hipchat': setup_hipchat}
+
+
+def run_case(adapter: str,
+             messages: int,
+             commands: int,
+             users: int,
+             max_workers: Optional[int]) -> Dict[str, Any]:
+    bot, event, dispatch = ADAPTERS[adapter](commands, max_workers)
+    bot.connect = lambda: None
+    bot.run()
+
+    latencies = []
+    respond = bot.respond
+
+    def timed_respond(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return respond(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    bot.respond = timed_respond
+
+    # Build events up front so JSON encoding is not measured
+    payloads = [event(i, i % users) for i in range(messages)]
+
+    # Warm up
+    bot.ws = StubWebSocket(min(100, messages))
+    for payload in payloads[:100]:
+        dispatch(payload)
+    bot.ws.done.wait(30)
+
+    latencies.clear()
+    bot.ws = StubWebSocket(messages)
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+
+    started = time.perf_counter()
+    for payload in payloads:
+        dispatch(payload)
+    completed = bot.ws.done.wait(60)
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    # Recorded latencies are the only objects meant to be retained
+    retained_blocks = sys.getallocatedblocks() - blocks_before - \
+        len(latencies)
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+
+    allocated = measure_allocation(bot,
+                                   dispatch,
+                                   payloads[:ALLOCATION_SAMPLES])
+
+    # Transports are never connected, so only stop workers and scheduler.
+    Base.stop(bot)
+
+    return {'adapter': adapter,
+            'messages': messages,
+            'commands': commands,
+            'users': users,
+            'max_workers': max_workers,
+            'completed': completed,
+            'elapsed': elapsed,
+            'messages_per_sec': messages / elapsed,
+            'respond_p50': p50,
+            'respond_p99': p99,
+            'allocated_bytes_per_message_p50': percentile(allocated, 50),
+            'allocated_bytes_per_message_max': max(allocated)
+            if allocated else None,
+            'allocated_samples': len(allocated),
+            'retained_blocks_per_message': retained_blocks / messages}
+
+
+def measure_allocation(bot: Base,
+                       dispatch: Callable[[Any], None],
+                       payloads: List[Any]) -> List[int]:
+    # Messages are handled one at a time, and the peak of memory traced
+    # from dispatching one until its reply is sent is taken as the bytes
+    # the message allocates. Restarting tracemalloc resets the peak.
+    allocated = []
+    bot.ws = StubWebSocket(len(payloads))
+    gc.collect()
+    for i, payload in enumerate(payloads):
+        tracemalloc.start()
+        dispatch(payload)
+        sent = bot.ws.wait_sent(i + 1, 10)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if sent:
+            allocated.append(peak)
+
+    return allocated
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def parse_workers(value: str) -> Optional[int]:
+    return None if value.lower() == 'none' else int(value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--adapters', nargs='+', default=['slack', 'hipchat'],
+                        choices=sorted(ADAPTERS.keys()))
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--commands', nargs='+', type=int,
+                        default=[10, 100, 1000])
+    parser.add_argument('--users', nargs='+', type=int, default=[1, 100])
+    parser.add_argument('--workers', nargs='+', type=parse_workers,
+                        default=[None, 4, 16])
+    parser.add_argument('--output', default=None,
+                        help='Path to write JSON result. Defaults to stdout.')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    for adapter in args.adapters:
+        try:
+            ADAPTERS[adapter](1, None)
+        except ImportError as e:
+            sys.stderr.write('Skipping %s. %s\n' % (adapter, e))
+            continue
+
+        for commands, users, workers in itertools.product(args.commands,
+                                                          args.users,
+                                                          args.workers):
+            result = run_case(adapter, args.messages, commands, users, workers)
+            sys.stderr.write(
+                '%(adapter)s commands=%(commands)d users=%(users)d '
+                'max_workers=%(max_workers)s: %(messages_per_sec).0f msg/s '
+                'p50=%(respond_p50).6fs p99=%(respond_p99).6fs '
+                'allocated=%(allocated_bytes_per_message_p50)sB\n' % result)
+            results.append(result)
+
+    output = json.dumps({'revision': revision(),
+                         'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'timestamp': time.time(),
+                         'results': results},
+                        indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,5 @@ import sarah.value_object
 VERSION = "0.0.1"
 
 ValueObject = sarah.value_object.ValueObject
+
+CompactValueObject = sarah.value_object.CompactValueObject
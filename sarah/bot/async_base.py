@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+import abc
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import inspect
+import logging
+import time
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from typing import Any, Awaitable, Dict, Hashable, Optional, Sequence, Union
+
+from sarah.bot.base import Base
+from sarah.bot.types import AnyFunction, PluginConfig
+from sarah.bot.values import Dispatch, RichMessage
+
+
+class AsyncBase(Base, metaclass=abc.ABCMeta):
+    # asyncio-native alternative to Base.
+    #
+    # Event handling, outbound queue and scheduler all run on one event loop.
+    # Command functions declared with "async def" are awaited on the loop, so
+    # thousands of slow commands waiting for network I/O cost coroutines
+    # rather than OS threads. Plain command functions are still supported;
+    # they run in the thread pool executor so they don't block the loop.
+    #
+    # This is an abstract base. No adapter in this package is built on it
+    # yet; Slack and HipChat use the thread based Base. Subclasses implement
+    # connect() as a coroutine, and call respond() and
+    # enqueue_sending_message() from the event loop.
+    #
+    # Outbound messages are queued per destination on the loop instead of
+    # LaneExecutor, so only max_queue_size of message_worker_config is used.
+    # Coroutine commands and sends are profiled by wall time only, since
+    # CPU time of one coroutine can't be told from others on the loop.
+
+    # Seconds to keep an idle per-destination sender task before releasing it
+    IDLE_LANE_TIMEOUT = 60
+
+    def __init__(self,
+                 plugins: Sequence[PluginConfig]=None,
+                 max_workers: Optional[int]=None,
+                 context_config: Dict=None,
+                 message_worker_config: Dict=None,
+                 rate_limit_config: Dict=None,
+                 profile_config: Dict=None,
+                 loop: asyncio.AbstractEventLoop=None,
+                 metrics_config: Dict=None,
+                 timeout_config: Dict=None) -> None:
+        super().__init__(plugins=plugins,
+                         max_workers=max_workers,
+                         context_config=context_config,
+                         message_worker_config=message_worker_config,
+                         rate_limit_config=rate_limit_config,
+                         profile_config=profile_config,
+                         metrics_config=metrics_config,
+                         timeout_config=timeout_config)
+
+        self.loop = loop if loop else asyncio.new_event_loop()
+        self.scheduler = AsyncIOScheduler(event_loop=self.loop)
+
+        # {destination: asyncio.Queue, ...}
+        self.__lanes = {}
+        self.__tasks = set()
+
+    @abc.abstractmethod
+    async def connect(self) -> None:
+        pass
+
+    def run(self) -> None:
+        started = time.monotonic()
+
+        # Plain command functions are executed here. When max_workers is not
+        # given, ThreadPoolExecutor picks its default size.
+        self.worker = ThreadPoolExecutor(max_workers=self.max_workers)
+        asyncio.set_event_loop(self.loop)
+
+        # Load plugins
+        self.load_plugins()
+
+        # Set scheduled job
+        self.add_schedule_jobs(self.schedules)
+        self.scheduler.start()
+
+        self.report_startup(started)
+        self.start_metrics_exporter()
+        try:
+            self.loop.run_until_complete(self.spawn(self.connect()))
+        except asyncio.CancelledError:
+            logging.info('CONNECTION CANCELLED')
+        finally:
+            # Connection is closed. Cancel remaining tasks such as idle
+            # senders, and let them finish before the loop stops.
+            self.loop.run_until_complete(self.__finish_tasks())
+
+    def close(self) -> None:
+        if not self.loop.is_closed():
+            self.loop.run_until_complete(self.__finish_tasks())
+            self.loop.close()
+
+    def stop(self) -> None:
+        if self.metrics_exporter:
+            logging.info('STOP METRICS EXPORTER')
+            self.metrics_exporter.stop()
+
+        logging.info('STOP SCHEDULER')
+        if self.scheduler.running:
+            try:
+                self.scheduler.shutdown(wait=False)
+                logging.info('CANCELLED SCHEDULED WORK')
+            except Exception as e:
+                logging.error(e)
+
+        logging.info('CANCEL RUNNING TASKS')
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.__cancel_tasks)
+
+        logging.info('STOP CONCURRENT WORKER')
+        if self.worker:
+            self.worker.shutdown(wait=False)
+        self.timeout_worker.shutdown(wait=False)
+
+        logging.info('CLOSE CONTEXT STORE')
+        self.user_context_map.close()
+
+    def spawn(self, coroutine: Awaitable) -> asyncio.Task:
+        task = self.loop.create_task(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    async def call(self, function: AnyFunction, *args, **kwargs) -> Any:
+        if asyncio.iscoroutinefunction(function):
+            return await function(*args, **kwargs)
+
+        return await self.result_of(self.loop.run_in_executor(
+            self.worker, partial(function, *args, **kwargs)))
+
+    async def call_profiled(self,
+                            kind: str,
+                            name: str,
+                            function: AnyFunction,
+                            *args,
+                            **kwargs) -> Any:
+        if not asyncio.iscoroutinefunction(function):
+            return await self.call(self.profiled, kind, name, function,
+                                   *args, **kwargs)
+
+        if self.profiler is None:
+            return await function(*args, **kwargs)
+
+        stats = self.profiler.stats_of(kind, name)
+        with stats.lock:
+            stats.calls += 1
+        error = None
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.profiler.record(stats, time.perf_counter() - started, 0.0,
+                                 error, None)
+
+    async def result_of(self, future: Union[Future, asyncio.Future]) -> Any:
+        ret = await asyncio.wrap_future(future, loop=self.loop)
+
+        # Decorated coroutine function such as the one registered via
+        # schedule() returns awaitable from plain wrapper.
+        if inspect.isawaitable(ret):
+            ret = await ret
+
+        return ret
+
+    async def respond(self, user_key, user_input) -> Union[RichMessage, str]:
+        self.messages_received.inc()
+        started = time.perf_counter()
+        dispatch = self.resolve(user_key, user_input)
+        if not isinstance(dispatch, Dispatch):
+            return dispatch
+
+        # Coroutine commands are cancelled on timeout. Plain ones keep
+        # running on the worker, but nobody waits for them. The worker's
+        # future is kept so an abandoned call is counted until it finishes.
+        timeout = self.command_timeout(dispatch)
+        args = ('next_step' if dispatch.in_conversation else 'command',
+                dispatch.name,
+                dispatch.function,
+                dispatch.message,
+                dispatch.config)
+        future = None
+        if self.worker and \
+                not asyncio.iscoroutinefunction(dispatch.function):
+            future = self.worker.submit(self.profiled, *args)
+            pending = self.result_of(future)
+        else:
+            pending = self.call_profiled(*args)
+
+        try:
+            ret = await asyncio.wait_for(pending, timeout)
+        except asyncio.TimeoutError:
+            return self.handle_timeout(dispatch, timeout, future)
+        except Exception as e:
+            return self.handle_error(dispatch, e)
+        finally:
+            self.dispatch_latency.observe(time.perf_counter() - started)
+
+        return self.handle_result(dispatch, ret)
+
+    def enqueue_sending_message(self,
+                                function,
+                                *args,
+                                destination: Hashable=None,
+                                **kwargs) -> asyncio.Future:
+        # Must be called from the event loop.
+        # Each destination gets its own queue and sender task, so messages to
+        # the same destination are sent in order while others don't wait.
+        # Raises asyncio.QueueFull while the destination has max_queue_size
+        # messages waiting, since the loop can't block for room.
+        future = self.loop.create_future()
+
+        lane = self.__lanes.get(destination, None)
+        if lane is None:
+            lane = asyncio.Queue(maxsize=self.message_worker_config.get(
+                'max_queue_size', 0))
+            self.__lanes[destination] = lane
+            self.spawn(self.__drain(destination, lane))
+
+        lane.put_nowait((future, function, args, kwargs))
+        self.messages_sent.inc()
+        return future
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        # Copied first, since metrics exporter calls this from its own thread
+        return dict((destination, lane.qsize())
+                    for destination, lane in list(self.__lanes.items()))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'queue_depths': self.queue_depths(),
+                'tasks': len(self.__tasks),
+                'rate_limit': self.rate_limiter.metrics()
+                if self.rate_limiter else None,
+                'context': self.user_context_map.metrics(),
+                'profile': self.profiler.summary() if self.profiler else None,
+                'messages': {'received': self.messages_received.value,
+                             'sent': self.messages_sent.value},
+                'dispatch_latency': self.dispatch_latency.snapshot(),
+                'timeouts': self.timeout_metrics(),
+                'cache': self.cache_metrics()}
+
+    async def __drain(self, destination: Hashable, lane: asyncio.Queue) \
+            -> None:
+        while True:
+            try:
+                future, function, args, kwargs = await asyncio.wait_for(
+                    lane.get(), self.IDLE_LANE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if lane.empty():
+                    # Nothing is sent for a while. Release this task, and let
+                    # the next message create a new one.
+                    self.__lanes.pop(destination, None)
+                    return
+                continue
+
+            if self.rate_limiter:
+                delay = self.rate_limiter.reserve(destination)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            try:
+                ret = await self.call_profiled(
+                    'send',
+                    getattr(function, '__name__', repr(function)),
+                    function,
+                    *args,
+                    **kwargs)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(ret)
+
+    def __cancel_tasks(self) -> None:
+        for task in list(self.__tasks):
+            task.cancel()
+
+    async def __finish_tasks(self) -> None:
+        self.__cancel_tasks()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__lanes.clear()
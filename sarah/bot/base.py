@@ -1,33 +1,68 @@
 # -*- coding: utf-8 -*-
 import abc
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor, Future
-from functools import wraps
-import imp
+from collections import deque, OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, \
+    TimeoutError as FutureTimeoutError
+from functools import partial, wraps
+import hashlib
 import importlib
+import inspect
 import logging
-import re
+import os
 import sys
+import threading
+import time
 
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from typing import Sequence, Optional, Callable, Union
+from typing import Sequence, Optional, Callable, Union, Dict, Hashable, Any, \
+    List, Tuple
 
+from sarah.bot.cache import ResponseCache
+from sarah.bot.command_index import CommandIndex
+from sarah.bot.context import ContextStore, MemoryContextStore, \
+    ShardedContextStore, SQLiteContextStore
 from sarah.bot.types import PluginConfig, AnyFunction, CommandFunction
-from sarah.bot.values import Command, CommandMessage, UserContext, RichMessage
-from sarah.thread import ThreadExecutor
+from sarah.bot.values import Command, CommandMessage, UserContext, \
+    RichMessage, Dispatch
+from sarah.exceptions import SarahException
+from sarah.exporter import MetricsExporter
+from sarah.metrics import Counter, Histogram
+from sarah.profiling import Profiler
+from sarah.rate_limit import RateLimiter
+from sarah.thread import LaneExecutor, KeyedThreadPoolExecutor
 
 
 class Base(object, metaclass=abc.ABCMeta):
     __commands = {}
+    __command_indexes = {}
     __schedules = {}
     __instances = {}
+    # {class name: {module name: {'commands': OrderedDict,
+    #                             'schedules': OrderedDict}, ...}, ...}
+    # Registration made while load_plugin() executes the module. Applied
+    # at once when the module is successfully executed.
+    __staging = {}
+    __reload_lock = threading.RLock()
+
+    # Plugin configuration keys that tell where the plugin's schedules post.
+    # A plugin configured with any of them is never deferred, because its
+    # schedules would not run until its command is first called.
+    SCHEDULE_CONFIG_KEYS = ()
 
     def __init__(self,
                  plugins: Sequence[PluginConfig]=None,
-                 max_workers: Optional[int]=None) -> None:
+                 max_workers: Optional[int]=None,
+                 context_config: Dict=None,
+                 message_worker_config: Dict=None,
+                 rate_limit_config: Dict=None,
+                 profile_config: Dict=None,
+                 metrics_config: Dict=None,
+                 timeout_config: Dict=None) -> None:
         if not plugins:
             plugins = ()
+        if not context_config:
+            context_config = {}
 
         # {module_name: config, ...}
         # Some simple plugins can be used without configuration, so second
@@ -36,9 +71,79 @@ class Base(object, metaclass=abc.ABCMeta):
         self.plugin_config = OrderedDict(
             [(p[0], p[1] if len(p) > 1 else {}) for p in plugins])
 
+        # {module_name: (command name, ...), ...}
+        # Optional third element declares the names of commands the plugin
+        # registers. Such a plugin is not imported on run(), but on the
+        # first call of its command, so plugins and adapters they import
+        # don't slow down startup. Plugins with schedules can't be deferred.
+        self.plugin_manifest = OrderedDict(
+            [(p[0], tuple(p[2])) for p in plugins if len(p) > 2 and p[2]])
+        self.deferred_plugins = set()
+        self.startup_time = None
+
         self.max_workers = max_workers
+
+        # e.g. {'lanes': 4, 'max_queue_size': 1000}
+        self.message_worker_config = message_worker_config \
+            if message_worker_config else {}
+
+        # e.g. {'rate': 10, 'burst': 20, 'key_rate': 1, 'key_burst': 5}
+        # Workspace-wide and per-destination token buckets. A message
+        # without a token waits in its destination's own queue until the
+        # token is ready, and is handed to message worker then. The lane
+        # is never put to sleep, so other destinations sharing it are not
+        # delayed.
+        self.rate_limiter = RateLimiter(**rate_limit_config) \
+            if rate_limit_config else None
+        # {destination: deque([(ready at, future, fn, args, kwargs), ...])}
+        # Presence of the destination means a timer is going to release it.
+        self.__throttled = {}
+        self.__throttled_lock = threading.Lock()
         self.scheduler = BackgroundScheduler()
-        self.user_context_map = {}
+        # e.g. {'max_size': 10000, 'ttl': 3600, 'shards': 16}
+        self.user_context_map = self.setup_context_store(**context_config)
+
+        # e.g. {'window': 1024, 'sample_every': 100, 'admins': ['U023BECGF']}
+        # Times commands, conversation steps, outbound sends and scheduled
+        # jobs. Disabled unless given. Admins are the user keys allowed to
+        # use .stats command, which is not registered without any.
+        if profile_config is not None:
+            profile_config = dict(profile_config)
+            self.stats_admins = frozenset(profile_config.pop('admins', ()))
+            self.profiler = Profiler(**profile_config)
+        else:
+            self.stats_admins = frozenset()
+            self.profiler = None
+
+        # e.g. {'port': 9100, 'host': '127.0.0.1'}
+        # Serves metrics() in Prometheus text format on run(). Disabled
+        # unless given.
+        self.metrics_config = metrics_config
+        self.metrics_exporter = None
+        self.messages_received = Counter()
+        self.messages_sent = Counter()
+        self.dispatch_latency = Histogram()
+        self.schedule_latency = Histogram()
+
+        # e.g. {'default': 30, 'max_workers': 16}
+        # Commands with timeout run on their own pool, and the responding
+        # thread stops waiting when the timeout passes. The timeout is given
+        # by plugin configuration as {'timeout': 10} for all of its commands
+        # or {'timeouts': {'.weather': 5}} for each, and falls back to the
+        # default here.
+        if not timeout_config:
+            timeout_config = {}
+        self.default_timeout = timeout_config.get('default', None)
+        self.timeout_worker = ThreadPoolExecutor(
+            max_workers=timeout_config.get('max_workers', 16))
+        self.timed_out = Counter()
+        # {name: count, ...}
+        self.timed_out_commands = {}
+        # Timed out calls that are still running. Stuck plugins show up here
+        # instead of silently exhausting threads.
+        self.abandoned_running = 0
+        self.abandoned_finished = 0
+        self.__abandoned_lock = threading.Lock()
 
         # To be set on run()
         self.worker = None
@@ -46,7 +151,12 @@ class Base(object, metaclass=abc.ABCMeta):
 
         # Reset to ease tests in one file
         self.__commands[self.__class__.__name__] = []
+        self.__command_indexes[self.__class__.__name__] = CommandIndex()
         self.__schedules[self.__class__.__name__] = []
+        self.__staging[self.__class__.__name__] = {}
+
+        # {module name: (mtime, sha1 of source), ...} of loaded plugins
+        self.plugin_fingerprints = {}
 
         # To refer to this instance from class method decorator
         self.__instances[self.__class__.__name__] = self
@@ -55,15 +165,34 @@ class Base(object, metaclass=abc.ABCMeta):
     def add_schedule_job(self, command: Command) -> None:
         pass
 
+    def setup_context_store(self,
+                            backend: str='memory',
+                            shards: int=16,
+                            **kwargs) -> ContextStore:
+        # Override this to use other storage
+        if backend == 'sqlite':
+            # e.g. {'backend': 'sqlite', 'path': '/var/lib/sarah/slack.db'}
+            return SQLiteContextStore(**kwargs)
+        elif backend != 'memory':
+            raise ValueError('Unknown context backend. %s' % backend)
+
+        # Contexts are read and written from all workers, so they are split
+        # into shards with their own locks by default.
+        if shards > 1:
+            return ShardedContextStore(shards=shards, **kwargs)
+        return MemoryContextStore(**kwargs)
+
     @abc.abstractmethod
     def connect(self) -> None:
         pass
 
     def run(self) -> None:
+        started = time.monotonic()
+
         # Setup required workers
-        self.worker = ThreadPoolExecutor(max_workers=self.max_workers) \
+        self.worker = KeyedThreadPoolExecutor(max_workers=self.max_workers) \
             if self.max_workers else None
-        self.message_worker = ThreadExecutor()
+        self.message_worker = LaneExecutor(**self.message_worker_config)
 
         # Load plugins
         self.load_plugins()
@@ -72,15 +201,96 @@ class Base(object, metaclass=abc.ABCMeta):
         self.add_schedule_jobs(self.schedules)
         self.scheduler.start()
 
+        self.report_startup(started)
+        self.start_metrics_exporter()
         self.connect()
 
+    def report_startup(self, started: float) -> None:
+        self.startup_time = time.monotonic() - started
+        logging.info('Started in %.3f seconds. %d plugins loaded. '
+                     '%d plugins deferred.' % (
+                         self.startup_time,
+                         len(self.plugin_config) - len(self.deferred_plugins),
+                         len(self.deferred_plugins)))
+
+    def start_metrics_exporter(self) -> None:
+        if self.metrics_config is None:
+            return
+
+        labels = {'adapter': self.__class__.__name__.lower()}
+        self.metrics_exporter = MetricsExporter(self.metrics,
+                                                labels=labels,
+                                                **self.metrics_config)
+        try:
+            self.metrics_exporter.start()
+        except OSError as e:
+            # e.g. Port is in use. Bot itself keeps working.
+            logging.error('Failed to start metrics exporter. %s' % e)
+            self.metrics_exporter = None
+
+    def metrics(self) -> Dict[str, Any]:
+        # Override this to add adapter specific metrics
+        return {'worker': self.worker.metrics() if self.worker else None,
+                'message_worker': self.message_worker.metrics()
+                if self.message_worker else None,
+                'rate_limit': self.rate_limiter.metrics()
+                if self.rate_limiter else None,
+                'throttled': self.throttled_count(),
+                'context': self.user_context_map.metrics(),
+                'startup': {'seconds': self.startup_time,
+                            'deferred_plugins': sorted(self.deferred_plugins)},
+                'profile': self.profiler.summary() if self.profiler else None,
+                'messages': {'received': self.messages_received.value,
+                             'sent': self.messages_sent.value},
+                'dispatch_latency': self.dispatch_latency.snapshot(),
+                'schedule': {'jobs': len(self.scheduler.get_jobs()),
+                             'latency': self.schedule_latency.snapshot()},
+                'timeouts': self.timeout_metrics(),
+                'cache': self.cache_metrics()}
+
+    def cache_metrics(self) -> Dict[str, Dict[str, int]]:
+        return dict((c.name, c.function.cache.metrics())
+                    for c in self.commands
+                    if hasattr(c.function, 'cache'))
+
+    def timeout_metrics(self) -> Dict[str, Any]:
+        with self.__abandoned_lock:
+            return {'timed_out': self.timed_out.value,
+                    'abandoned_running': self.abandoned_running,
+                    'abandoned_finished': self.abandoned_finished,
+                    'by_command': dict(self.timed_out_commands)}
+
+    def profiled(self,
+                 kind: str,
+                 name: str,
+                 function: AnyFunction,
+                 *args,
+                 **kwargs) -> Any:
+        # kind is one of 'command', 'next_step', 'send' and 'schedule'
+        if self.profiler is None:
+            return function(*args, **kwargs)
+        return self.profiler.call(kind, name, function, *args, **kwargs)
+
+    def execute_schedule(self, command: Command) -> Any:
+        started = time.perf_counter()
+        try:
+            return self.profiled('schedule', command.name, command.execute)
+        finally:
+            self.schedule_latency.observe(time.perf_counter() - started)
+
     def stop(self) -> None:
+        if self.metrics_exporter:
+            logging.info('STOP METRICS EXPORTER')
+            self.metrics_exporter.stop()
+
         logging.info('STOP MESSAGE WORKER')
         self.message_worker.shutdown(wait=False)
 
         logging.info('STOP CONCURRENT WORKER')
         if self.worker:
             self.worker.shutdown(wait=False)
+        # Don't wait for abandoned calls
+        self.timeout_worker.shutdown(wait=False)
 
         logging.info('STOP SCHEDULER')
         if self.scheduler.running:
@@ -90,11 +300,31 @@ class Base(object, metaclass=abc.ABCMeta):
             except Exception as e:
                 logging.error(e)
 
+        logging.info('CLOSE CONTEXT STORE')
+        self.user_context_map.close()
+
     @classmethod
-    def concurrent(cls, callback_function: AnyFunction):
+    def concurrent(cls,
+                   callback_function: AnyFunction=None,
+                   key: AnyFunction=None):
+        # Use as @concurrent, or as @concurrent(key=func) to run calls that
+        # give the same key one at a time and in order. e.g. Messages from
+        # the same user are responded in order and don't race on the user's
+        # conversation context, while other users are served in parallel.
+        # Key function receives the same arguments as the callback function
+        # except self.
+        if callback_function is None:
+            return partial(cls.concurrent, key=key)
+
         @wraps(callback_function)
         def wrapper(self, *args, **kwargs):
             if self.worker:
+                if key:
+                    return self.worker.submit_keyed(key(*args, **kwargs),
+                                                    callback_function,
+                                                    self,
+                                                    *args,
+                                                    **kwargs)
                 return self.worker.submit(callback_function,
                                           self,
                                           *args,
@@ -104,38 +334,459 @@ class Base(object, metaclass=abc.ABCMeta):
 
         return wrapper
 
-    def enqueue_sending_message(self, function, *args, **kwargs) -> Future:
-        return self.message_worker.submit(function, *args, **kwargs)
+    def enqueue_sending_message(self,
+                                function,
+                                *args,
+                                destination: Hashable=None,
+                                block: bool=True,
+                                **kwargs) -> Future:
+        # Messages to the same destination such as channel or room are sent
+        # in order, while a slow destination doesn't delay others.
+        # Waits for room while the destination's lane is full, or raises
+        # queue.Full without block.
+        self.messages_sent.inc()
+        if self.profiler:
+            args = ('send',
+                    getattr(function, '__name__', repr(function)),
+                    function) + args
+            function = self.profiled
+
+        if self.rate_limiter:
+            delay = self.rate_limiter.reserve(destination)
+            with self.__throttled_lock:
+                waiting = self.__throttled.get(destination, None)
+                if delay > 0 or waiting is not None:
+                    # Queued behind earlier ones even if the token is ready,
+                    # so the order within the destination is kept.
+                    future = Future()
+                    item = (time.monotonic() + delay,
+                            future,
+                            function,
+                            args,
+                            kwargs)
+                    if waiting is None:
+                        self.__throttled[destination] = deque((item,))
+                        self.__release_later(destination, delay)
+                    else:
+                        waiting.append(item)
+                    return future
+
+        submit = self.message_worker.submit_to if block \
+            else self.message_worker.try_submit_to
+        return submit(destination, function, *args, **kwargs)
+
+    def throttled_count(self) -> int:
+        with self.__throttled_lock:
+            return sum(len(q) for q in self.__throttled.values())
+
+    def __release_later(self, destination: Hashable, delay: float) -> None:
+        timer = threading.Timer(delay,
+                                self.__release_throttled,
+                                args=(destination,))
+        timer.daemon = True
+        timer.start()
+
+    def __release_throttled(self, destination: Hashable) -> None:
+        # Hands messages whose tokens are ready to the destination's lane.
+        # Ones queued while doing so wait for the next release, so nothing
+        # overtakes them.
+        now = time.monotonic()
+        with self.__throttled_lock:
+            waiting = self.__throttled[destination]
+            ready = []
+            while waiting and waiting[0][0] <= now:
+                ready.append(waiting.popleft())
+
+        for _, future, function, args, kwargs in ready:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                sent = self.message_worker.submit_to(destination,
+                                                     function,
+                                                     *args,
+                                                     **kwargs)
+            except Exception as e:
+                # Stopped
+                future.set_exception(e)
+                continue
+            sent.add_done_callback(partial(self.__copy_result, future))
+
+        with self.__throttled_lock:
+            if waiting:
+                self.__release_later(
+                    destination, max(0.0, waiting[0][0] - time.monotonic()))
+            else:
+                del self.__throttled[destination]
+
+    @staticmethod
+    def __copy_result(future: Future, source: Future) -> None:
+        if source.cancelled():
+            future.set_exception(CancelledError())
+            return
+
+        error = source.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(source.result())
 
     def load_plugins(self) -> None:
+        for module_name, config in self.plugin_config.items():
+            if module_name not in self.plugin_manifest:
+                self.load_plugin(module_name)
+            elif any(key in config for key in self.SCHEDULE_CONFIG_KEYS):
+                logging.warning('%s is configured for schedules, so it is '
+                                'loaded now instead of deferred.' %
+                                module_name)
+                self.load_plugin(module_name)
+            else:
+                self.defer_plugin(module_name)
+
+        if self.profiler:
+            if not self.stats_admins:
+                logging.warning('No admin is given for .stats command. '
+                                'Not registering it.')
+                return
+
+            with self.__reload_lock:
+                self.__apply_plugin(
+                    __name__,
+                    [Command('.stats', self.stats_command, __name__, {})],
+                    [])
+
+    def stats_command(self, msg: CommandMessage, config: Dict) -> str:
+        # Built-in admin command registered when profiling is enabled with
+        # admins. ".stats" lists the slowest names and ".stats <name>" shows
+        # the detail of the name including sampled profile, if any.
+        if msg.sender not in self.stats_admins:
+            return 'Only admins can see the stats.'
+
+        if not msg.text:
+            lines = ['%s: %d calls, %d errors, p50 %s, p99 %s' % (
+                name,
+                stats['calls'],
+                stats['errors'],
+                self.format_seconds(stats['wall_p50']),
+                self.format_seconds(stats['wall_p99']))
+                for name, stats in self.profiler.slowest()]
+            return '\n'.join(lines) if lines else 'No stats yet.'
+
+        kind, _, name = msg.text.partition(':')
+        if not name:
+            kind, name = 'command', kind
+        stats = self.profiler.summary().get('%s:%s' % (kind, name), None)
+        if stats is None:
+            return 'No stats for %s.' % msg.text
+
+        lines = ['%s:%s' % (kind, name),
+                 'calls: %d, errors: %d, last error: %s' % (
+                     stats['calls'], stats['errors'], stats['last_error']),
+                 'wall p50: %s, p99: %s, total: %s' % (
+                     self.format_seconds(stats['wall_p50']),
+                     self.format_seconds(stats['wall_p99']),
+                     self.format_seconds(stats['wall_total'])),
+                 'cpu p50: %s, p99: %s, total: %s' % (
+                     self.format_seconds(stats['cpu_p50']),
+                     self.format_seconds(stats['cpu_p99']),
+                     self.format_seconds(stats['cpu_total']))]
+        report = self.profiler.profile_report(kind, name)
+        if report:
+            lines.append('profile of %d sampled calls:' %
+                         stats['profiled_calls'])
+            lines.append(report)
+        return '\n'.join(lines)
+
+    @staticmethod
+    def format_seconds(seconds: Optional[float]) -> str:
+        if seconds is None:
+            return '-'
+        return '%.1fms' % (seconds * 1000)
+
+    def defer_plugin(self, module_name: str) -> None:
+        # Register stand-ins for declared commands. The first call of any of
+        # them loads the plugin, which replaces all stand-ins at once.
+        config = self.plugin_config.get(module_name, {})
+        commands = [Command(name,
+                            self.__deferred_command(module_name, name),
+                            module_name,
+                            config)
+                    for name in self.plugin_manifest[module_name]]
+
+        with self.__reload_lock:
+            self.__apply_plugin(module_name, commands, [])
+            self.deferred_plugins.add(module_name)
+
+        logging.info('Deferred plugin. %s' % module_name)
+
+    def __deferred_command(self,
+                           module_name: str,
+                           name: str) -> CommandFunction:
+        def load_and_call(msg: CommandMessage, config: Dict) \
+                -> Union[str, UserContext]:
+            with self.__reload_lock:
+                if module_name in self.deferred_plugins \
+                        and not self.load_plugin(module_name):
+                    raise SarahException('Failed to load plugin %s.' %
+                                         module_name)
+
+            command = self.command_index.find(name)
+            if command is None or command.name != name:
+                raise SarahException('%s does not register %s.' % (
+                    module_name, name))
+
+            return command.function(msg, command.config)
+
+        return load_and_call
+
+    def load_plugin(self, module_name: str) -> bool:
+        # Commands and schedules the module registers on execution are
+        # staged, and replace the module's previous ones only after the
+        # whole module is executed. Responding threads see either the old
+        # set or the new one, and a module failing to load keeps its
+        # previous commands.
+        with self.__reload_lock:
+            staging = self.__staging[self.__class__.__name__]
+            staging[module_name] = {'commands': OrderedDict(),
+                                    'schedules': OrderedDict()}
+            try:
+                if module_name in sys.modules.keys():
+                    importlib.reload(sys.modules[module_name])
+                else:
+                    importlib.import_module(module_name)
+            except Exception as e:
+                logging.warning('Failed to load %s. %s. Skipping.' % (
+                    module_name, e))
+                return False
+            finally:
+                staged = staging.pop(module_name)
+
+            commands = list(staged['commands'].values())
+            if module_name in self.deferred_plugins:
+                self.deferred_plugins.discard(module_name)
+                missing = set(self.plugin_manifest[module_name]) - \
+                    set(c.name for c in commands)
+                if missing:
+                    logging.warning('%s does not register %s declared in '
+                                    'manifest.' % (module_name,
+                                                   ', '.join(sorted(missing))))
+                if staged['schedules']:
+                    logging.warning('Deferred %s registers schedules, which '
+                                    'did not run until now. Don\'t declare '
+                                    'its commands to load it on startup.' %
+                                    module_name)
+
+            self.__apply_plugin(module_name,
+                                commands,
+                                list(staged['schedules'].values()))
+            self.plugin_fingerprints[module_name] = \
+                self.plugin_fingerprint(module_name)
+
+        logging.info('Loaded plugin. %s' % module_name)
+        return True
+
+    def reload_plugins(self) -> List[str]:
+        """Reloads plugins whose source is changed since loaded, and returns
+        the names of reloaded ones. Safe to call while the bot is running."""
+        reloaded = []
+        with self.__reload_lock:
+            for module_name in self.changed_plugins():
+                if self.load_plugin(module_name):
+                    reloaded.append(module_name)
+
+        return reloaded
+
+    def changed_plugins(self) -> List[str]:
+        changed = []
         for module_name in self.plugin_config.keys():
-            self.load_plugin(module_name)
+            if module_name in self.deferred_plugins:
+                # Loaded on first use anyway
+                continue
+
+            loaded = self.plugin_fingerprints.get(module_name, None)
+            if loaded is None:
+                # Failed to load last time
+                changed.append(module_name)
+                continue
+
+            # Reading the source only when mtime differs
+            mtime = self.plugin_mtime(module_name)
+            if mtime == loaded[0]:
+                continue
+            if self.plugin_fingerprint(module_name) != loaded:
+                changed.append(module_name)
+            else:
+                # e.g. touched. Remember new mtime to skip reading next time
+                self.plugin_fingerprints[module_name] = (mtime, loaded[1])
+
+        return changed
 
     @staticmethod
-    def load_plugin(module_name: str) -> None:
+    def plugin_mtime(module_name: str) -> Optional[float]:
+        path = getattr(sys.modules.get(module_name, None), '__file__', None)
         try:
-            if module_name in sys.modules.keys():
-                imp.reload(sys.modules[module_name])
-            else:
-                importlib.import_module(module_name)
-        except Exception as e:
-            logging.warning('Failed to load %s. %s. Skipping.' % (module_name,
-                                                                  e))
-        else:
-            logging.info('Loaded plugin. %s' % module_name)
+            return os.stat(path).st_mtime if path else None
+        except OSError:
+            return None
+
+    @classmethod
+    def plugin_fingerprint(cls, module_name: str) \
+            -> Tuple[Optional[float], Optional[str]]:
+        path = getattr(sys.modules.get(module_name, None), '__file__', None)
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except (OSError, TypeError):
+            return None, None
+
+        return cls.plugin_mtime(module_name), digest
+
+    def __apply_plugin(self,
+                       module_name: str,
+                       commands: List[Command],
+                       schedules: List[Command]) -> None:
+        class_name = self.__class__.__name__
+
+        # Build new list and index aside, and swap references. Readers keep
+        # using the old ones they already refer to.
+        names = set(c.name for c in commands)
+        new_commands = self.__merge(self.__commands[class_name],
+                                    module_name,
+                                    commands,
+                                    lambda c: c.name in names)
+        index = CommandIndex()
+        for command in new_commands:
+            index.add(command)
+
+        self.__commands[class_name] = new_commands
+        self.__command_indexes[class_name] = index
+
+        old_schedules = [c for c in self.__schedules[class_name]
+                         if c.module_name == module_name]
+        self.__schedules[class_name] = self.__merge(
+            self.__schedules[class_name],
+            module_name,
+            schedules,
+            lambda c: False)
+
+        if self.scheduler.running:
+            for command in old_schedules:
+                try:
+                    self.scheduler.remove_job(self.schedule_job_id(command))
+                except Exception:
+                    # Not added. e.g. Missing configuration.
+                    pass
+            self.add_schedule_jobs(schedules)
+
+    @staticmethod
+    def __merge(current: List[Command],
+                module_name: str,
+                replacing: List[Command],
+                is_overridden: Callable[[Command], bool]) -> List[Command]:
+        # Module's new commands take the place of its old ones, so the order
+        # stays. Others' commands with the same name are overridden by the
+        # later loaded one.
+        merged = []
+        inserted = False
+        for command in current:
+            if command.module_name == module_name:
+                if not inserted:
+                    merged.extend(replacing)
+                    inserted = True
+            elif not is_overridden(command):
+                merged.append(command)
+
+        if not inserted:
+            merged.extend(replacing)
+
+        return merged
+
+    @staticmethod
+    def schedule_job_id(command: Command) -> str:
+        return '%s.%s' % (command.module_name, command.name)
 
     def respond(self, user_key, user_input) -> Union[RichMessage, str]:
+        self.messages_received.inc()
+        started = time.perf_counter()
+        dispatch = self.resolve(user_key, user_input)
+        if not isinstance(dispatch, Dispatch):
+            # Immediate reply such as help message, or None for irrelevant
+            # input.
+            return dispatch
+
+        timeout = self.command_timeout(dispatch)
+        args = ('next_step' if dispatch.in_conversation else 'command',
+                dispatch.name,
+                dispatch.function,
+                dispatch.message,
+                dispatch.config)
+        try:
+            if timeout is None:
+                ret = self.profiled(*args)
+            else:
+                future = self.timeout_worker.submit(self.profiled, *args)
+                try:
+                    ret = future.result(timeout)
+                except FutureTimeoutError:
+                    if future.done():
+                        # Raised by the command itself
+                        raise
+                    return self.handle_timeout(dispatch, timeout, future)
+        except Exception as e:
+            return self.handle_error(dispatch, e)
+        finally:
+            self.dispatch_latency.observe(time.perf_counter() - started)
+
+        return self.handle_result(dispatch, ret)
+
+    def command_timeout(self, dispatch: Dispatch) -> Optional[float]:
+        config = dispatch.config or {}
+        timeouts = config.get('timeouts', {})
+        if dispatch.name in timeouts:
+            return timeouts[dispatch.name]
+        return config.get('timeout', self.default_timeout)
+
+    def handle_timeout(self,
+                       dispatch: Dispatch,
+                       timeout: float,
+                       future: Optional[Future]=None) -> str:
+        # Running thread can't be stopped. The call is abandoned, and its
+        # result is discarded when it finishes. Conversation context is
+        # kept, so the user can try again.
+        self.timed_out.inc()
+        with self.__abandoned_lock:
+            self.timed_out_commands[dispatch.name] = \
+                self.timed_out_commands.get(dispatch.name, 0) + 1
+
+        if future is not None and not future.cancel():
+            # Already running
+            with self.__abandoned_lock:
+                self.abandoned_running += 1
+            future.add_done_callback(partial(self.__abandoned_done,
+                                             dispatch.name))
+
+        logging.error('Timed out. command: %s. input: %s. timeout: %s.' % (
+            dispatch.name, dispatch.message.original_text, timeout))
+        return '"%s" did not finish in %s seconds' % (
+            dispatch.message.original_text, timeout)
+
+    def __abandoned_done(self, name: str, future: Future) -> None:
+        with self.__abandoned_lock:
+            self.abandoned_running -= 1
+            self.abandoned_finished += 1
+        logging.warning('Abandoned command finished. command: %s.' % name)
+
+    def resolve(self,
+                user_key,
+                user_input) -> Union[Dispatch, RichMessage, str, None]:
         user_context = self.user_context_map.get(user_key, None)
 
-        ret = None
-        error = []
         if user_context:
             # User is in the middle of conversation
 
             if user_input == '.abort':
                 # If user wishes, abort the current conversation, and remove
                 # context data.
-                self.user_context_map.pop(user_key)
+                self.user_context_map.pop(user_key, None)
                 return 'Abort current conversation'
 
             # Check if we can proceed conversation. If user input is irrelevant
@@ -146,48 +797,61 @@ class Base(object, metaclass=abc.ABCMeta):
             if option is None:
                 return user_context.help_message
 
-            try:
-                config = self.plugin_config.get(option.next_step.__module__,
-                                                {})
-                ret = option.next_step(CommandMessage(original_text=user_input,
-                                                      text=user_input,
-                                                      sender=user_key),
-                                       config)
-
-                # Only when command is successfully executed, remove current
-                # context. To forcefully abort the conversation, use ".abort"
-                # command
-                self.user_context_map.pop(user_key)
-            except Exception as e:
-                error.append((option.next_step.__name__, str(e)))
-
-        else:
-            # If user is not in the middle of conversation, see if the input
-            # text contains command.
-            command = self.find_command(user_input)
-            if command is None:
-                # If it doesn't match any command, leave it.
-                return
-
-            try:
-                text = re.sub(r'{0}\s+'.format(command.name), '', user_input)
-                ret = command.execute(CommandMessage(original_text=user_input,
-                                                     text=text,
-                                                     sender=user_key))
-            except Exception as e:
-                error.append((command.name, str(e)))
-
-        if error:
-            logging.error('Error occurred. '
-                          'command: %s. input: %s. error: %s.' % (
-                              error[0][0], user_input, error[0][1]
-                          ))
-            return 'Something went wrong with "%s"' % user_input
+            return Dispatch(name=option.next_step.__name__,
+                            function=option.next_step,
+                            message=CommandMessage(original_text=user_input,
+                                                   text=user_input,
+                                                   sender=user_key),
+                            config=self.plugin_config.get(
+                                option.next_step.__module__, {}),
+                            in_conversation=True)
+
+        # If user is not in the middle of conversation, see if the input
+        # text contains command.
+        command = self.find_command(user_input)
+        if command is None:
+            # If it doesn't match any command, leave it.
+            return None
+
+        # find_command() guarantees the input starts with the command name, so
+        # arguments can be sliced off without building and matching regular
+        # expression every time.
+        text = user_input[len(command.name):].lstrip()
+        return Dispatch(name=command.name,
+                        function=command.function,
+                        message=CommandMessage(original_text=user_input,
+                                               text=text,
+                                               sender=user_key),
+                        config=command.config,
+                        in_conversation=False)
 
-        elif not ret:
+    @staticmethod
+    def handle_error(dispatch: Dispatch, error: Exception) -> str:
+        logging.error('Error occurred. '
+                      'command: %s. input: %s. error: %s.' % (
+                          dispatch.name,
+                          dispatch.message.original_text,
+                          error))
+        return 'Something went wrong with "%s"' % \
+               dispatch.message.original_text
+
+    def handle_result(self,
+                      dispatch: Dispatch,
+                      ret: Union[UserContext, RichMessage, str]) \
+            -> Union[RichMessage, str]:
+        user_key = dispatch.message.sender
+
+        if dispatch.in_conversation:
+            # Only when command is successfully executed, remove current
+            # context. To forcefully abort the conversation, use ".abort"
+            # command
+            self.user_context_map.pop(user_key, None)
+
+        if not ret:
             logging.error('command should return UserContext or text'
                           'to let user know the result or next move')
-            return 'Something went wrong with "%s"' % user_input
+            return 'Something went wrong with "%s"' % \
+                   dispatch.message.original_text
 
         elif isinstance(ret, UserContext):
             self.user_context_map[user_key] = ret
@@ -198,8 +862,8 @@ class Base(object, metaclass=abc.ABCMeta):
             return ret
 
     def find_command(self, text: str) -> Optional[Command]:
-        return next((c for c in self.commands if text.startswith(c.name)),
-                    None)
+        # Longest registered name that prefixes the given text wins.
+        return self.command_index.find(text)
 
     @property
     def schedules(self) -> OrderedDict:
@@ -224,10 +888,16 @@ class Base(object, metaclass=abc.ABCMeta):
                                       wrapped_function,
                                       func.__module__,
                                       config)
+                    staged = cls.__staging[cls.__name__].get(func.__module__,
+                                                             None)
+                    if staged is not None:
+                        staged['schedules'][command.name] = command
+                        return wrapped_function
+
                     try:
                         # If command is already registered, updated it.
                         idx = [c.name for c in cls.__schedules[cls.__name__]] \
-                            .index(command)
+                            .index(command.name)
                         cls.__schedules[cls.__name__][idx] = command
                     except ValueError:
                         # Not registered, just append it.
@@ -246,13 +916,28 @@ class Base(object, metaclass=abc.ABCMeta):
         for command in commands:
             self.add_schedule_job(command)
 
+    @classmethod
+    def instance(cls) -> Optional['Base']:
+        # Running bot of this class. Lets plugin functions, which only
+        # receive message and config, reach the bot's facilities.
+        return cls.__instances.get(cls.__name__, None)
+
     @property
     def commands(self) -> OrderedDict:
         return self.__commands.get(self.__class__.__name__, [])
 
+    @property
+    def command_index(self) -> CommandIndex:
+        return self.__command_indexes.get(self.__class__.__name__,
+                                          CommandIndex())
+
     @classmethod
-    def command(cls, name: str) -> Callable[[CommandFunction],
-                                            CommandFunction]:
+    def command(cls,
+                name: str,
+                cache: Dict=None) -> Callable[[CommandFunction],
+                                              CommandFunction]:
+        # Give cache, e.g. {'ttl': 300, 'max_size': 256}, to memoize
+        # responses of an idempotent command. See ResponseCache.
 
         def wrapper(func: CommandFunction) -> CommandFunction:
             @wraps(func)
@@ -266,17 +951,71 @@ class Base(object, metaclass=abc.ABCMeta):
                 # If command name duplicates, update with the later one.
                 # The order stays.
 
-                command = Command(name, func, func.__module__, config)
+                function = func
+                if cache is not None:
+                    if inspect.iscoroutinefunction(func):
+                        raise ValueError('cache is not supported for '
+                                         'coroutine function. %s' % name)
+                    function = ResponseCache(**cache)(func)
+
+                command = Command(name, function, func.__module__, config)
+                staged = cls.__staging[cls.__name__].get(func.__module__, None)
+                if staged is not None:
+                    # Being loaded via load_plugin(). Applied after the whole
+                    # module is executed.
+                    staged['commands'][command.name] = command
+                    return wrapped_function
+
                 try:
                     # If command is already registered, updated it.
                     idx = [c.name for c in cls.__commands[cls.__name__]] \
-                        .index(command)
+                        .index(command.name)
                     cls.__commands[cls.__name__][idx] = command
                 except ValueError:
                     # Not registered, just append it.
                     cls.__commands[cls.__name__].append(command)
 
+                # Imported outside load_plugin(), e.g. in plugin's test.
+                cls.__command_indexes[cls.__name__].add(command)
+
             # To ease plugin's unit test
             return wrapped_function
 
         return wrapper
+
+    @classmethod
+    def command_for(cls,
+                    adapter: str,
+                    name: str,
+                    cache: Dict=None) -> Callable[[CommandFunction],
+                                                  CommandFunction]:
+        # Same as command() of the adapter class named adapter, e.g. 'Slack',
+        # but the plugin doesn't have to import the adapter. A plugin
+        # supporting several adapters then doesn't pull in ones the process
+        # doesn't run, such as sleekxmpp for a Slack bot.
+        adapter_class = cls.adapter_class(adapter)
+        if adapter_class is None:
+            # Not imported, so never instantiated in this process either
+            return lambda func: func
+        return adapter_class.command(name, cache)
+
+    @classmethod
+    def schedule_for(cls,
+                     adapter: str,
+                     name: str) -> Callable[[CommandFunction], None]:
+        # Same as schedule() of the adapter class. See command_for().
+        adapter_class = cls.adapter_class(adapter)
+        if adapter_class is None:
+            return lambda func: func
+        return adapter_class.schedule(name)
+
+    @staticmethod
+    def adapter_class(name: str) -> Optional[type]:
+        # Only adapters whose modules are already imported are found.
+        classes = Base.__subclasses__()
+        while classes:
+            adapter_class = classes.pop()
+            if adapter_class.__name__ == name:
+                return adapter_class
+            classes.extend(adapter_class.__subclasses__())
+        return None
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable
+
+from sarah.bot.values import CommandMessage, UserContext
+
+
+def freeze(value: Any) -> Hashable:
+    # Hashable equivalent of configuration that consists of dictionaries
+    # and lists.
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class ResponseCache(object):
+    # Memoizes responses of an idempotent command.
+    #
+    #   @Slack.command('.weather', cache={'ttl': 300, 'max_size': 256})
+    #   def weather(msg, config):
+    #       ...
+    #
+    # Responses are keyed on the input text with whitespace collapsed and
+    # the plugin configuration, but not on the sender, so every user gets
+    # the same response within ttl seconds. The least recently used one is
+    # evicted when max_size is reached.
+    # While a response is being built, identical calls wait for it instead
+    # of running the command again. Exceptions and responses that start a
+    # conversation are passed to the waiting callers but never cached.
+
+    def __init__(self,
+                 ttl: float=60,
+                 max_size: int=128,
+                 ignore_case: bool=False,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if max_size < 1:
+            raise ValueError('max_size must be positive. %s' % max_size)
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.ignore_case = ignore_case
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+        # {key: (stored time, response), ...} in the order of last access
+        self.__entries = OrderedDict()
+        # {key: Future, ...} of the calls being executed
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, function: Callable) -> Callable:
+        @wraps(function)
+        def cached(msg: CommandMessage, config: Dict) -> Any:
+            return self.get_or_call(self.key(msg, config),
+                                    function,
+                                    msg,
+                                    config)
+
+        cached.cache = self
+        return cached
+
+    def key(self, msg: CommandMessage, config: Dict) -> Hashable:
+        text = ' '.join(msg.text.split())
+        if self.ignore_case:
+            text = text.lower()
+        return text, freeze(config)
+
+    def get_or_call(self,
+                    key: Hashable,
+                    function: Callable,
+                    *args,
+                    **kwargs) -> Any:
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is not None:
+                if self.clock() - entry[0] <= self.ttl:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+
+                del self.__entries[key]
+                self.evicted_ttl += 1
+
+            future = self.__in_flight.get(key, None)
+            if future is None:
+                future = Future()
+                self.__in_flight[key] = future
+                self.misses += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            return future.result()
+
+        try:
+            response = function(*args, **kwargs)
+        except BaseException as e:
+            with self.__lock:
+                del self.__in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self.__lock:
+            del self.__in_flight[key]
+            if response and not isinstance(response, UserContext):
+                self.__store(key, response)
+        future.set_result(response)
+        return response
+
+    def __store(self, key: Hashable, response: Any) -> None:
+        self.__entries[key] = (self.clock(), response)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+            self.evicted_lru += 1
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evicted_lru': self.evicted_lru,
+                'evicted_ttl': self.evicted_ttl}
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+
+from sarah.bot.values import Command
+
+
+class CommandIndex(object):
+    # Prefix trie keyed by each character of command name.
+    # Each node is a list of [children, command] so walking the tree only
+    # costs dictionary look-ups. Lookup walks along the given text until no
+    # child node matches, which makes the cost proportional to the length of
+    # the command token rather than to the number of registered commands.
+    # The deepest node with a command wins, so ".reset_count" is preferred
+    # over ".reset" for the input ".reset_count".
+
+    def __init__(self) -> None:
+        self.__root = [{}, None]
+        self.__size = 0
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def add(self, command: Command) -> None:
+        node = self.__root
+        for char in command.name:
+            node = node[0].setdefault(char, [{}, None])
+
+        if node[1] is None:
+            self.__size += 1
+
+        # If command name duplicates, update with the later one.
+        node[1] = command
+
+    def find(self, text: str) -> Optional[Command]:
+        node = self.__root
+        found = None
+        for char in text:
+            node = node[0].get(char, None)
+            if node is None:
+                break
+            if node[1] is not None:
+                found = node[1]
+
+        return found
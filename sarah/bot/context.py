@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+import abc
+import base64
+from collections import OrderedDict
+import importlib
+import json
+import logging
+import pickle
+import re
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, Hashable, Optional, Callable
+
+from sarah.bot.values import UserContext, InputOption, RichMessage
+
+_MISSING = object()
+
+
+class ContextStore(object, metaclass=abc.ABCMeta):
+    # Storage for UserContext keyed by user.
+    # Provides the subset of dict interface that Base.respond() relies on so
+    # the store can be replaced without touching conversation logic.
+
+    @abc.abstractmethod
+    def get(self,
+            key: Hashable,
+            default: Optional[UserContext]=None) -> Optional[UserContext]:
+        pass
+
+    @abc.abstractmethod
+    def __setitem__(self, key: Hashable, value: UserContext) -> None:
+        pass
+
+    @abc.abstractmethod
+    def pop(self, key: Hashable, default: Any=_MISSING) -> UserContext:
+        pass
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def metrics(self) -> Dict[str, int]:
+        pass
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def close(self) -> None:
+        # Override this to release resources or write pending changes
+        pass
+
+
+class MemoryContextStore(ContextStore):
+    # In-memory store with LRU and idle-TTL eviction.
+    #
+    # Entries are kept in an OrderedDict in the order of last access, so the
+    # least recently used entry is always at the head. That also means the
+    # head is the first one to be expired by idle TTL, and expired entries
+    # can be found without scanning the whole store.
+    # Every write sweeps at most SWEEP_BATCH expired entries from the head,
+    # so eviction cost stays O(1) on the message path while expired entries
+    # are still drained faster than new ones can come in.
+
+    SWEEP_BATCH = 2
+
+    def __init__(self,
+                 max_size: int=10000,
+                 ttl: Optional[float]=3600,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if max_size < 1:
+            raise ValueError('max_size must be positive. %s' % max_size)
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+        # {key: (context, last accessed time), ...}
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self,
+            key: Hashable,
+            default: Optional[UserContext]=None) -> Optional[UserContext]:
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is None:
+                return default
+
+            now = self.clock()
+            if self.__is_expired(entry, now):
+                del self.__entries[key]
+                self.evicted_ttl += 1
+                return default
+
+            self.__entries[key] = (entry[0], now)
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def __setitem__(self, key: Hashable, value: UserContext) -> None:
+        with self.__lock:
+            now = self.clock()
+            self.__entries[key] = (value, now)
+            self.__entries.move_to_end(key)
+
+            self.__sweep(now)
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evicted_lru += 1
+
+    def pop(self, key: Hashable, default: Any=_MISSING) -> UserContext:
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+
+        if entry is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+
+        return entry[0]
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'size': len(self.__entries),
+                'max_size': self.max_size,
+                'evicted_lru': self.evicted_lru,
+                'evicted_ttl': self.evicted_ttl}
+
+    def __is_expired(self, entry, now: float) -> bool:
+        return self.ttl is not None and now - entry[1] > self.ttl
+
+    def __sweep(self, now: float) -> None:
+        for _ in range(self.SWEEP_BATCH):
+            if not self.__entries:
+                return
+
+            key, entry = next(iter(self.__entries.items()))
+            if not self.__is_expired(entry, now):
+                return
+
+            del self.__entries[key]
+            self.evicted_ttl += 1
+
+
+class ShardedContextStore(ContextStore):
+    # Set of MemoryContextStore, each guarded by its own lock.
+    #
+    # A user is always stored in the same shard chosen by the hash of the
+    # key, so workers responding to different users rarely wait for each
+    # other's lock while operations for one user stay serialized.
+    # max_size is divided among shards, so LRU eviction is per shard and
+    # only approximates the global one.
+
+    def __init__(self,
+                 shards: int=16,
+                 max_size: int=10000,
+                 ttl: Optional[float]=3600,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if shards < 1:
+            raise ValueError('shards must be positive. %s' % shards)
+        if max_size < 1:
+            raise ValueError('max_size must be positive. %s' % max_size)
+
+        # Each shard must be able to hold at least one entry
+        shards = min(shards, max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__shards = tuple(
+            MemoryContextStore(max_size=-(-max_size // shards),
+                               ttl=ttl,
+                               clock=clock)
+            for _ in range(shards))
+
+    @property
+    def shards(self) -> int:
+        return len(self.__shards)
+
+    def shard_of(self, key: Hashable) -> MemoryContextStore:
+        return self.__shards[hash(key) % len(self.__shards)]
+
+    def get(self,
+            key: Hashable,
+            default: Optional[UserContext]=None) -> Optional[UserContext]:
+        return self.shard_of(key).get(key, default)
+
+    def __setitem__(self, key: Hashable, value: UserContext) -> None:
+        self.shard_of(key)[key] = value
+
+    def pop(self, key: Hashable, default: Any=_MISSING) -> UserContext:
+        return self.shard_of(key).pop(key, default)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.__shards)
+
+    def metrics(self) -> Dict[str, int]:
+        metrics = {'size': 0, 'evicted_lru': 0, 'evicted_ttl': 0}
+        for shard in self.__shards:
+            for name, value in shard.metrics().items():
+                if name in metrics:
+                    metrics[name] += value
+        metrics.update({'max_size': self.max_size,
+                        'shards': len(self.__shards)})
+        return metrics
+
+
+def dump_context(context: UserContext) -> str:
+    """Serializes UserContext to JSON.
+
+    Each next step is stored as a reference to its module and qualified
+    name, so it must be defined at module level. RichMessage is pickled."""
+    message = context.message
+    if isinstance(message, RichMessage):
+        message = {'pickle': base64.b64encode(pickle.dumps(message))
+                   .decode('ascii')}
+
+    options = []
+    for option in context.input_options:
+        function = option.next_step
+        qualname = getattr(function, '__qualname__', '')
+        if '<' in qualname:
+            raise ValueError('%s can not be referred by name. Define the next '
+                             'step at module level.' % qualname)
+
+        options.append({'pattern': option.pattern.pattern,
+                        'flags': option.pattern.flags,
+                        'module': function.__module__,
+                        'qualname': qualname})
+
+    return json.dumps({'message': message,
+                       'help_message': context.help_message,
+                       'input_options': options})
+
+
+def load_context(data: str) -> UserContext:
+    """Restores UserContext serialized by dump_context()."""
+    loaded = json.loads(data)
+
+    message = loaded['message']
+    if isinstance(message, dict):
+        message = pickle.loads(base64.b64decode(message['pickle']))
+
+    options = []
+    for option in loaded['input_options']:
+        next_step = importlib.import_module(option['module'])
+        for name in option['qualname'].split('.'):
+            next_step = getattr(next_step, name)
+
+        options.append(InputOption(re.compile(option['pattern'],
+                                              option['flags']),
+                                   next_step))
+
+    return UserContext(message=message,
+                       help_message=loaded['help_message'],
+                       input_options=tuple(options))
+
+
+class SQLiteContextStore(ContextStore):
+    # Persistent store backed by SQLite, so conversations survive restarts
+    # and can be shared by bots sharing the database file.
+    #
+    # Contexts are kept in MemoryContextStore as well, and reads are served
+    # from there. Keys in the database are loaded on start and kept up to
+    # date on every write, so only a miss for a user who has a stored
+    # context, e.g. the first message after a restart, reads the database.
+    # Most messages come from users not in conversation, and they never
+    # touch the database or its lock. Writes are applied to memory, and the
+    # database is updated by a background thread in batches every
+    # flush_interval seconds or when batch_size changes are pending. So the
+    # reply path never waits for disk, while changes made in the last
+    # flush_interval may be lost on crash. Each process has its own memory
+    # cache and set of stored keys; route a user to the same process when
+    # scaling out.
+
+    def __init__(self,
+                 path: str=':memory:',
+                 max_size: int=10000,
+                 ttl: Optional[float]=3600,
+                 flush_interval: float=1.0,
+                 batch_size: int=100,
+                 clock: Callable[[], float]=time.time) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.clock = clock
+
+        # Wall clock time is stored, so expiration works across restarts
+        self.__cache = MemoryContextStore(max_size=max_size,
+                                          ttl=ttl,
+                                          clock=clock)
+
+        # {key: (serialized context or None to delete, updated time), ...}
+        self.__pending = OrderedDict()
+        # Ones being written. Still looked up until the write completes.
+        self.__flushing = {}
+        self.__pending_lock = threading.Condition()
+        self.__flush_lock = threading.Lock()
+
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__db_lock = threading.Lock()
+        with self.__db_lock, self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS user_context ('
+                'key TEXT PRIMARY KEY, '
+                'value TEXT NOT NULL, '
+                'updated_at REAL NOT NULL)')
+            # {str(key), ...} of rows in the database
+            self.__stored_keys = set(
+                row[0] for row in self.__connection.execute(
+                    'SELECT key FROM user_context'))
+
+        self.loaded = 0
+        self.flushed = 0
+        self.flush_errors = 0
+        self.serialize_errors = 0
+
+        self.__closed = False
+        self.__flusher = threading.Thread(target=self.__flush_loop,
+                                          name='SQLiteContextStore',
+                                          daemon=True)
+        self.__flusher.start()
+
+    @property
+    def max_size(self) -> int:
+        return self.__cache.max_size
+
+    def get(self,
+            key: Hashable,
+            default: Optional[UserContext]=None) -> Optional[UserContext]:
+        context = self.__cache.get(key, None)
+        if context is not None:
+            return context
+
+        context = self.__lookup(key)
+        if context is None:
+            return default
+
+        self.__cache[key] = context
+        return context
+
+    def __setitem__(self, key: Hashable, value: UserContext) -> None:
+        try:
+            data = dump_context(value)
+        except Exception as e:
+            # Still usable in this process, but won't survive restart
+            logging.error('Failed to serialize context for %s. %s' % (key, e))
+            self.serialize_errors += 1
+            data = None
+
+        self.__cache[key] = value
+        self.__enqueue(key, data)
+
+    def pop(self, key: Hashable, default: Any=_MISSING) -> UserContext:
+        context = self.__cache.pop(key, None)
+        if context is None:
+            context = self.__lookup(key)
+        if context is not None:
+            self.__enqueue(key, None)
+
+        if context is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+
+        return context
+
+    def __len__(self) -> int:
+        self.flush()
+        with self.__db_lock:
+            return self.__connection.execute(
+                'SELECT COUNT(*) FROM user_context').fetchone()[0]
+
+    def metrics(self) -> Dict[str, int]:
+        metrics = self.__cache.metrics()
+        metrics.update({'pending': len(self.__pending),
+                        'stored': len(self.__stored_keys),
+                        'loaded': self.loaded,
+                        'flushed': self.flushed,
+                        'flush_errors': self.flush_errors,
+                        'serialize_errors': self.serialize_errors})
+        return metrics
+
+    def flush(self) -> None:
+        """Writes pending changes to the database."""
+        with self.__flush_lock:
+            self.__flush()
+
+    def __flush(self) -> None:
+        with self.__pending_lock:
+            if not self.__pending:
+                return
+            pending = self.__pending
+            self.__pending = OrderedDict()
+            self.__flushing = pending
+
+        upserts = [(str(key), data, updated_at)
+                   for key, (data, updated_at) in pending.items() if data]
+        deletes = [(str(key),)
+                   for key, (data, _) in pending.items() if not data]
+        expired_at = self.clock() - self.ttl if self.ttl is not None else None
+
+        try:
+            with self.__db_lock, self.__connection:
+                self.__connection.executemany(
+                    'INSERT OR REPLACE INTO user_context '
+                    '(key, value, updated_at) VALUES (?, ?, ?)', upserts)
+                self.__connection.executemany(
+                    'DELETE FROM user_context WHERE key = ?', deletes)
+                if expired_at is not None:
+                    self.__connection.execute(
+                        'DELETE FROM user_context WHERE updated_at < ?',
+                        (expired_at,))
+        except sqlite3.Error as e:
+            logging.error('Failed to write contexts. %s' % e)
+            self.flush_errors += 1
+
+            # Put them back unless newer changes are made meanwhile
+            with self.__pending_lock:
+                for key, entry in pending.items():
+                    self.__pending.setdefault(key, entry)
+                self.__flushing = {}
+            return
+
+        with self.__db_lock:
+            # Expired rows stay in the set until a lookup misses them
+            self.__stored_keys.update(row[0] for row in upserts)
+            self.__stored_keys.difference_update(row[0] for row in deletes)
+        with self.__pending_lock:
+            self.__flushing = {}
+        self.flushed += len(pending)
+
+    def close(self) -> None:
+        with self.__pending_lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__pending_lock.notify()
+
+        self.__flusher.join()
+        self.flush()
+        with self.__db_lock:
+            self.__connection.close()
+
+    def __enqueue(self, key: Hashable, data: Optional[str]) -> None:
+        with self.__pending_lock:
+            self.__pending[key] = (data, self.clock())
+            self.__pending.move_to_end(key)
+            if len(self.__pending) >= self.batch_size:
+                self.__pending_lock.notify()
+
+    def __flush_loop(self) -> None:
+        while True:
+            with self.__pending_lock:
+                if not self.__closed \
+                        and len(self.__pending) < self.batch_size:
+                    self.__pending_lock.wait(self.flush_interval)
+                if self.__closed:
+                    return
+
+            self.flush()
+
+    def __lookup(self, key: Hashable) -> Optional[UserContext]:
+        # Called on cache miss
+        with self.__pending_lock:
+            entry = self.__pending.get(key, None) \
+                or self.__flushing.get(key, None)
+        if entry is not None:
+            # Deleted, or evicted from memory before being written
+            return load_context(entry[0]) if entry[0] else None
+
+        return self.__load(key)
+
+    def __load(self, key: Hashable) -> Optional[UserContext]:
+        key = str(key)
+        if key not in self.__stored_keys:
+            return None
+
+        with self.__db_lock:
+            row = self.__connection.execute(
+                'SELECT value, updated_at FROM user_context WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                self.__stored_keys.discard(key)
+
+        if row is None:
+            return None
+
+        if self.ttl is not None and self.clock() - row[1] > self.ttl:
+            return None
+
+        try:
+            context = load_context(row[0])
+        except Exception as e:
+            # e.g. next step is renamed or removed since it was stored
+            logging.error('Failed to restore context for %s. %s' % (key, e))
+            return None
+
+        self.loaded += 1
+        return context
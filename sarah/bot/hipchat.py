@@ -13,6 +13,8 @@ from sarah.bot.types import PluginConfig
 
 
 class HipChat(Base):
+    SCHEDULE_CONFIG_KEYS = ('rooms',)
+
     def __init__(self,
                  plugins: Sequence[PluginConfig]=None,
                  jid: str='',
@@ -20,9 +22,22 @@ class HipChat(Base):
                  rooms: Sequence[str]=None,
                  nick: str='',
                  proxy: Dict=None,
-                 max_workers: int=None) -> None:
-
-        super().__init__(plugins=plugins, max_workers=max_workers)
+                 max_workers: int=None,
+                 context_config: Dict=None,
+                 message_worker_config: Dict=None,
+                 rate_limit_config: Dict=None,
+                 profile_config: Dict=None,
+                 metrics_config: Dict=None,
+                 timeout_config: Dict=None) -> None:
+
+        super().__init__(plugins=plugins,
+                         max_workers=max_workers,
+                         context_config=context_config,
+                         message_worker_config=message_worker_config,
+                         rate_limit_config=rate_limit_config,
+                         profile_config=profile_config,
+                         metrics_config=metrics_config,
+                         timeout_config=timeout_config)
 
         if not rooms:
             rooms = []
@@ -38,16 +53,17 @@ class HipChat(Base):
             return
 
         def job_function() -> None:
-            ret = command.execute()
+            ret = self.execute_schedule(command)
             for room in command.config['rooms']:
                 self.enqueue_sending_message(self.client.send_message,
                                              mto=room,
                                              mbody=ret,
                                              mtype=command.config.get(
-                                                 'message_type', 'groupchat'))
+                                                 'message_type', 'groupchat'),
+                                             destination=room)
 
-        job_id = '%s.%s' % (command.module_name, command.name)
-        logging.info("Add schedule %s" % id)
+        job_id = self.schedule_job_id(command)
+        logging.info("Add schedule %s" % job_id)
         self.scheduler.add_job(
             job_function,
             'interval',
@@ -120,7 +136,9 @@ class HipChat(Base):
                                                    maxhistory=None,
                                                    wait=True)
 
-    @concurrent
+    # Messages from the same user are handled one at a time and in order, so
+    # the user's conversation proceeds as the user typed.
+    @concurrent(key=lambda msg: str(msg['from']))
     def message(self, msg: Message) -> Optional[Future]:
         if msg['delay']['stamp']:
             # Avoid answering to all past messages when joining the room.
@@ -145,7 +163,9 @@ class HipChat(Base):
 
         ret = self.respond(msg['from'], msg['body'])
         if ret:
-            return self.enqueue_sending_message(lambda: msg.reply(ret).send())
+            # Room for groupchat, and sender for direct chat
+            return self.enqueue_sending_message(lambda: msg.reply(ret).send(),
+                                                destination=msg['from'].bare)
 
     def stop(self) -> None:
         super().stop()
@@ -3,9 +3,8 @@
 import random
 
 from typing import Dict
-from sarah.bot.values import CommandMessage
-from sarah.bot.hipchat import HipChat
-from sarah.bot.slack import Slack, SlackMessage, MessageAttachment
+from sarah.bot import Base
+from sarah.bot.values import CommandMessage, RichMessage
 
 
 # http://www.imdb.com/title/tt0105958/quotes
@@ -40,18 +39,21 @@ def _hipchat_message():
 
 
 # noinspection PyUnusedLocal
-@HipChat.command('.bmw')
+@Base.command_for('HipChat', '.bmw')
 def hipchat_quote(msg: CommandMessage, config: Dict) -> str:
     return _hipchat_message()
 
 
 # noinspection PyUnusedLocal
-@HipChat.schedule('bmw_quotes')
+@Base.schedule_for('HipChat', 'bmw_quotes')
 def hipchat_scheduled_quote(config: Dict) -> str:
     return _hipchat_message()
 
 
 def _slack_message():
+    # Only called under Slack, which is already imported then
+    from sarah.bot.slack import SlackMessage, MessageAttachment
+
     quote = random.choice(quotes)
     if isinstance(quote[0], str):
         title = quote.pop(0)
@@ -77,12 +79,12 @@ def _slack_message():
 
 
 # noinspection PyUnusedLocal
-@Slack.command('.bmw')
-def slack_quote(msg: CommandMessage, config: Dict) -> SlackMessage:
+@Base.command_for('Slack', '.bmw')
+def slack_quote(msg: CommandMessage, config: Dict) -> RichMessage:
     return _slack_message()
 
 
 # noinspection PyUnusedLocal
-@Slack.schedule('bmw_quotes')
-def slack_scheduled_quote(config: Dict) -> SlackMessage:
+@Base.schedule_for('Slack', 'bmw_quotes')
+def slack_scheduled_quote(config: Dict) -> RichMessage:
     return _slack_message()
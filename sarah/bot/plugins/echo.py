@@ -1,17 +1,16 @@
 # -*- coding: utf-8 -*-
 from typing import Dict
+from sarah.bot import Base
 from sarah.bot.values import CommandMessage
-from sarah.bot.hipchat import HipChat
-from sarah.bot.slack import Slack
 
 
 # noinspection PyUnusedLocal
-@HipChat.command('.echo')
+@Base.command_for('HipChat', '.echo')
 def hipchat_echo(msg: CommandMessage, config: Dict) -> str:
     return msg.text
 
 
 # noinspection PyUnusedLocal
-@Slack.command('.echo')
+@Base.command_for('Slack', '.echo')
 def slack_echo(msg: CommandMessage, config: Dict) -> str:
     return msg.text
@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 from typing import Dict
+from sarah.bot import Base
 from sarah.bot.values import CommandMessage, UserContext, InputOption
 
-from sarah.bot.hipchat import HipChat
-
 
 # noinspection PyUnusedLocal
-@HipChat.command('.hello')
+@Base.command_for('HipChat', '.hello')
 def hipchat_hello(msg: CommandMessage, config: Dict) -> UserContext:
     # Return UserContext to start conversation. State will be stored for later
     # user interaction.
@@ -1,50 +1,47 @@
 # -*- coding: utf-8 -*-
 from typing import Dict
+from sarah.bot import Base
 from sarah.bot.values import CommandMessage
-
-from sarah.bot.hipchat import HipChat
-from sarah.bot.slack import Slack
+from sarah.bot.state import UserStore
 
 __stash = {'hipchat': {},
            'slack': {}}
 
+# Commands are called from concurrent workers, so stashed values are only
+# touched through UserStore.
+__stores = dict((bot_type, UserStore(stash))
+                for bot_type, stash in __stash.items())
 
-def count(bot_type: str, user_key: str, key: str) -> int:
-    stash = __stash[bot_type]
-    if user_key not in stash:
-        stash[user_key] = {}
 
-    cnt = stash[user_key].get(key, 0) + 1
-    stash[user_key][key] = cnt
-    return cnt
+def count(bot_type: str, user_key: str, key: str) -> int:
+    return __stores[bot_type].update(user_key, key, lambda cnt: cnt + 1, 0)
 
 
 def reset_count(bot_type: str) -> None:
-    stash = __stash[bot_type]
-    stash.clear()
+    __stores[bot_type].clear()
 
 
 # noinspection PyUnusedLocal
-@HipChat.command('.count')
+@Base.command_for('HipChat', '.count')
 def hipchat_count(msg: CommandMessage, config: Dict) -> str:
     return str(count('hipchat', msg.sender, msg.text))
 
 
 # noinspection PyUnusedLocal
-@HipChat.command('.reset_count')
+@Base.command_for('HipChat', '.reset_count')
 def hipchat_reset_count(msg: CommandMessage, config: Dict) -> str:
     reset_count('hipchat')
     return 'restart counting'
 
 
 # noinspection PyUnusedLocal
-@Slack.command('.count')
+@Base.command_for('Slack', '.count')
 def slack_count(msg: CommandMessage, config: Dict) -> str:
     return str(count('slack', msg.sender, msg.text))
 
 
 # noinspection PyUnusedLocal
-@Slack.command('.reset_count')
+@Base.command_for('Slack', '.reset_count')
 def slack_reset_count(msg: CommandMessage, config: Dict) -> str:
     reset_count('slack')
     return 'restart counting'
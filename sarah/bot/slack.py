@@ -1,34 +1,101 @@
 # -*- coding: utf-8 -*-
 # https://api.slack.com/rtm
-from concurrent.futures import Future
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import json
 import logging
+import queue
+import random
+import re
+import threading
+import time
 
-from typing import Optional, Dict, Sequence
+from typing import Any, Callable, Optional, Dict, Sequence, Tuple, Union
 import requests
-from websocket import WebSocketApp
-from sarah import ValueObject
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from websocket import WebSocketApp, WebSocketConnectionClosedException
+from sarah import CompactValueObject
+from sarah.coalesce import MessageCoalescer
+from sarah.inflight import InFlightTable
 
 from sarah.exceptions import SarahException
 from sarah.bot import Base, concurrent
 from sarah.bot.values import Command, RichMessage
 from sarah.bot.types import PluginConfig
 
+# Incoming RTM events are decoded with faster backend if installed
+try:
+    # noinspection PyUnresolvedReferences
+    from orjson import loads as decode_event
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        # noinspection PyUnresolvedReferences
+        from ujson import loads as decode_event
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        decode_event = json.loads
+        JSON_BACKEND = 'json'
+
 
 class SlackClient(object):
     def __init__(self,
                  token: str,
-                 base_url: str='https://slack.com/api/') -> None:
+                 base_url: str='https://slack.com/api/',
+                 pool_size: int=10,
+                 max_retries: int=3,
+                 backoff_factor: float=0.3,
+                 timeout: Union[float, Tuple[float, float]]=(3.05, 30),
+                 max_rate_limit_retries: int=3) -> None:
         self.base_url = base_url
         self.token = token
+        # YAML gives a list for (connect timeout, read timeout) pair
+        self.timeout = tuple(timeout) if isinstance(timeout, list) \
+            else timeout
+
+        # One session with keep-alive connection pool is shared among worker
+        # threads so each Web API call does not pay for TCP and TLS
+        # handshake. urllib3's connection pool is thread-safe.
+        self.session = self.setup_session(pool_size,
+                                          max_retries,
+                                          backoff_factor)
+
+        # https://api.slack.com/docs/rate-limits
+        # Rate limits are applied per method. When one thread is told to
+        # back off, other threads calling the same method wait as well
+        # instead of piling up more rejected requests.
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.__blocked_until = {}
+        self.__blocked_lock = threading.Lock()
+
+    @staticmethod
+    def setup_session(pool_size: int,
+                      max_retries: int,
+                      backoff_factor: float) -> requests.Session:
+        # Retry on connection failure and on temporary server error.
+        # Requests that reached the server and timed out are not retried
+        # for POST, so chat.postMessage is not sent twice.
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
     def generate_endpoint(self, method: str) -> str:
         # https://api.slack.com/methods
         return self.base_url + method if self.base_url.endswith('/') else \
             self.base_url + '/' + method
 
-    def get(self, method) -> Dict:
-        return self.request('GET', method)
+    def get(self, method, params=None) -> Dict:
+        return self.request('GET', method, params)
 
     def post(self, method, params=None, data=None) -> Dict:
         return self.request('POST', method, params, data)
@@ -46,21 +113,52 @@ class SlackClient(object):
         if self.token:
             params['token'] = self.token
 
-        try:
-            response = requests.request(http_method,
-                                        endpoint,
-                                        params=params,
-                                        data=data)
-        except Exception as e:
-            logging.error(e)
-            raise e
+        for _ in range(self.max_rate_limit_retries + 1):
+            self.wait_rate_limit(method)
+
+            try:
+                response = self.session.request(http_method,
+                                                endpoint,
+                                                params=params,
+                                                data=data,
+                                                timeout=self.timeout)
+            except Exception as e:
+                logging.error(e)
+                raise e
+
+            if response.status_code != 429:
+                break
+
+            # HTTP 429 Too Many Requests with Retry-After header
+            retry_after = float(response.headers.get('Retry-After', 1))
+            logging.warning('Rate limited on %s. Retry after %s seconds.' % (
+                method, retry_after))
+            self.block(method, retry_after)
+        else:
+            raise SarahSlackRateLimited(
+                'Rate limit exceeded on %s. Gave up after %d retries.' % (
+                    method, self.max_rate_limit_retries))
 
         # Avoid "can't use a string pattern on a bytes-like object"
         # j = json.loads(response.content)
         return json.loads(response.content.decode())
 
+    def block(self, method: str, seconds: float) -> None:
+        with self.__blocked_lock:
+            until = time.monotonic() + seconds
+            if until > self.__blocked_until.get(method, 0):
+                self.__blocked_until[method] = until
+
+    def wait_rate_limit(self, method: str) -> None:
+        wait = self.__blocked_until.get(method, 0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
 
-class AttachmentField(ValueObject):
+    def close(self) -> None:
+        self.session.close()
+
+
+class AttachmentField(CompactValueObject):
     def __init__(self, title: str, value: str, short: bool=None):
         pass
 
@@ -77,7 +175,7 @@ class AttachmentField(ValueObject):
 
 
 # https://api.slack.com/docs/attachments
-class MessageAttachment(ValueObject):
+class MessageAttachment(CompactValueObject):
     def __init__(self,
                  fallback: str,
                  title: str,
@@ -145,39 +243,447 @@ class SlackMessage(RichMessage):
         return params
 
 
+class FanOutResult(CompactValueObject):
+    def __init__(self,
+                 method: str,
+                 succeeded: int,
+                 failed: int,
+                 elapsed: float) -> None:
+        pass
+
+    @property
+    def method(self) -> str:
+        return self['method']
+
+    @property
+    def succeeded(self) -> int:
+        return self['succeeded']
+
+    @property
+    def failed(self) -> int:
+        return self['failed']
+
+    @property
+    def elapsed(self) -> float:
+        return self['elapsed']
+
+
+class SlackDirectory(object):
+    # Cache of users and channels in the workspace.
+    #
+    # Each list is fetched with paginated call on first lookup, not on
+    # connection. After ttl seconds, lookups keep returning cached entries
+    # while one background thread fetches the list again. An ID missing in
+    # the cache, e.g. a user who just joined, is fetched individually and
+    # added. An ID Slack reports as not found is remembered for ttl seconds
+    # as well, so it doesn't cost a Web API call on every lookup.
+
+    # {kind: (list method, list key, info method, info key), ...}
+    METHODS = {'users': ('users.list', 'members', 'users.info', 'user'),
+               'channels': ('conversations.list', 'channels',
+                            'conversations.info', 'channel')}
+
+    def __init__(self,
+                 client: SlackClient,
+                 ttl: float=600,
+                 page_size: int=200,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.page_size = page_size
+        self.clock = clock
+
+        # {kind: {id: object, ...}, ...}
+        self.__entries = {}
+        # {(kind, id): time to look up again, ...}
+        self.__not_found = {}
+        self.__loaded_at = {}
+        self.__refreshing = set()
+        self.__lock = threading.Lock()
+        self.__load_lock = threading.Lock()
+
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_found_hits = 0
+
+    def user(self, user_id: str) -> Optional[Dict]:
+        return self.lookup('users', user_id)
+
+    def channel(self, channel_id: str) -> Optional[Dict]:
+        return self.lookup('channels', channel_id)
+
+    def user_name(self, user_id: str, default: str=None) -> Optional[str]:
+        user = self.user(user_id)
+        return user.get('name', default) if user else default
+
+    def channel_name(self,
+                     channel_id: str,
+                     default: str=None) -> Optional[str]:
+        channel = self.channel(channel_id)
+        return channel.get('name', default) if channel else default
+
+    def lookup(self, kind: str, entry_id: str) -> Optional[Dict]:
+        with self.__lock:
+            entries = self.__entries.get(kind, None)
+
+        if entries is None:
+            # First lookup. Others wait for this so the list is fetched once.
+            with self.__load_lock:
+                if kind not in self.__entries:
+                    self.refresh(kind)
+                entries = self.__entries.get(kind, {})
+        elif self.clock() - self.__loaded_at[kind] > self.ttl:
+            self.__refresh_in_background(kind)
+
+        entry = entries.get(entry_id, None)
+        with self.__lock:
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+            retry_at = self.__not_found.get((kind, entry_id), None)
+            if retry_at is not None:
+                if self.clock() < retry_at:
+                    self.not_found_hits += 1
+                    return None
+                del self.__not_found[(kind, entry_id)]
+
+            self.misses += 1
+
+        entry, answered = self.__fetch(kind, entry_id)
+        with self.__lock:
+            if entry is not None:
+                self.__entries.setdefault(kind, {})[entry_id] = entry
+            elif answered:
+                # Connection failure is not remembered, and tried again
+                self.__not_found[(kind, entry_id)] = self.clock() + self.ttl
+        return entry
+
+    def refresh(self, kind: str) -> None:
+        list_method, list_key, _, _ = self.METHODS[kind]
+        entries = {}
+        cursor = None
+        while True:
+            params = {'limit': self.page_size}
+            if cursor:
+                params['cursor'] = cursor
+
+            response = self.__request(list_method, params)
+            if response is None or not response.get('ok', False):
+                # Keep the stale ones, and try again after ttl
+                with self.__lock:
+                    self.__entries.setdefault(kind, {})
+                    self.__loaded_at[kind] = self.clock()
+                return
+
+            for entry in response.get(list_key, ()):
+                entries[entry['id']] = entry
+
+            cursor = response.get('response_metadata', {}) \
+                .get('next_cursor', None)
+            if not cursor:
+                break
+
+        with self.__lock:
+            self.__entries[kind] = entries
+            self.__loaded_at[kind] = self.clock()
+
+    def fetch_one(self, kind: str, entry_id: str) -> Optional[Dict]:
+        return self.__fetch(kind, entry_id)[0]
+
+    def metrics(self) -> Dict[str, int]:
+        with self.__lock:
+            sizes = dict((kind, len(entries))
+                         for kind, entries in self.__entries.items())
+            return {'users': sizes.get('users', 0),
+                    'channels': sizes.get('channels', 0),
+                    'not_found': len(self.__not_found),
+                    'requests': self.requests,
+                    'hits': self.hits,
+                    'not_found_hits': self.not_found_hits,
+                    'misses': self.misses}
+
+    def __fetch(self, kind: str, entry_id: str) -> Tuple[Optional[Dict], bool]:
+        # Returns the entry, and whether Slack answered the request
+        _, _, info_method, info_key = self.METHODS[kind]
+        response = self.__request(info_method, {info_key: entry_id})
+        if response is None:
+            return None, False
+        if not response.get('ok', False):
+            return None, True
+        return response.get(info_key, None), True
+
+    def __request(self, method: str, params: Dict) -> Optional[Dict]:
+        # Returns None on connection failure
+        with self.__lock:
+            self.requests += 1
+        try:
+            response = self.client.get(method, params)
+        except Exception as e:
+            logging.error('Failed to fetch %s. %s' % (method, e))
+            return None
+
+        if not response.get('ok', False):
+            logging.error('Failed to fetch %s. %s' % (
+                method, response.get('error', response)))
+
+        return response
+
+    def __refresh_in_background(self, kind: str) -> None:
+        with self.__lock:
+            if kind in self.__refreshing:
+                return
+            self.__refreshing.add(kind)
+
+        def refresh() -> None:
+            try:
+                self.refresh(kind)
+            finally:
+                with self.__lock:
+                    self.__refreshing.discard(kind)
+
+        threading.Thread(target=refresh,
+                         name='SlackDirectory-%s' % kind,
+                         daemon=True).start()
+
+
 class Slack(Base):
+    SCHEDULE_CONFIG_KEYS = ('channels',)
+
+    # https://api.slack.com/docs/rate-limits
+    # Slack allows one message per second per channel with short bursts.
+    DEFAULT_RATE_LIMIT = {'rate': 10,
+                          'burst': 20,
+                          'key_rate': 1,
+                          'key_burst': 5}
+
+    # https://api.slack.com/rtm#events
+    # {type: (name of handling method, description), ...}
+    EVENT_HANDLERS = {
+        'hello': ('handle_hello',
+                  'The client has successfully connected to the server'),
+        'message': ('handle_message',
+                    'A message was sent to a channel')}
+
+    # Events to be dropped without decoding
+    IGNORED_EVENT_TYPES = frozenset(('user_typing',
+                                     'presence_change',
+                                     'manual_presence_change',
+                                     'reconnect_url',
+                                     'pong',
+                                     'channel_marked',
+                                     'group_marked',
+                                     'im_marked',
+                                     'pref_change',
+                                     'dnd_updated_user',
+                                     'emoji_changed'))
+
+    # Reconnection on disconnect. Delay before each attempt is chosen
+    # randomly up to initial_delay * 2 ** (failed attempts), capped by
+    # max_delay, so bots dropped at once don't hit Slack at once.
+    # A ping is sent when nothing is received for ping_interval seconds, and
+    # the connection is considered dead if still nothing is received in
+    # ping_timeout seconds. max_attempts of None retries forever.
+    DEFAULT_RECONNECT = {'max_attempts': None,
+                         'initial_delay': 1,
+                         'max_delay': 60,
+                         'ping_interval': 30,
+                         'ping_timeout': 10}
+
+    # Matches the type only when it is the first property of the top level
+    # object, so type property of nested object is never taken.
+    EVENT_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([a-z_]+)"')
+
     def __init__(self,
                  token: str='',
                  plugins: Sequence[PluginConfig]=None,
-                 max_workers: int=None) -> None:
-
-        super().__init__(plugins=plugins, max_workers=max_workers)
+                 max_workers: int=None,
+                 client_config: Dict=None,
+                 context_config: Dict=None,
+                 message_worker_config: Dict=None,
+                 rate_limit_config: Dict=None,
+                 fan_out_workers: int=8,
+                 coalesce_config: Dict=None,
+                 reply_config: Dict=None,
+                 reconnect_config: Dict=None,
+                 handshake: str='rtm.start',
+                 directory_config: Dict=None,
+                 profile_config: Dict=None,
+                 metrics_config: Dict=None,
+                 timeout_config: Dict=None) -> None:
+
+        if rate_limit_config is None:
+            rate_limit_config = self.DEFAULT_RATE_LIMIT
+
+        super().__init__(plugins=plugins,
+                         max_workers=max_workers,
+                         context_config=context_config,
+                         message_worker_config=message_worker_config,
+                         rate_limit_config=rate_limit_config,
+                         profile_config=profile_config,
+                         metrics_config=metrics_config,
+                         timeout_config=timeout_config)
+
+        # e.g. {'pool_size': 10, 'max_retries': 3, 'timeout': 10}
+        if not client_config:
+            client_config = {}
+        self.client = self.setup_client(token=token, **client_config)
+
+        # rtm.start returns every user, channel and bot in the workspace
+        # along with url, which is slow to receive and decode on large
+        # workspaces. rtm.connect only returns url and a few more.
+        if handshake not in ('rtm.start', 'rtm.connect'):
+            raise ValueError('Unknown handshake method. %s' % handshake)
+        self.handshake = handshake
+
+        # e.g. {'ttl': 600, 'page_size': 200}
+        # Users and channels fetched on demand, so plugins can resolve IDs
+        # to names. See Slack.instance().
+        self.directory = SlackDirectory(self.client,
+                                        **(directory_config or {}))
 
-        self.client = self.setup_client(token=token)
         self.message_id = 0
+        self.__message_id_lock = threading.Lock()
         self.ws = None
 
-    def setup_client(self, token: str) -> SlackClient:
-        return SlackClient(token=token)
+        # e.g. {'timeout': 10, 'max_size': 1000, 'max_retries': 1}
+        # Sent messages are tracked until Slack replies with the same id.
+        # Ones without reply in timeout seconds are re-sent up to
+        # max_retries times. Retry may duplicate a message whose reply is
+        # just delayed, so it is disabled by default.
+        reply_config = dict(reply_config) if reply_config else {}
+        self.max_send_retries = reply_config.pop('max_retries', 0)
+        self.in_flight = InFlightTable(**reply_config)
+        # Retries that found their lane full
+        self.dropped_retries = 0
+
+        # {event type: count, ...} of ignored or unknown events.
+        # Only updated on the receiving thread.
+        self.dropped_events = Counter()
+
+        # Shared among all scheduled jobs so the number of simultaneous Web
+        # API calls stays bounded however many channels jobs target.
+        self.fan_out_worker = ThreadPoolExecutor(max_workers=fan_out_workers)
+
+        # e.g. {'window': 0.005, 'max_length': 4000}
+        # Text messages to the same channel within the window are merged
+        # into one before being queued. Disabled unless configured.
+        self.coalescer = None
+        if coalesce_config is not None:
+            # Handed to lanes without blocking, so one full lane doesn't
+            # stall flushes for other channels.
+            self.coalescer = MessageCoalescer(
+                partial(self.enqueue_text, block=False), **coalesce_config)
+
+        # e.g. {'max_attempts': 10, 'max_delay': 30}
+        self.reconnect_config = dict(self.DEFAULT_RECONNECT)
+        if reconnect_config:
+            self.reconnect_config.update(reconnect_config)
+
+        # Set while the websocket is open. Outbound messages wait for this
+        # in message worker, so the ones sent during an outage are kept in
+        # order and flushed after reconnecting.
+        self.connected = threading.Event()
+        self.__stopping = threading.Event()
+        self.__last_received = time.monotonic()
+        self.__disconnected_at = time.monotonic()
+        self.__connections = 0
+        self.reconnects = 0
+        self.failed_reconnects = 0
+        self.downtime = 0.0
+        self.waiting_sends = 0
+
+    def setup_client(self, token: str, **kwargs) -> SlackClient:
+        return SlackClient(token=token, **kwargs)
 
     def connect(self) -> None:
-        try:
-            response = self.client.get('rtm.start')
-        except Exception as e:
-            raise SarahSlackException(
-                "Slack request error on /rtm.start. %s" % e)
-        else:
-            if 'url' not in response:
-                raise SarahSlackException(
-                    "Slack response did not contain connecting url. %s" %
-                    response)
+        # Failure on the first connection is raised, because that is most
+        # likely a configuration problem such as invalid token.
+        url = self.fetch_ws_url()
+
+        watchdog = threading.Thread(target=self.watch_connection,
+                                    name='SlackConnectionWatchdog',
+                                    daemon=True)
+        watchdog.start()
 
-            self.ws = WebSocketApp(response['url'],
+        while url:
+            self.ws = WebSocketApp(url,
                                    on_message=self.message,
                                    on_error=self.on_error,
                                    on_open=self.on_open,
                                    on_close=self.on_close)
             self.ws.run_forever()
+            self.on_disconnect()
+
+            url = self.reconnect()
+
+    def fetch_ws_url(self) -> str:
+        try:
+            response = self.client.get(self.handshake)
+        except Exception as e:
+            raise SarahSlackException(
+                "Slack request error on /%s. %s" % (self.handshake, e))
+
+        if 'url' not in response:
+            raise SarahSlackException(
+                "Slack response did not contain connecting url. %s" %
+                response)
+
+        return response['url']
+
+    def reconnect(self) -> Optional[str]:
+        """Waits with backoff and returns new url. None is returned when
+        the bot is stopping or max_attempts is exceeded."""
+        attempt = 0
+        max_attempts = self.reconnect_config['max_attempts']
+        while max_attempts is None or attempt < max_attempts:
+            if self.__stopping.wait(self.reconnect_delay(attempt)):
+                return None
+
+            try:
+                return self.fetch_ws_url()
+            except SarahSlackException as e:
+                logging.error('Failed to reconnect. %s' % e)
+                self.failed_reconnects += 1
+                attempt += 1
+
+        logging.error('Giving up reconnecting after %d attempts.' % attempt)
+        return None
+
+    def reconnect_delay(self, attempt: int) -> float:
+        cap = min(self.reconnect_config['max_delay'],
+                  self.reconnect_config['initial_delay'] * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    def watch_connection(self) -> None:
+        # Pings an idle connection, and expires messages without reply. On
+        # its own thread, so a quiet connection is watched as well.
+        interval = self.reconnect_config['ping_interval']
+        timeout = self.reconnect_config['ping_timeout']
+        period = self.in_flight.timeout
+        if interval:
+            period = min(period, interval, timeout)
+
+        while not self.__stopping.wait(period / 2):
+            if not self.connected.is_set():
+                continue
+
+            self.check_in_flight()
+            if not interval:
+                continue
+
+            idle = time.monotonic() - self.__last_received
+            if idle > interval + timeout:
+                logging.error('No response for %.1f seconds. Reconnecting.' %
+                              idle)
+                self.ws.close()
+            elif idle > interval:
+                try:
+                    self.ws.send(json.dumps({'id': self.next_message_id(),
+                                             'type': 'ping'}))
+                except Exception as e:
+                    logging.error('Failed to send ping. %s' % e)
 
     def add_schedule_job(self, command: Command) -> None:
         if 'channels' not in command.config:
@@ -186,31 +692,91 @@ class Slack(Base):
                 'Skipping.' % command.module_name)
             return
 
+        channels = command.config['channels']
+        if isinstance(channels, str):
+            channels = (channels,)
+
         def job_function() -> None:
-            ret = command.execute()
+            ret = self.execute_schedule(command)
             if isinstance(ret, SlackMessage):
-                for channel in command.config['channels']:
-                    # TODO Error handling
-                    data = dict({'channel': channel})
-                    data.update(ret.to_request_params())
-                    self.client.post('chat.postMessage', data=data)
+                self.fan_out('chat.postMessage',
+                             channels,
+                             ret.to_request_params())
             else:
-                for channel in command.config['channels']:
-                    self.enqueue_sending_message(self.send_message,
-                                                 channel,
-                                                 str(ret))
+                for channel in channels:
+                    self.send_text(channel, str(ret))
 
-        job_id = '%s.%s' % (command.module_name, command.name)
-        logging.info("Add schedule %s" % id)
+        job_id = self.schedule_job_id(command)
+        logging.info("Add schedule %s" % job_id)
         self.scheduler.add_job(
             job_function,
             'interval',
             id=job_id,
             minutes=command.config.get('interval', 5))
 
-    @concurrent
-    def message(self, _: WebSocketApp, event: str) -> None:
-        decoded_event = json.loads(event)
+    def fan_out(self,
+                method: str,
+                channels: Sequence[str],
+                data: Dict) -> FanOutResult:
+        started = time.monotonic()
+
+        futures = []
+        for channel in channels:
+            channel_data = dict({'channel': channel})
+            channel_data.update(data)
+            # Tokens are reserved here in order, and the wait is spent on
+            # the fan-out worker, not on the calling thread.
+            delay = self.rate_limiter.reserve(channel) \
+                if self.rate_limiter else 0
+            futures.append((channel, self.fan_out_worker.submit(
+                self.delayed_post, delay, method, channel_data)))
+
+        succeeded = 0
+        failed = 0
+        for channel, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                failed += 1
+                logging.error('Failed to call %s for %s. %s' % (
+                    method, channel, e))
+                continue
+
+            if response.get('ok', False):
+                succeeded += 1
+            else:
+                failed += 1
+                logging.error('Failed to call %s for %s. error: %s' % (
+                    method, channel, response.get('error', 'unknown')))
+
+        result = FanOutResult(method=method,
+                              succeeded=succeeded,
+                              failed=failed,
+                              elapsed=time.monotonic() - started)
+        logging.info('Fan-out %s to %d channels in %.3f seconds. '
+                     'succeeded: %d. failed: %d.' % (
+                         method, len(futures), result.elapsed,
+                         result.succeeded, result.failed))
+        return result
+
+    def delayed_post(self, delay: float, method: str, data: Dict) -> Dict:
+        if delay > 0:
+            time.sleep(delay)
+        return self.client.post(method, data=data)
+
+    def message(self, _: WebSocketApp, event: str) -> Optional[Future]:
+        # Decoded on the receiving thread so the event can be routed to a
+        # worker by its sender. See handle_message().
+        self.__last_received = time.monotonic()
+
+        # Most frames are events we don't handle, e.g. user_typing. Peek the
+        # type, which Slack puts first, to drop them before decoding.
+        peeked = self.EVENT_TYPE_PATTERN.match(event)
+        if peeked and peeked.group(1) in self.IGNORED_EVENT_TYPES:
+            self.dropped_events[peeked.group(1)] += 1
+            return
+
+        decoded_event = decode_event(event)
 
         if 'ok' in decoded_event and 'reply_to' in decoded_event:
             # https://api.slack.com/rtm#sending_messages
@@ -218,24 +784,18 @@ class Slack(Base):
             # properties: a boolean ok indicating whether they succeeded and
             # an integer reply_to indicating which message they are in response
             # to.
-            if decoded_event['ok'] is False:
+            ok = decoded_event['ok'] is not False
+            sent = self.in_flight.ack(decoded_event['reply_to'], ok)
+            if not ok:
                 # Something went wrong with the previous message
                 logging.error(
                     'Something went wrong with the previous message. '
-                    'message_id: %d. error: %s' % (decoded_event['reply_to'],
-                                                   decoded_event['error']))
+                    'message_id: %d. error: %s. sent: %s' % (
+                        decoded_event['reply_to'],
+                        decoded_event['error'],
+                        sent[0] if sent else None))
             return
 
-        # TODO organize
-        type_map = {
-            'hello': {'method': self.handle_hello,
-                      'description': 'The client has successfully connected '
-                                     'to the server'},
-            'message': {'method': self.handle_message,
-                        'description': 'A message was sent to a channel'},
-            'user_typing': {'description': 'A channel member is typing a '
-                                           'message'}}
-
         if 'type' not in decoded_event:
             # https://api.slack.com/rtm#events
             # Every event has a type property which describes the type of
@@ -244,24 +804,28 @@ class Slack(Base):
                           event)
             return
 
-        if decoded_event['type'] not in type_map:
+        event_type = decoded_event['type']
+        if event_type in self.IGNORED_EVENT_TYPES:
+            # Type was not the first property
+            self.dropped_events[event_type] += 1
+            return
+
+        handler = self.EVENT_HANDLERS.get(event_type, None)
+        if handler is None:
+            self.dropped_events[event_type] += 1
             logging.error('Unknown type value is given. %s' % event)
             return
 
-        logging.debug(
-            '%s: %s. %s' % (
-                decoded_event['type'],
-                type_map[decoded_event['type']].get('description',
-                                                    'NO DESCRIPTION'),
-                event))
+        logging.debug('%s: %s. %s' % (event_type, handler[1], event))
 
-        if 'method' in type_map[decoded_event['type']]:
-            type_map[decoded_event['type']]['method'](decoded_event)
-            return
+        return getattr(self, handler[0])(decoded_event)
 
     def handle_hello(self, _: Dict) -> None:
         logging.info('Successfully connected to the server.')
 
+    # Messages from the same user are handled one at a time and in order, so
+    # the user's conversation proceeds as the user typed.
+    @concurrent(key=lambda content: content.get('user', None))
     def handle_message(self, content: Dict) -> Optional[Future]:
         # content
         # {
@@ -284,45 +848,171 @@ class Slack(Base):
         ret = self.respond(content['user'], content['text'])
         if isinstance(ret, SlackMessage):
             # TODO Error handling
-            data = dict({'channel': content["channel"]})
+            # Queued like text replies, so waiting for rate limit token
+            # doesn't hold this thread.
+            channel = content['channel']
+            data = dict({'channel': channel})
             data.update(ret.to_request_params())
-            self.client.post('chat.postMessage', data=data)
+            if self.coalescer:
+                # Sent after text replies to the channel still being merged
+                return self.coalescer.pass_through(
+                    channel,
+                    self.enqueue_sending_message,
+                    self.client.post,
+                    'chat.postMessage',
+                    data=data,
+                    destination=channel,
+                    block=False)
+            return self.enqueue_sending_message(self.client.post,
+                                                'chat.postMessage',
+                                                data=data,
+                                                destination=channel)
         elif isinstance(ret, str):
-            return self.enqueue_sending_message(self.send_message,
-                                                content['channel'],
-                                                ret)
+            return self.send_text(content['channel'], ret)
 
     def on_error(self, _: WebSocketApp, error) -> None:
         logging.error(error)
 
     def on_open(self, _: WebSocketApp) -> None:
         logging.info('connected')
-
-    def on_close(self, _: WebSocketApp) -> None:
+        self.__last_received = time.monotonic()
+        if self.__connections:
+            self.reconnects += 1
+            self.downtime += time.monotonic() - self.__disconnected_at
+        self.__connections += 1
+        self.connected.set()
+
+    def on_close(self, _: WebSocketApp, *args) -> None:
         logging.info('closed')
 
+    def on_disconnect(self) -> None:
+        if self.connected.is_set():
+            self.__disconnected_at = time.monotonic()
+            self.connected.clear()
+
+    def send_text(self, channel: str, text: str) -> Future:
+        if self.coalescer:
+            return self.coalescer.add(channel, text)
+        return self.enqueue_text(channel, text)
+
+    def enqueue_text(self,
+                     channel: str,
+                     text: str,
+                     block: bool=True) -> Future:
+        return self.enqueue_sending_message(self.send_message,
+                                            channel,
+                                            text,
+                                            destination=channel,
+                                            block=block)
+
     def send_message(self,
                      channel: str,
                      text: str,
-                     message_type: str='message') -> None:
-        params = {'channel': channel,
-                  'text': text,
-                  'type': message_type,
-                  'id': self.next_message_id()}
-        self.ws.send(json.dumps(params))
+                     message_type: str='message',
+                     attempts: int=1) -> None:
+        while True:
+            self.wait_for_connection()
+            params = {'channel': channel,
+                      'text': text,
+                      'type': message_type,
+                      'id': self.next_message_id()}
+            self.in_flight.add(params['id'], params, attempts)
+            try:
+                self.ws.send(json.dumps(params))
+                return
+            except WebSocketConnectionClosedException:
+                # Disconnected but not noticed yet. Send again after
+                # reconnecting.
+                self.in_flight.discard(params['id'])
+                self.on_disconnect()
+
+    def wait_for_connection(self) -> None:
+        if self.connected.is_set():
+            return
+
+        self.waiting_sends += 1
+        try:
+            while not self.connected.wait(1):
+                if self.__stopping.is_set():
+                    raise SarahSlackException('Connection is closed.')
+        finally:
+            self.waiting_sends -= 1
 
     def next_message_id(self) -> int:
         # https://api.slack.com/rtm#sending_messages
         # Every event should have a unique (for that connection) positive
         # integer ID. All replies to that message will include this ID.
-        self.message_id += 1
-        return self.message_id
+        # Messages are sent from multiple lanes of message worker.
+        with self.__message_id_lock:
+            self.message_id += 1
+            return self.message_id
+
+    def check_in_flight(self) -> None:
+        for params, attempts in self.in_flight.expire():
+            if attempts > self.max_send_retries:
+                logging.error('No reply for message_id %d. Giving up. %s' % (
+                    params['id'], params))
+                continue
+
+            logging.warning('No reply for message_id %d. Retrying.' %
+                            params['id'])
+            # Called from the watchdog, which must not wait for a full lane
+            try:
+                self.enqueue_sending_message(self.send_message,
+                                             params['channel'],
+                                             params['text'],
+                                             params['type'],
+                                             attempts=attempts + 1,
+                                             destination=params['channel'],
+                                             block=False)
+            except queue.Full:
+                self.dropped_retries += 1
+                logging.error('Message worker is full. Dropped retry of '
+                              'message_id %d.' % params['id'])
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics.update({'connection': self.connection_metrics(),
+                        'directory': self.directory.metrics(),
+                        'replies': dict(self.in_flight.metrics(),
+                                        dropped_retries=self.dropped_retries),
+                        'dropped_events': dict(self.dropped_events),
+                        'coalesce': self.coalescer.metrics()
+                        if self.coalescer else None})
+        return metrics
+
+    def connection_metrics(self) -> Dict[str, Any]:
+        connected = self.connected.is_set()
+        current_downtime = 0.0
+        if self.__connections and not connected:
+            current_downtime = time.monotonic() - self.__disconnected_at
+        return {'connected': connected,
+                'reconnects': self.reconnects,
+                'failed_reconnects': self.failed_reconnects,
+                'downtime': self.downtime + current_downtime,
+                'current_downtime': current_downtime,
+                'waiting_sends': self.waiting_sends}
 
     def stop(self) -> None:
+        # Tell connect() not to reconnect
+        self.__stopping.set()
+
+        if self.coalescer:
+            # Send merged messages before message worker stops
+            logging.info('STOP MESSAGE COALESCER')
+            self.coalescer.close()
+
         super().stop()
         logging.info('STOP SLACK INTEGRATION')
-        self.ws.close()
+        if self.ws:
+            self.ws.close()
+        self.fan_out_worker.shutdown(wait=False)
+        self.client.close()
 
 
 class SarahSlackException(SarahException):
     pass
+
+
+class SarahSlackRateLimited(SarahSlackException):
+    pass
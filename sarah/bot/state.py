@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import threading
+
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional
+
+
+class StripedLock(object):
+    # Fixed set of locks shared by any number of keys.
+    #
+    # Each key is mapped to one of the locks by its hash, so operations on the
+    # same key are always serialized while operations on different keys
+    # rarely wait for each other. Unlike one lock per key, memory does not
+    # grow with the number of keys and no lock ever has to be removed.
+
+    def __init__(self, stripes: int=64) -> None:
+        if stripes < 1:
+            raise ValueError('stripes must be positive. %s' % stripes)
+
+        self.__locks = tuple(threading.RLock() for _ in range(stripes))
+
+    @property
+    def stripes(self) -> int:
+        return len(self.__locks)
+
+    def __call__(self, key: Hashable) -> threading.RLock:
+        return self.__locks[hash(key) % len(self.__locks)]
+
+    @contextmanager
+    def all(self) -> Iterator[None]:
+        """Holds every stripe. Locks are always taken in the same order, so
+        two callers of this never deadlock each other."""
+        acquired = []
+        try:
+            for lock in self.__locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+
+class UserStore(object):
+    # Per-user key/value store for plugins, safe to use from concurrent
+    # workers.
+    #
+    #   counts = UserStore()
+    #
+    #   @Slack.command('.count')
+    #   def count(msg, config):
+    #       return str(counts.update(msg.sender, msg.text,
+    #                                lambda cnt: cnt + 1, 0))
+    #
+    # Values are kept in a plain dictionary, {user_key: {key: value}}, and
+    # each user's dictionary is only touched while holding the user's lock
+    # of StripedLock. The dictionary may be given to share existing state.
+
+    def __init__(self,
+                 data: Optional[Dict[Hashable, Dict[Hashable, Any]]]=None,
+                 stripes: int=64) -> None:
+        self.__data = data if data is not None else {}
+        self.__lock = StripedLock(stripes)
+
+    def get(self, user_key: Hashable, key: Hashable, default: Any=None) -> Any:
+        with self.__lock(user_key):
+            return self.__data.get(user_key, {}).get(key, default)
+
+    def set(self, user_key: Hashable, key: Hashable, value: Any) -> None:
+        with self.__lock(user_key):
+            self.__data.setdefault(user_key, {})[key] = value
+
+    def update(self,
+               user_key: Hashable,
+               key: Hashable,
+               function: Callable[[Any], Any],
+               default: Any=None) -> Any:
+        """Replaces the value with function(current value) atomically, and
+        returns the new value."""
+        with self.__lock(user_key):
+            values = self.__data.setdefault(user_key, {})
+            value = function(values.get(key, default))
+            values[key] = value
+            return value
+
+    def pop(self, user_key: Hashable, key: Hashable, default: Any=None) -> Any:
+        with self.__lock(user_key):
+            values = self.__data.get(user_key, None)
+            if values is None:
+                return default
+
+            value = values.pop(key, default)
+            if not values:
+                del self.__data[user_key]
+            return value
+
+    def items(self, user_key: Hashable) -> Dict[Hashable, Any]:
+        """Returns a copy of the user's values."""
+        with self.__lock(user_key):
+            return dict(self.__data.get(user_key, {}))
+
+    def clear(self, user_key: Optional[Hashable]=None) -> None:
+        if user_key is not None:
+            with self.__lock(user_key):
+                self.__data.pop(user_key, None)
+            return
+
+        # Other users' updates may be adding keys meanwhile, so wait for all of
+        # them. The dictionary itself is kept as it may be shared.
+        with self.__lock.all():
+            self.__data.clear()
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def __contains__(self, user_key: Hashable) -> bool:
+        return user_key in self.__data
@@ -2,7 +2,7 @@
 import abc
 import re
 from typing import Union, Pattern, AnyStr, Callable, Sequence
-from sarah import ValueObject
+from sarah import ValueObject, CompactValueObject
 from sarah.bot.types import CommandFunction, CommandConfig
 
 
@@ -12,7 +12,7 @@ class RichMessage(ValueObject, metaclass=abc.ABCMeta):
         pass
 
 
-class InputOption(ValueObject):
+class InputOption(CompactValueObject):
     def __init__(self,
                  pattern: Union[Pattern, AnyStr],
                  next_step: Callable) -> None:
@@ -56,8 +56,19 @@ class UserContext(ValueObject):
 
 
 class CommandMessage(ValueObject):
-    def __init__(self, original_text: str, text: str, sender: str):
-        pass
+    # Whitespace separated tokens. Quoted strings are taken as one token.
+    ARGUMENT_PATTERN = re.compile(r'"([^"]*)"|\'([^\']*)\'|(\S+)')
+
+    def __init__(self,
+                 original_text: str,
+                 text: str,
+                 sender: str,
+                 arguments: Sequence[str]=None):
+        # Parse once here so each plugin doesn't have to parse text again.
+        if arguments is None:
+            self['arguments'] = tuple(
+                ''.join(groups)
+                for groups in self.ARGUMENT_PATTERN.findall(text))
 
     @property
     def original_text(self):
@@ -71,6 +82,10 @@ class CommandMessage(ValueObject):
     def sender(self):
         return self['sender']
 
+    @property
+    def arguments(self) -> Sequence[str]:
+        return self['arguments']
+
 
 class Command(ValueObject):
     def __init__(self,
@@ -100,3 +115,35 @@ class Command(ValueObject):
         args = list(args)
         args.append(self.config)
         return self.function(*args)
+
+
+class Dispatch(CompactValueObject):
+    # What Base.resolve() decided to run for the given input. Either
+    # a command or the next step of ongoing conversation.
+    def __init__(self,
+                 name: str,
+                 function: Callable,
+                 message: CommandMessage,
+                 config: CommandConfig,
+                 in_conversation: bool) -> None:
+        pass
+
+    @property
+    def name(self) -> str:
+        return self['name']
+
+    @property
+    def function(self) -> Callable:
+        return self['function']
+
+    @property
+    def message(self) -> CommandMessage:
+        return self['message']
+
+    @property
+    def config(self) -> CommandConfig:
+        return self['config']
+
+    @property
+    def in_conversation(self) -> bool:
+        return self['in_conversation']
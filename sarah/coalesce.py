@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable, List
+
+
+class _Batch(object):
+    __slots__ = ('key', 'deadline', 'texts', 'futures', 'length', 'call')
+
+    def __init__(self, key: Hashable, deadline: float, call=None) -> None:
+        self.key = key
+        self.deadline = deadline
+        self.texts = []
+        self.futures = []
+        self.length = 0
+        # (function, args, kwargs) of a message that is not merged
+        self.call = call
+
+
+class MessageCoalescer(object):
+    # Merges text messages to the same destination that come within a short
+    # window, so a burst of replies costs one outbound message and one token
+    # of rate limit.
+    #
+    # The first message to a destination opens a batch, and following ones
+    # are appended until the window passes or the merged text would exceed
+    # max_length. Then the batch is closed and the next message opens a new
+    # one. Closed batches are handed to send() by a single thread in the
+    # order they are closed, so messages to one destination keep their
+    # order. Each add() returns a future that is resolved with the result of
+    # the merged send.
+    #
+    # Messages that can't be merged, e.g. ones with attachments, are given
+    # to pass_through() to keep their place among the text ones. send() and
+    # passed functions run on the single thread, so they must not block; a
+    # failed one is counted and its futures get the exception.
+
+    def __init__(self,
+                 send: Callable[[Hashable, str], Any],
+                 window: float=0.005,
+                 max_length: int=4000,
+                 separator: str='\n',
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if window < 0:
+            raise ValueError('window must not be negative. %s' % window)
+
+        self.send = send
+        self.window = window
+        self.max_length = max_length
+        self.separator = separator
+        self.clock = clock
+
+        self.messages = 0
+        self.batches = 0
+        self.passed = 0
+        self.failed = 0
+
+        # {key: _Batch, ...} in the order of opening, so the head is always
+        # the first one to expire.
+        self.__open = OrderedDict()
+        self.__closed = deque()
+        self.__condition = threading.Condition()
+        self.__stopped = False
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='MessageCoalescer',
+                                         daemon=True)
+        self.__thread.start()
+
+    def add(self, key: Hashable, text: str) -> Future:
+        future = Future()
+        with self.__condition:
+            if self.__stopped:
+                raise RuntimeError('cannot add messages after close')
+
+            batch = self.__open.get(key, None)
+            if batch and batch.length + len(self.separator) + len(text) \
+                    > self.max_length:
+                self.__closed.append(self.__open.pop(key))
+                self.__condition.notify()
+                batch = None
+
+            if batch is None:
+                batch = _Batch(key, self.clock() + self.window)
+                self.__open[key] = batch
+                self.__condition.notify()
+            else:
+                batch.length += len(self.separator)
+
+            batch.texts.append(text)
+            batch.futures.append(future)
+            batch.length += len(text)
+            self.messages += 1
+
+        return future
+
+    def pass_through(self, key: Hashable, function: Callable, *args,
+                     **kwargs) -> Future:
+        """Calls function on the sending thread after the key's pending
+        messages are sent, without merging."""
+        future = Future()
+        with self.__condition:
+            if self.__stopped:
+                raise RuntimeError('cannot add messages after close')
+
+            batch = self.__open.pop(key, None)
+            if batch is not None:
+                self.__closed.append(batch)
+
+            passed = _Batch(key, 0, (function, args, kwargs))
+            passed.futures.append(future)
+            self.__closed.append(passed)
+            self.__condition.notify()
+
+        return future
+
+    def metrics(self) -> Dict[str, int]:
+        with self.__condition:
+            pending = sum(len(b.texts) for b in self.__open.values()) + \
+                sum(len(b.texts) for b in self.__closed)
+        return {'messages': self.messages,
+                'batches': self.batches,
+                'merged': self.messages - self.batches - pending,
+                'pending': pending,
+                'passed': self.passed,
+                'failed': self.failed}
+
+    def close(self) -> None:
+        """Sends all pending messages, and stops the sending thread."""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                batches = self.__take_due()
+                while not batches and not self.__stopped:
+                    self.__condition.wait(self.__timeout())
+                    batches = self.__take_due()
+
+                if self.__stopped:
+                    batches.extend(self.__open.values())
+                    self.__open.clear()
+
+            for batch in batches:
+                self.__send(batch)
+
+            if self.__stopped and not batches:
+                return
+
+    def __take_due(self) -> List[_Batch]:
+        now = self.clock()
+        while self.__open:
+            key, batch = next(iter(self.__open.items()))
+            if batch.deadline > now:
+                break
+            self.__closed.append(self.__open.pop(key))
+
+        batches = list(self.__closed)
+        self.__closed.clear()
+        return batches
+
+    def __timeout(self):
+        if not self.__open:
+            return None
+        batch = next(iter(self.__open.values()))
+        return max(0, batch.deadline - self.clock())
+
+    def __send(self, batch: _Batch) -> None:
+        try:
+            if batch.call is not None:
+                self.passed += 1
+                function, args, kwargs = batch.call
+                ret = function(*args, **kwargs)
+            else:
+                self.batches += 1
+                if len(batch.texts) > 1:
+                    logging.debug('Merged %d messages to %s' % (
+                        len(batch.texts), batch.key))
+                ret = self.send(batch.key, self.separator.join(batch.texts))
+        except Exception as e:
+            self.failed += len(batch.futures)
+            logging.error('Failed to send to %s. %r' % (batch.key, e))
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+
+        if not isinstance(ret, Future):
+            for future in batch.futures:
+                future.set_result(ret)
+            return
+
+        def resolve(f: Future) -> None:
+            for future in batch.futures:
+                if f.cancelled():
+                    future.cancel()
+                elif f.exception():
+                    future.set_exception(f.exception())
+                else:
+                    future.set_result(f.result())
+
+        ret.add_done_callback(resolve)
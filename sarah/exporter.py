@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import re
+from socketserver import ThreadingMixIn
+import threading
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Names of dictionaries in metrics whose keys are values rather than names,
+# such as destinations or command names. Their keys become the given label
+# so the number of metric names stays fixed. Indexes of a listed list become
+# the label as well, in place of "index".
+LABELED = {'queue_depths': 'destination',
+           'lane_depths': 'lane',
+           'profile': 'name',
+           'dropped_events': 'type',
+           'by_command': 'name',
+           'cache': 'name'}
+
+INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def render(metrics: Dict[str, Any],
+           prefix: str='sarah',
+           labels: Dict[str, str]=None) -> str:
+    """Renders nested metrics such as Base.metrics() in Prometheus text
+    exposition format.
+
+    Numbers and booleans are exposed as untyped samples named after their
+    path, and Histogram snapshots as histograms. Strings and None are
+    skipped."""
+    # {name: (type, [sample line, ...]), ...}
+    families = {}
+    _walk(families, prefix, metrics, tuple(sorted((labels or {}).items())))
+
+    lines = []
+    for name, (metric_type, samples) in sorted(families.items()):
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _walk(families: Dict[str, Tuple[str, List[str]]],
+          name: str,
+          value: Any,
+          labels: Tuple[Tuple[str, str], ...],
+          label_name: Optional[str]=None) -> None:
+    if isinstance(value, bool):
+        _add(families, name, 'untyped', name, labels, int(value))
+
+    elif isinstance(value, (int, float)):
+        _add(families, name, 'untyped', name, labels, value)
+
+    elif isinstance(value, dict):
+        if 'buckets' in value and 'count' in value and 'sum' in value:
+            _add_histogram(families, name, value, labels)
+            return
+
+        for key, child in value.items():
+            if label_name:
+                _walk(families,
+                      name,
+                      child,
+                      labels + ((label_name, str(key)),))
+            else:
+                child_name = INVALID_NAME_CHARS.sub('_', str(key))
+                _walk(families,
+                      '%s_%s' % (name, child_name),
+                      child,
+                      labels,
+                      LABELED.get(key, None))
+
+    elif isinstance(value, (list, tuple)):
+        for i, child in enumerate(value):
+            if isinstance(child, (int, float)):
+                _walk(families,
+                      name,
+                      child,
+                      labels + ((label_name or 'index', str(i)),))
+
+
+def _add_histogram(families: Dict[str, Tuple[str, List[str]]],
+                   name: str,
+                   snapshot: Dict[str, Any],
+                   labels: Tuple[Tuple[str, str], ...]) -> None:
+    for bound, count in snapshot['buckets']:
+        le = '+Inf' if bound == float('inf') else repr(float(bound))
+        _add(families,
+             name,
+             'histogram',
+             name + '_bucket',
+             labels + (('le', le),),
+             count)
+    _add(families, name, 'histogram', name + '_sum', labels, snapshot['sum'])
+    _add(families, name, 'histogram', name + '_count', labels,
+         snapshot['count'])
+
+
+def _add(families: Dict[str, Tuple[str, List[str]]],
+         family: str,
+         metric_type: str,
+         name: str,
+         labels: Tuple[Tuple[str, str], ...],
+         value: float) -> None:
+    samples = families.setdefault(family, (metric_type, []))[1]
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                                  for k, v in labels)
+    samples.append('%s %s' % (name, repr(value)))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsExporter(object):
+    # Serves metrics of the process at http://host:port/metrics.
+    #
+    # Metrics are collected only when scraped, so the message path pays for
+    # counting alone. Each bot runs in its own process, so each one is given
+    # its own port.
+
+    def __init__(self,
+                 collect: Callable[[], Dict[str, Any]],
+                 host: str='127.0.0.1',
+                 port: int=9100,
+                 prefix: str='sarah',
+                 labels: Dict[str, str]=None) -> None:
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.labels = labels if labels else {}
+        self.scrapes = 0
+        self.scrape_errors = 0
+
+        self.__server = None
+        self.__thread = None
+
+    def start(self) -> None:
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                try:
+                    body = exporter.render().encode('utf-8')
+                except Exception as e:
+                    logging.error('Failed to collect metrics. %s' % e)
+                    exporter.scrape_errors += 1
+                    self.send_error(500)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Don't log every scrape
+                pass
+
+        self.__server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        # Port 0 picks a free one
+        self.port = self.__server.server_address[1]
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         name='MetricsExporter',
+                                         daemon=True)
+        self.__thread.start()
+        logging.info('Serving metrics on http://%s:%d/metrics' % (self.host,
+                                                                  self.port))
+
+    def render(self) -> str:
+        self.scrapes += 1
+        return render(self.collect(), self.prefix, self.labels)
+
+    def stop(self) -> None:
+        if self.__server is None:
+            return
+
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+        self.__server = None
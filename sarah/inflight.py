@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from sarah.metrics import Histogram
+
+
+class InFlightTable(object):
+    # Sent messages waiting for acknowledgement, keyed by message id.
+    #
+    # Entries are kept in the order of sending, so the oldest one is always
+    # at the head. Timed out entries are found by looking at the head alone,
+    # and the oldest one is dropped when max_size is reached, so memory
+    # stays bounded even if acknowledgements never come.
+
+    def __init__(self,
+                 max_size: int=1000,
+                 timeout: float=10,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if max_size < 1:
+            raise ValueError('max_size must be positive. %s' % max_size)
+
+        self.max_size = max_size
+        self.timeout = timeout
+        self.clock = clock
+        self.latency = Histogram()
+
+        self.sent = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.evicted = 0
+        self.unknown = 0
+
+        # {message_id: (sent time, payload, attempts), ...}
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add(self, message_id: Hashable, payload: Any, attempts: int=1) -> None:
+        with self.__lock:
+            self.__entries[message_id] = (self.clock(), payload, attempts)
+            self.sent += 1
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evicted += 1
+
+    def ack(self, message_id: Hashable, ok: bool=True) \
+            -> Optional[Tuple[Any, int]]:
+        """Removes the entry, and returns its payload and attempts."""
+        with self.__lock:
+            entry = self.__entries.pop(message_id, None)
+            if entry is None:
+                # Already timed out or evicted
+                self.unknown += 1
+                return None
+
+            if ok:
+                self.acknowledged += 1
+            else:
+                self.failed += 1
+
+        self.latency.observe(self.clock() - entry[0])
+        return entry[1], entry[2]
+
+    def discard(self, message_id: Hashable) -> None:
+        """Removes the entry without counting, e.g. when sending failed."""
+        with self.__lock:
+            if self.__entries.pop(message_id, None) is not None:
+                self.sent -= 1
+
+    def expire(self) -> List[Tuple[Any, int]]:
+        """Removes timed out entries, and returns their payloads and
+        attempts."""
+        expired = []
+        with self.__lock:
+            deadline = self.clock() - self.timeout
+            while self.__entries:
+                message_id, entry = next(iter(self.__entries.items()))
+                if entry[0] > deadline:
+                    break
+
+                del self.__entries[message_id]
+                expired.append((entry[1], entry[2]))
+
+            self.timed_out += len(expired)
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'in_flight': len(self.__entries),
+                'max_size': self.max_size,
+                'sent': self.sent,
+                'acknowledged': self.acknowledged,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'evicted': self.evicted,
+                'unknown': self.unknown,
+                'latency_p50': self.latency.percentile(50),
+                'latency_p99': self.latency.percentile(99),
+                'latency': self.latency.snapshot()}
@@ -1,36 +1,45 @@
 # -*- coding: utf-8 -*-
 
+import importlib
 import logging
 from multiprocessing import Process
 import os
+import time
 
 from typing import Dict, Sequence
 import yaml
 
-from sarah.bot.hipchat import HipChat
-from sarah.bot.slack import Slack
 from sarah.exceptions import SarahException
 from sarah.bot.types import Path
 
 
 class Sarah(object):
+    # (configuration key, module, class name)
+    # Adapters are imported only when configured, so a process running Slack
+    # alone doesn't pay for importing sleekxmpp and vice versa.
+    ADAPTERS = (('hipchat', 'sarah.bot.hipchat', 'HipChat'),
+                ('slack', 'sarah.bot.slack', 'Slack'))
+
     def __init__(self,
                  config_paths: Sequence[Path]) -> None:
 
         self.config = self.load_config(config_paths)
 
     def start(self) -> None:
-        if 'hipchat' in self.config:
-            logging.info('Start HipChat integration')
-            hipchat = HipChat(**self.config['hipchat'])
-            hipchat_process = Process(target=hipchat.run)
-            hipchat_process.start()
-
-        if 'slack' in self.config:
-            logging.info('Start Slack integration')
-            slack = Slack(**self.config['slack'])
-            slack_process = Process(target=slack.run)
-            slack_process.start()
+        for key, module_name, class_name in self.ADAPTERS:
+            if key not in self.config:
+                continue
+
+            logging.info('Start %s integration' % class_name)
+            started = time.monotonic()
+            adapter = getattr(importlib.import_module(module_name),
+                              class_name)
+            logging.info('Imported %s in %.3f seconds' % (
+                class_name, time.monotonic() - started))
+
+            bot = adapter(**self.config[key])
+            process = Process(target=bot.run)
+            process.start()
 
     @staticmethod
     def load_config(paths: Sequence[Path]) -> Dict:
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+import threading
+
+from typing import Any, Dict, List, Optional, Sequence
+
+# Upper bounds in seconds. Covers both local processing and network round
+# trip.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    # Monotonically increasing counter cheap enough for the message path.
+    #
+    # A plain attribute incremented without a lock. "+=" is not atomic, so
+    # an increment racing with another thread can in theory be lost, but
+    # the GIL rarely switches in between and an occasional miss doesn't
+    # matter to a metric. A lock would cost about six times as much.
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self) -> None:
+        self.value += 1
+
+
+class Histogram(object):
+    # Cumulative histogram with fixed buckets.
+    # Memory stays the same however many values are observed, and
+    # percentiles are estimated by the upper bound of the bucket they fall
+    # into.
+
+    def __init__(self, buckets: Sequence[float]=DEFAULT_BUCKETS) -> None:
+        if list(buckets) != sorted(buckets):
+            raise ValueError('buckets must be sorted. %s' % (buckets,))
+
+        self.buckets = tuple(buckets)
+        # Last one is for values larger than any bucket
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+        self.__max = None
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.__lock:
+            self.__counts[bisect_left(self.buckets, value)] += 1
+            self.__sum += value
+            if self.__max is None or value > self.__max:
+                self.__max = value
+
+    @property
+    def count(self) -> int:
+        return sum(self.__counts)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self.__lock:
+            counts = list(self.__counts)
+            max_value = self.__max
+
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = total * p / 100
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, max_value)
+        return max_value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            counts = list(self.__counts)
+            total_sum = self.__sum
+            max_value = self.__max
+
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        return {'count': cumulative,
+                'sum': total_sum,
+                'max': max_value,
+                'buckets': buckets}
+
+
+class RollingWindow(object):
+    # Keeps the latest size values in a ring buffer, so percentiles reflect
+    # recent behavior and memory stays fixed.
+
+    def __init__(self, size: int=1024) -> None:
+        if size < 1:
+            raise ValueError('size must be positive. %s' % size)
+
+        self.size = size
+        self.__values = []
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.__lock:
+            if len(self.__values) < self.size:
+                self.__values.append(value)
+            else:
+                self.__values[self.__next] = value
+            self.__next = (self.__next + 1) % self.size
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def percentiles(self, *ps: float) -> List[Optional[float]]:
+        with self.__lock:
+            values = sorted(self.__values)
+
+        if not values:
+            return [None for _ in ps]
+
+        return [values[min(len(values) - 1, int(len(values) * p / 100))]
+                for p in ps]
+
+    def percentile(self, p: float) -> Optional[float]:
+        return self.percentiles(p)[0]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sarah.metrics import RollingWindow
+
+# Called after each profiled call with
+# (kind, name, wall seconds, cpu seconds, exception or None)
+ProfileHook = Callable[[str, str, float, float, Optional[BaseException]], Any]
+
+
+class CallStats(object):
+    # Aggregated timing of one name, e.g. one command.
+
+    def __init__(self, kind: str, name: str, window: int) -> None:
+        self.kind = kind
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.last_error = None
+        self.wall_total = 0.0
+        self.cpu_total = 0.0
+        self.wall = RollingWindow(window)
+        self.cpu = RollingWindow(window)
+        self.profile = None
+        self.profiled_calls = 0
+        self.lock = threading.Lock()
+
+    def summary(self) -> Dict[str, Any]:
+        wall_p50, wall_p99 = self.wall.percentiles(50, 99)
+        cpu_p50, cpu_p99 = self.cpu.percentiles(50, 99)
+        return {'kind': self.kind,
+                'calls': self.calls,
+                'errors': self.errors,
+                'last_error': repr(self.last_error)
+                if self.last_error else None,
+                'wall_total': self.wall_total,
+                'cpu_total': self.cpu_total,
+                'wall_p50': wall_p50,
+                'wall_p99': wall_p99,
+                'cpu_p50': cpu_p50,
+                'cpu_p99': cpu_p99,
+                'profiled_calls': self.profiled_calls}
+
+
+class Profiler(object):
+    # Records wall time, CPU time and exceptions of calls by kind and name.
+    #
+    # Percentiles are computed over the latest window calls of each name.
+    # When sample_every is N, every Nth call of each name runs under
+    # cProfile and the result is accumulated, so the slow part of a
+    # command can be found without profiling every call.
+    # CPU time is of the calling thread, so time spent waiting for I/O only
+    # shows in wall time.
+
+    def __init__(self,
+                 window: int=1024,
+                 sample_every: int=0,
+                 hooks: Tuple[ProfileHook, ...]=()) -> None:
+        self.window = window
+        self.sample_every = sample_every
+        self.hooks = list(hooks)
+
+        # {(kind, name): CallStats, ...}
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def add_hook(self, hook: ProfileHook) -> None:
+        self.hooks.append(hook)
+
+    def call(self,
+             kind: str,
+             name: str,
+             function: Callable,
+             *args,
+             **kwargs) -> Any:
+        stats = self.stats_of(kind, name)
+        with stats.lock:
+            stats.calls += 1
+            sampled = self.sample_every > 0 \
+                and stats.calls % self.sample_every == 0
+
+        profile = cProfile.Profile() if sampled else None
+        error = None
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            if profile:
+                return profile.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            wall = time.perf_counter() - wall_started
+            cpu = time.thread_time() - cpu_started
+            self.record(stats, wall, cpu, error, profile)
+
+    def record(self,
+               stats: CallStats,
+               wall: float,
+               cpu: float,
+               error: Optional[BaseException],
+               profile: Optional[cProfile.Profile]) -> None:
+        stats.wall.observe(wall)
+        stats.cpu.observe(cpu)
+        with stats.lock:
+            stats.wall_total += wall
+            stats.cpu_total += cpu
+            if error is not None:
+                stats.errors += 1
+                stats.last_error = error
+            if profile is not None:
+                stats.profiled_calls += 1
+                if stats.profile is None:
+                    stats.profile = pstats.Stats(profile)
+                else:
+                    stats.profile.add(profile)
+
+        for hook in self.hooks:
+            hook(stats.kind, stats.name, wall, cpu, error)
+
+    def stats_of(self, kind: str, name: str) -> CallStats:
+        key = (kind, name)
+        stats = self.__stats.get(key, None)
+        if stats is None:
+            with self.__lock:
+                stats = self.__stats.setdefault(
+                    key, CallStats(kind, name, self.window))
+        return stats
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self.__lock:
+            stats = list(self.__stats.values())
+        return dict(('%s:%s' % (s.kind, s.name), s.summary()) for s in stats)
+
+    def slowest(self, limit: int=10) -> List[Tuple[str, Dict[str, Any]]]:
+        return sorted(self.summary().items(),
+                      key=lambda item: item[1]['wall_p99'] or 0,
+                      reverse=True)[:limit]
+
+    def profile_report(self, kind: str, name: str, limit: int=10) \
+            -> Optional[str]:
+        stats = self.__stats.get((kind, name), None)
+        if stats is None or stats.profile is None:
+            return None
+
+        output = io.StringIO()
+        with stats.lock:
+            report = pstats.Stats(stream=output)
+            report.add(stats.profile)
+            report.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class TokenBucket(object):
+    # Token bucket that lets callers reserve a token ahead of time.
+    # Token count may go negative, which represents callers already waiting
+    # for tokens to be refilled. Each caller is told how long to wait for its
+    # reserved token, so callers are served in order without polling.
+
+    def __init__(self,
+                 rate: float,
+                 capacity: float,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        if rate <= 0:
+            raise ValueError('rate must be positive. %s' % rate)
+
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.clock = clock
+        self.__tokens = self.capacity
+        self.__updated_at = clock()
+        self.__lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        with self.__lock:
+            self.__refill()
+            return self.__tokens
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def reserve(self) -> float:
+        """Takes one token, and returns seconds to wait until it is ready."""
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= 1
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0.0
+
+    def __refill(self) -> None:
+        now = self.clock()
+        self.__tokens = min(self.capacity,
+                            self.__tokens + (now - self.__updated_at) *
+                            self.rate)
+        self.__updated_at = now
+
+
+class RateLimiter(object):
+    # Combination of one workspace-wide bucket and one bucket per key such as
+    # channel or room. acquire() blocks until both buckets grant a token, so
+    # messages are delayed rather than dropped.
+    # Omitting rate for either level disables limitation on that level.
+
+    def __init__(self,
+                 rate: Optional[float]=None,
+                 burst: float=1,
+                 key_rate: Optional[float]=None,
+                 key_burst: float=1,
+                 max_keys: int=10000,
+                 clock: Callable[[], float]=time.monotonic,
+                 sleep: Callable[[float], Any]=time.sleep) -> None:
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.sleep = sleep
+
+        self.bucket = TokenBucket(rate, burst, clock) if rate else None
+        self.__key_buckets = OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.acquired = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def acquire(self, key: Hashable=None) -> float:
+        delay = self.reserve(key)
+        if delay > 0:
+            self.sleep(delay)
+
+        return delay
+
+    def reserve(self, key: Hashable=None) -> float:
+        """Takes tokens, and returns seconds to wait without blocking."""
+        delay = 0.0
+        if self.bucket:
+            delay = self.bucket.reserve()
+
+        key_bucket = self.key_bucket(key)
+        if key_bucket:
+            delay = max(delay, key_bucket.reserve())
+
+        with self.__lock:
+            self.acquired += 1
+            if delay > 0:
+                self.delayed += 1
+                self.total_delay += delay
+                self.max_delay = max(self.max_delay, delay)
+
+        return delay
+
+    def key_bucket(self, key: Hashable) -> Optional[TokenBucket]:
+        if key is None or not self.key_rate:
+            return None
+
+        with self.__lock:
+            bucket = self.__key_buckets.get(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.key_rate, self.key_burst, self.clock)
+                self.__key_buckets[key] = bucket
+
+                # Forget the least recently used one. A bucket is only
+                # dropped when it is full, or a busy key would get a fresh
+                # bucket with full burst.
+                if len(self.__key_buckets) > self.max_keys:
+                    oldest_key, oldest = next(iter(self.__key_buckets.items()))
+                    if oldest.is_full():
+                        del self.__key_buckets[oldest_key]
+            else:
+                self.__key_buckets.move_to_end(key)
+
+            return bucket
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'tokens': self.bucket.tokens if self.bucket else None,
+                'keys': len(self.__key_buckets),
+                'acquired': self.acquired,
+                'delayed': self.delayed,
+                'total_delay': self.total_delay,
+                'max_delay': self.max_delay}
@@ -1,27 +1,28 @@
 # -*- coding: utf-8 -*-
 # noinspection PyProtectedMember
 from concurrent.futures.thread import _WorkItem as WorkItem
-from concurrent.futures import Executor, Future
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 import logging
-from queue import Queue
+from queue import Full, Queue
 import threading
 import weakref
 import atexit
 
-# Provide the same interface as ThreadPoolExecutor, but create only on thread.
-# Worker is created as daemon thread. This is done to allow the interpreter to
-# exit when there is still idle thread in ThreadExecutor (i.e. shutdown() was
-# not called). However, allowing worker to die with the interpreter has two
-# undesirable properties:
-#   - The worker would still be running during interpreter shutdown,
+from typing import Any, Dict, Hashable, List
+
+# Lane workers are created as daemon threads. This is done to allow the
+# interpreter to exit when there are still idle threads in LaneExecutor (i.e.
+# shutdown() was not called). However, allowing workers to die with the
+# interpreter has two undesirable properties:
+#   - The workers would still be running during interpreter shutdown,
 #     meaning that they would fail in unpredictable ways.
-#   - The worker could be killed while evaluating a work item, which could
+#   - The workers could be killed while evaluating a work item, which could
 #     be bad if the callable being evaluated has external side-effects e.g.
 #     writing to a file.
 #
 # To work around this problem, an exit handler is installed which tells the
-# worker to exit when its work queue is empty and then waits until the thread
-# finish.
+# workers to exit when their work queues are empty.
 
 _shutdown = False
 
@@ -34,64 +35,220 @@ def _python_exit():
 atexit.register(_python_exit)
 
 
-# noinspection PyProtectedMember,PyBroadException
-def _worker(executor_reference, work_queue):
+# noinspection PyBroadException
+def _lane_worker(executor_reference, work_queue):
+    # Each lane has its own queue and the only thread that consumes it. So
+    # there is no need to notice other workers on exit, which could block
+    # forever on a bounded queue.
     try:
         while True:
             work_item = work_queue.get(block=True)
             if work_item is not None:
                 work_item.run()
-                continue
+                del work_item
+                # A full lane may have had no room for the exit signal, so
+                # check again once the queue is drained.
+                if not work_queue.empty():
+                    continue
             executor = executor_reference()
-            # Exit if:
-            #   - The interpreter is shutting down OR
-            #   - The executor that owns the worker has been collected OR
-            #   - The executor that owns the worker has been shutdown.
             if _shutdown or executor is None or executor._shutdown:
-                # Notice other workers
-                work_queue.put(None)
                 return
             del executor
     except BaseException:
         logging.critical('Exception in worker', exc_info=True)
 
 
-class ThreadExecutor(Executor):
-    def __init__(self):
-        """ Initialize a new ThreadExecutor instance. """
-        self._work_queue = Queue()
+def _wake(work_queue: Queue) -> None:
+    # Never blocks on a full lane. Its worker checks for shutdown by itself
+    # after draining the queue.
+    try:
+        work_queue.put_nowait(None)
+    except Full:
+        pass
+
+
+class LaneExecutor(Executor):
+    # Provide the same interface as ThreadPoolExecutor, but with N lanes. Each
+    # lane has its own queue and its own daemon thread. Work items submitted
+    # with the same key always go to the same lane, so they are executed in
+    # the submitted order, while work for other keys is not held back by a
+    # slow one.
+    #
+    # submit() blocks while the lane has max_queue_size items, so the
+    # producer is slowed down instead of piling up unbounded work. 0 makes
+    # lanes unbounded.
+
+    def __init__(self, lanes: int=4, max_queue_size: int=1000) -> None:
+        """ Initialize a new LaneExecutor instance. """
+        if lanes < 1:
+            raise ValueError('lanes must be positive. %s' % lanes)
+
+        self.max_queue_size = max_queue_size
+        self._work_queues = [Queue(maxsize=max_queue_size)
+                             for _ in range(lanes)]
         self._shutdown = False
         self._shutdown_lock = threading.Lock()
 
-        def weakref_cb(_, q=self._work_queue):
-            q.put(None)
+        def weakref_cb(_, queues=self._work_queues):
+            for q in queues:
+                _wake(q)
 
-        t = threading.Thread(target=_worker,
-                             args=(weakref.ref(self, weakref_cb),
-                                   self._work_queue))
-        t.daemon = True
-        t.start()
-        self._thread = t
+        reference = weakref.ref(self, weakref_cb)
+        self._threads = []
+        for work_queue in self._work_queues:
+            t = threading.Thread(target=_lane_worker,
+                                 args=(reference, work_queue))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
 
-    def submit(self, fn, *args, **kwargs):
-        with self._shutdown_lock:
-            if self._shutdown:
-                raise RuntimeError(
-                    'cannot schedule new futures after shutdown')
+    @property
+    def lanes(self) -> int:
+        return len(self._work_queues)
 
-            f = Future()
-            w = WorkItem(f, fn, args, kwargs)
+    def lane_of(self, key: Hashable) -> int:
+        return hash(key) % len(self._work_queues) if key is not None else 0
 
-            self._work_queue.put(w)
-            return f
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_to(None, fn, *args, **kwargs)
 
     submit.__doc__ = Executor.submit.__doc__
 
+    def submit_to(self, key: Hashable, fn, *args, **kwargs) -> Future:
+        """Submits a callable to the lane that corresponds to the given key.
+
+        Callables submitted with the same key are executed in order.
+        Blocks while the lane's queue is full.
+        """
+        return self._submit(key, True, fn, args, kwargs)
+
+    def try_submit_to(self, key: Hashable, fn, *args, **kwargs) -> Future:
+        """Same as submit_to(), but raises queue.Full instead of blocking
+        while the lane's queue is full."""
+        return self._submit(key, False, fn, args, kwargs)
+
+    def _submit(self, key, block, fn, args, kwargs) -> Future:
+        f = Future()
+        w = WorkItem(f, fn, args, kwargs)
+        work_queue = self._work_queues[self.lane_of(key)]
+
+        while True:
+            # The check and the put are done under the lock, so a work item
+            # is never put after the lane worker has seen the shutdown.
+            with self._shutdown_lock:
+                if self._shutdown:
+                    raise RuntimeError(
+                        'cannot schedule new futures after shutdown')
+                try:
+                    work_queue.put_nowait(w)
+                    return f
+                except Full:
+                    if not block:
+                        raise
+
+            # Don't hold the lock while waiting for room in the queue, or
+            # one full lane would block submission to all other lanes.
+            # Worker keeps draining on shutdown, so this always wakes up.
+            with work_queue.not_full:
+                while 0 < work_queue.maxsize <= work_queue._qsize():
+                    work_queue.not_full.wait()
+
+    def queue_depths(self) -> List[int]:
+        return [q.qsize() for q in self._work_queues]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'lanes': len(self._work_queues),
+                'max_queue_size': self.max_queue_size,
+                'lane_depths': self.queue_depths()}
+
     def shutdown(self, wait=True):
         with self._shutdown_lock:
             self._shutdown = True
-            self._work_queue.put(None)
+        for q in self._work_queues:
+            _wake(q)
         if wait:
-            self._thread.join()
+            for t in self._threads:
+                t.join()
 
     shutdown.__doc__ = Executor.shutdown.__doc__
+
+
+class KeyedThreadPoolExecutor(ThreadPoolExecutor):
+    # ThreadPoolExecutor that runs work items sharing the same key one at a
+    # time, in the submitted order.
+    #
+    # Unlike LaneExecutor, keys are not pinned to particular threads. While
+    # a key has a running item, later items for that key wait in the key's
+    # own queue, and the next one is handed to the pool when the running one
+    # finishes. Different keys are spread across all workers, and a busy key
+    # never holds back other keys.
+
+    def __init__(self, max_workers: int=None) -> None:
+        super().__init__(max_workers=max_workers)
+
+        # {key: deque([(future, fn, args, kwargs), ...]), ...}
+        # Presence of the key means an item for the key is being executed.
+        self._key_queues = {}
+        self._key_lock = threading.Lock()
+
+    def submit_keyed(self, key: Hashable, fn, *args, **kwargs) -> Future:
+        """Submits a callable that must not run concurrently with other
+        callables with the same key."""
+        if key is None:
+            return self.submit(fn, *args, **kwargs)
+
+        f = Future()
+        with self._key_lock:
+            key_queue = self._key_queues.get(key, None)
+            if key_queue is not None:
+                key_queue.append((f, fn, args, kwargs))
+                return f
+            self._key_queues[key] = deque()
+
+        try:
+            self.submit(self._run_keyed, key, f, fn, args, kwargs)
+        except BaseException:
+            with self._key_lock:
+                del self._key_queues[key]
+            raise
+        return f
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._key_lock:
+            waiting = sum(len(q) for q in self._key_queues.values())
+        return {'max_workers': self._max_workers,
+                'queue_depth': self._work_queue.qsize(),
+                'active_keys': len(self._key_queues),
+                'waiting_keyed_items': waiting}
+
+    def _run_keyed(self, key, f, fn, args, kwargs) -> None:
+        try:
+            if f.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    f.set_exception(e)
+                else:
+                    f.set_result(result)
+        finally:
+            self._next_keyed(key)
+
+    def _next_keyed(self, key) -> None:
+        with self._key_lock:
+            key_queue = self._key_queues[key]
+            if not key_queue:
+                del self._key_queues[key]
+                return
+            item = key_queue.popleft()
+
+        # Hand the next item to the pool instead of running it here, so keys
+        # with long backlog take turns with others.
+        try:
+            self.submit(self._run_keyed, key, *item)
+        except RuntimeError as e:
+            # Shutdown. Nothing for this key can run anymore.
+            with self._key_lock:
+                items = [item] + list(self._key_queues.pop(key, ()))
+            for f, _, _, _ in items:
+                if f.set_running_or_notify_cancel():
+                    f.set_exception(e)
@@ -1,26 +1,63 @@
 # -*- coding: utf-8 -*-
+import abc
 from inspect import getfullargspec
 from typing import Any
 
 
-class ValueObject(object):
-    def __new__(cls, *args, **kwargs):
-        self = super().__new__(cls)
+class ValueObjectMeta(abc.ABCMeta):
+    # Inspecting __init__ on every instantiation is expensive, and value
+    # objects are created for every single message. Instead the declaration
+    # is inspected once when the class is created, and the resulting field
+    # layout is stored on the class.
+    #
+    # This derives from ABCMeta so subclasses such as RichMessage can still
+    # declare metaclass=abc.ABCMeta without metaclass conflict.
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
 
         # "ValueError: Function has keyword-only arguments or annotations, use
         # getfullargspec() API which can support them"
-        # names, varargs, keywords, defaults = getargspec(self.__init__)
-        names, varargs, keywords, defaults = getfullargspec(self.__init__)[:4]
+        # names, varargs, keywords, defaults = getargspec(cls.__init__)
+        names, varargs, keywords, defaults = getfullargspec(cls.__init__)[:4]
+
+        # Skip the first argument, own instance
+        names = tuple(names[1:])
+        defaults = () if not defaults else tuple(defaults)
+
+        # Reject malformed declaration on instantiation as we always did.
+        cls._malformed = bool(varargs or keywords)
+
+        cls._fields = names
+        cls._defaults = dict(zip(names[::-1], defaults[::-1]))
+
+        # Default values aligned with _fields. Fields without default value
+        # are padded with a sentinel so __repr__ only needs to zip tuples.
+        cls._repr_defaults = \
+            (_NULL,) * (len(names) - len(defaults)) + defaults
+
+        return cls
+
+
+_NULL = object()
+
+
+class ValueObject(object, metaclass=ValueObjectMeta):
+    # Subclasses without __slots__ declaration still get per-instance
+    # __dict__ as usual. Declaring slots here lets CompactValueObject drop it.
+    __slots__ = ('__stash', '__weakref__')
 
+    def __new__(cls, *args, **kwargs):
         # Check __init__'s declaration
-        if varargs or keywords:
+        if cls._malformed:
             raise ValueError("__init__ with *args or **kwargs are not allowed")
 
-        defaults = () if not defaults else defaults
-        self.__stash = dict()
-        self.__stash.update(dict(zip(names[:0:-1], defaults[::-1])))
-        self.__stash.update(dict(zip(names[1:], args)))
-        self.__stash.update(kwargs.items())
+        self = super().__new__(cls)
+
+        stash = dict(cls._defaults)
+        stash.update(zip(cls._fields, args))
+        stash.update(kwargs)
+        self.__stash = stash
 
         # # Dynamically adding properties doesn't help because these properties
         # # are not recognized by IDEs.
@@ -45,17 +82,12 @@ class ValueObject(object):
         self.__stash[key] = value
 
     def __repr__(self):
-        null = object()
-        names, _, _, defaults = getfullargspec(self.__init__)[:4]
-        names.pop(0)  # Skip the first argument, own class
-        values = [self.__stash[arg] for arg in names]
-        defaults = () if not defaults else defaults
-        defaults = defaults[1:] if len(defaults) == len(
-            names) + 1 else defaults
-        defaults = (null,) * (len(names) - len(defaults)) + defaults
+        stash = self.__stash
         return '%s(%s)' % (
             self.__class__.__name__,
-            ', '.join(repr(a) for a, d in zip(values, defaults) if a != d))
+            ', '.join(repr(stash[name]) for name, default
+                      in zip(self._fields, self._repr_defaults)
+                      if stash[name] != default))
 
     def __hash__(self) -> int:
         return hash(repr(self))
@@ -70,3 +102,86 @@ class ValueObject(object):
 
     def keys(self):
         return self.__stash.keys()
+
+
+class CompactValueObjectMeta(ValueObjectMeta):
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        # Subclasses must not re-introduce per-instance __dict__
+        namespace.setdefault('__slots__', ())
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+        cls._field_index = dict((n, i) for i, n in enumerate(cls._fields))
+        return cls
+
+    def __call__(cls, *args, **kwargs):
+        self = super().__call__(*args, **kwargs)
+
+        # Values may be modified in __init__. After that, freeze them so
+        # the hash value can be cached safely.
+        self._values = tuple(self._values)
+        return self
+
+
+class CompactValueObject(ValueObject, metaclass=CompactValueObjectMeta):
+    # Opt-in compact representation. Values are stored in a tuple in declared
+    # order instead of per-instance dictionary. Hash value is calculated from
+    # the values on first use and cached, and equality compares the values
+    # field by field instead of comparing repr() strings.
+    # Values can only be modified in __init__.
+    __slots__ = ('_values', '_hash')
+
+    def __new__(cls, *args, **kwargs):
+        # Check __init__'s declaration
+        if cls._malformed:
+            raise ValueError("__init__ with *args or **kwargs are not allowed")
+
+        self = object.__new__(cls)
+
+        values = list(cls._repr_defaults)
+        values[:len(args)] = args
+        for key, value in kwargs.items():
+            try:
+                values[cls._field_index[key]] = value
+            except KeyError:
+                raise TypeError("__init__() got an unexpected keyword "
+                                "argument '%s'" % key)
+        self._values = values
+
+        return self
+
+    def __getitem__(self, key) -> Any:
+        return self._values[self._field_index[key]]
+
+    def __setitem__(self, key, value) -> Any:
+        if isinstance(self._values, tuple):
+            raise TypeError("%s can't be modified after initialization" %
+                            self.__class__.__name__)
+        self._values[self._field_index[key]] = value
+
+    def __repr__(self):
+        return '%s(%s)' % (
+            self.__class__.__name__,
+            ', '.join(repr(value) for value, default
+                      in zip(self._values, self._repr_defaults)
+                      if value != default))
+
+    def __hash__(self) -> int:
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+
+        try:
+            self._hash = hash((self.__class__, self._values))
+        except TypeError:
+            # Some field holds unhashable value such as list or dict
+            self._hash = hash(repr(self))
+
+        return self._hash
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, self.__class__):
+            return False
+        return self._values == other._values
+
+    def keys(self):
+        return self._fields
@@ -33,7 +33,12 @@ setup(
     url='https://github.com/oklahomer/sarah',
     version=VERSION,
     install_requires=open('requirements.txt').read().splitlines(),
+    # async def, importlib.reload() and time.thread_time()
+    python_requires='>=3.7',
     packages=find_packages(),
     include_package_data=True,
-    classifiers=['Programming Language :: Python'],
+    classifiers=['Programming Language :: Python',
+                 'Programming Language :: Python :: 3 :: Only',
+                 'Programming Language :: Python :: 3.7',
+                 'Programming Language :: Python :: 3.8'],
 )
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+class Clock(object):
+    # Fake time source for classes taking clock argument. Time only moves
+    # when the test sets now or sleeps.
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
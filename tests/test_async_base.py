@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+from assertpy import assert_that
+import pytest
+
+from sarah.bot.async_base import AsyncBase
+from sarah.bot.values import UserContext, InputOption
+
+
+class AsyncBot(AsyncBase):
+    def __init__(self, inputs, **kwargs):
+        super().__init__(**kwargs)
+        self.inputs = inputs
+        self.sent = []
+
+    async def connect(self):
+        # Each input is handled concurrently, and ends when all replies are
+        # sent.
+        await asyncio.gather(*[self.message(user, text)
+                               for user, text in self.inputs])
+
+    async def message(self, user, text):
+        ret = await self.respond(user, text)
+        if ret:
+            await self.enqueue_sending_message(self.sent.append,
+                                               (user, ret),
+                                               destination=user)
+
+    def add_schedule_job(self, command):
+        pass
+
+
+def _stop(bot):
+    bot.stop()
+    bot.close()
+
+
+class TestRespond(object):
+    def test_async_and_plain_commands(self):
+        bot = AsyncBot(inputs=(('U06TXXXXX', '.async spam'),
+                               ('U06TYYYYY', '.plain ham')),
+                       max_workers=2)
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.async')
+        async def async_command(msg, config):
+            await asyncio.sleep(0)
+            return 'async %s %s' % (msg.text, threading.current_thread().name)
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.plain')
+        def plain_command(msg, config):
+            return 'plain %s %s' % (msg.text, threading.current_thread().name)
+
+        bot.run()
+        _stop(bot)
+
+        sent = dict(bot.sent)
+        assert_that(sent['U06TXXXXX']) \
+            .described_as("Coroutine runs on event loop thread") \
+            .is_equal_to('async spam %s' % threading.current_thread().name)
+        assert_that(sent['U06TYYYYY']).starts_with('plain ham ')
+        assert_that(sent['U06TYYYYY'].split()[-1]) \
+            .described_as("Plain function runs in executor") \
+            .is_not_equal_to(threading.current_thread().name)
+
+    def test_many_slow_commands(self):
+        inputs = [('U%04d' % i, '.slow') for i in range(1000)]
+        bot = AsyncBot(inputs=inputs, max_workers=1)
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.slow')
+        async def slow_command(msg, config):
+            await asyncio.sleep(.2)
+            return 'done'
+
+        started = time.monotonic()
+        bot.run()
+        elapsed = time.monotonic() - started
+        _stop(bot)
+
+        assert_that(bot.sent).is_length(1000)
+        assert_that(elapsed) \
+            .described_as("Commands wait concurrently without threads") \
+            .is_less_than(2)
+
+    def test_conversation(self):
+        user_key = 'U06TXXXXX'
+        bot = AsyncBot(inputs=())
+
+        async def feeling_good(msg, config):
+            return 'Good to hear that.'
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.hello')
+        def hello(msg, config):
+            return UserContext(message='How are you?',
+                               help_message='Say Good, please.',
+                               input_options=(
+                                   InputOption('Good', feeling_good),))
+
+        bot.worker = None
+        assert_that(bot.loop.run_until_complete(
+            bot.respond(user_key, '.hello'))).is_equal_to('How are you?')
+        assert_that(bot.loop.run_until_complete(
+            bot.respond(user_key, 'Bad'))).is_equal_to('Say Good, please.')
+        assert_that(bot.loop.run_until_complete(
+            bot.respond(user_key, 'Good'))).is_equal_to('Good to hear that.')
+        assert_that(bot.user_context_map.get(user_key)).is_none()
+        bot.close()
+
+    def test_timeout(self):
+        bot = AsyncBot(inputs=(('U06TXXXXX', '.stuck'),),
+                       timeout_config={'default': .1})
+        cancelled = []
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.stuck')
+        async def stuck_command(msg, config):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(msg.text)
+                raise
+
+        bot.run()
+        _stop(bot)
+
+        assert_that(bot.sent).is_equal_to(
+            [('U06TXXXXX', '".stuck" did not finish in 0.1 seconds')])
+        assert_that(cancelled).is_length(1)
+        assert_that(bot.metrics()['timeouts']) \
+            .contains_entry({'timed_out': 1}) \
+            .contains_entry({'by_command': {'.stuck': 1}})
+
+    def test_timeout_plain(self):
+        bot = AsyncBot(inputs=(('U06TXXXXX', '.stuck'),),
+                       timeout_config={'default': .1})
+        release = threading.Event()
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.stuck')
+        def stuck_command(msg, config):
+            release.wait(10)
+            return 'done'
+
+        bot.run()
+        assert_that(bot.sent).is_equal_to(
+            [('U06TXXXXX', '".stuck" did not finish in 0.1 seconds')])
+        assert_that(bot.metrics()['timeouts']) \
+            .contains_entry({'abandoned_running': 1}) \
+            .contains_entry({'abandoned_finished': 0})
+
+        release.set()
+        bot.worker.shutdown(wait=True)
+        assert_that(bot.metrics()['timeouts']) \
+            .described_as("Counted when the abandoned call finishes") \
+            .contains_entry({'abandoned_running': 0}) \
+            .contains_entry({'abandoned_finished': 1})
+        _stop(bot)
+
+    def test_profile(self):
+        bot = AsyncBot(inputs=(('U06TXXXXX', '.async'),
+                               ('U06TYYYYY', '.plain')),
+                       max_workers=2,
+                       profile_config={'admins': ['U06TXXXXX']})
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.async')
+        async def async_command(msg, config):
+            await asyncio.sleep(.05)
+            return 'async'
+
+        # noinspection PyUnusedLocal
+        @AsyncBot.command('.plain')
+        def plain_command(msg, config):
+            return 'plain'
+
+        bot.run()
+        _stop(bot)
+
+        profile = bot.metrics()['profile']
+        assert_that(profile).contains_key('command:.async',
+                                          'command:.plain',
+                                          'send:append')
+        assert_that(profile['command:.async']['calls']).is_equal_to(1)
+        assert_that(profile['command:.async']['wall_total']) \
+            .described_as("Awaited time is counted") \
+            .is_greater_than_or_equal_to(.05)
+        assert_that(profile['command:.plain']['calls']).is_equal_to(1)
+        assert_that(profile['send:append']['calls']).is_equal_to(2)
+
+
+class TestEnqueue(object):
+    def test_order_within_destination(self):
+        bot = AsyncBot(inputs=())
+        sent = []
+
+        async def send(i):
+            # Later ones finish earlier if they are not serialized
+            await asyncio.sleep((10 - i) / 1000)
+            sent.append(i)
+
+        async def enqueue():
+            futures = [bot.enqueue_sending_message(send, i,
+                                                   destination='C06TXXXX')
+                       for i in range(10)]
+            assert_that(bot.queue_depths()).contains_key('C06TXXXX')
+            await asyncio.gather(*futures)
+
+        bot.loop.run_until_complete(enqueue())
+        bot.close()
+
+        assert_that(sent).is_equal_to(list(range(10)))
+
+    def test_full_destination(self):
+        bot = AsyncBot(inputs=(),
+                       message_worker_config={'max_queue_size': 1})
+
+        async def enqueue():
+            bot.enqueue_sending_message(asyncio.sleep, 0,
+                                        destination='C06TXXXX')
+            with pytest.raises(asyncio.QueueFull):
+                bot.enqueue_sending_message(asyncio.sleep, 0,
+                                            destination='C06TXXXX')
+            await bot.enqueue_sending_message(asyncio.sleep, 0,
+                                              destination='C06TYYYY')
+
+        bot.loop.run_until_complete(enqueue())
+        bot.close()
+
+        assert_that(bot.metrics()['messages']) \
+            .contains_entry({'sent': 2})
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from assertpy import assert_that
+import pytest
+
+from sarah.bot.cache import ResponseCache, freeze
+from sarah.bot.values import CommandMessage, UserContext
+
+
+def message(text):
+    return CommandMessage(original_text='.spam %s' % text,
+                          text=text,
+                          sender='U06TXXXXX')
+
+
+class TestResponseCache(object):
+    def test_hit(self):
+        calls = []
+        cache = ResponseCache()
+        spam = cache(lambda msg, config: calls.append(msg.text) or msg.text)
+
+        assert_that(spam(message('ham  egg'), {})).is_equal_to('ham  egg')
+        assert_that(spam(message(' ham egg '), {})) \
+            .described_as("Whitespace is normalized") \
+            .is_equal_to('ham  egg')
+        assert_that(spam(message('Ham egg'), {})).is_equal_to('Ham egg')
+
+        assert_that(calls).is_equal_to(['ham  egg', 'Ham egg'])
+        assert_that(cache.metrics()) \
+            .contains_entry({'hits': 1}) \
+            .contains_entry({'misses': 2}) \
+            .contains_entry({'size': 2})
+
+    def test_ignore_case(self):
+        cache = ResponseCache(ignore_case=True)
+        assert_that(cache.key(message('Ham'), {})) \
+            .is_equal_to(cache.key(message('ham'), {}))
+
+    def test_config(self):
+        cache = ResponseCache()
+        assert_that(cache.key(message('ham'), {'city': 'Tokyo'})) \
+            .is_not_equal_to(cache.key(message('ham'), {'city': 'Osaka'}))
+        assert_that(freeze({'b': [1, {'c': 2}], 'a': 1})) \
+            .is_equal_to((('a', 1), ('b', (1, (('c', 2),)))))
+
+    def test_ttl(self, clock):
+        cache = ResponseCache(ttl=10, clock=clock)
+        cache.get_or_call('ham', lambda: 'v1')
+
+        clock.now = 10
+        assert_that(cache.get_or_call('ham', lambda: 'v2')).is_equal_to('v1')
+        clock.now = 11
+        assert_that(cache.get_or_call('ham', lambda: 'v2')).is_equal_to('v2')
+        assert_that(cache.metrics()).contains_entry({'evicted_ttl': 1})
+
+    def test_lru(self):
+        cache = ResponseCache(max_size=2)
+        cache.get_or_call('ham', lambda: 'ham')
+        cache.get_or_call('egg', lambda: 'egg')
+        cache.get_or_call('ham', lambda: 'ham')
+        cache.get_or_call('spam', lambda: 'spam')
+
+        assert_that(cache).is_length(2)
+        assert_that(cache.get_or_call('egg', lambda: 'new egg')) \
+            .described_as("Least recently used one is evicted") \
+            .is_equal_to('new egg')
+        assert_that(cache.metrics()).contains_entry({'evicted_lru': 2})
+
+    def test_not_cached(self):
+        cache = ResponseCache()
+        context = UserContext(message='How are you?',
+                              help_message='Say Good.',
+                              input_options=())
+        cache.get_or_call('context', lambda: context)
+        cache.get_or_call('empty', lambda: '')
+        with pytest.raises(ValueError):
+            cache.get_or_call('error', self.raise_error)
+
+        assert_that(cache).is_length(0)
+        assert_that(cache.get_or_call('error', lambda: 'ok')) \
+            .is_equal_to('ok')
+
+    def test_single_flight(self):
+        cache = ResponseCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'ham'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(cache.get_or_call('ham', slow)))
+        leader.start()
+        started.wait()
+
+        followers = [threading.Thread(
+            target=lambda: results.append(cache.get_or_call('ham', slow)))
+            for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while cache.shared < 3:
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        assert_that(calls).is_length(1)
+        assert_that(results).is_equal_to(['ham'] * 4)
+        assert_that(cache.metrics()) \
+            .contains_entry({'misses': 1}) \
+            .contains_entry({'shared': 3})
+
+    def test_single_flight_error(self):
+        cache = ResponseCache()
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing():
+            started.set()
+            release.wait()
+            raise ValueError('ham')
+
+        errors = []
+
+        def call():
+            try:
+                cache.get_or_call('ham', failing)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        while cache.shared < 1:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert_that(errors).is_length(2)
+
+    @staticmethod
+    def raise_error():
+        raise ValueError('spam')
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+import threading
+
+from assertpy import assert_that
+import pytest
+
+from sarah.coalesce import MessageCoalescer
+
+
+class Sender(object):
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key, text):
+        with self.lock:
+            self.sent.append((key, text))
+        return len(self.sent)
+
+
+class TestMessageCoalescer(object):
+    def test_merge_within_window(self):
+        sender = Sender()
+        coalescer = MessageCoalescer(sender, window=.1)
+
+        futures = [coalescer.add('C06TXXXX', 'spam'),
+                   coalescer.add('C06TYYYY', 'egg'),
+                   coalescer.add('C06TXXXX', 'ham')]
+
+        assert_that([f.result(1) for f in futures]).is_length(3)
+        assert_that(sender.sent) \
+            .contains_only(('C06TXXXX', 'spam\nham'), ('C06TYYYY', 'egg'))
+        assert_that(futures[0].result()).is_equal_to(futures[2].result())
+        assert_that(coalescer.metrics()) \
+            .contains_entry({'messages': 3}) \
+            .contains_entry({'batches': 2}) \
+            .contains_entry({'merged': 1}) \
+            .contains_entry({'pending': 0})
+        coalescer.close()
+
+    def test_max_length(self):
+        sender = Sender()
+        coalescer = MessageCoalescer(sender, window=60, max_length=10)
+
+        first = coalescer.add('C06TXXXX', 'spam')
+        coalescer.add('C06TXXXX', 'ham')
+        coalescer.add('C06TXXXX', 'egg')
+        last = coalescer.add('C06TXXXX', 'onion')
+
+        # Adding "egg" closes "spam\nham" batch without waiting for window
+        first.result(1)
+        assert_that(last.done()).is_false()
+
+        coalescer.close()
+        assert_that(sender.sent) \
+            .described_as("Order is kept across batches") \
+            .is_equal_to([('C06TXXXX', 'spam\nham'),
+                          ('C06TXXXX', 'egg\nonion')])
+
+    def test_future_chaining(self):
+        sent = Future()
+        coalescer = MessageCoalescer(lambda key, text: sent, window=0)
+
+        future = coalescer.add('C06TXXXX', 'spam')
+        sent.set_exception(ValueError('ham'))
+
+        with pytest.raises(ValueError):
+            future.result(1)
+        coalescer.close()
+
+    def test_pass_through(self):
+        sender = Sender()
+        coalescer = MessageCoalescer(sender, window=60)
+
+        text = coalescer.add('C06TXXXX', 'spam')
+        passed = coalescer.pass_through('C06TXXXX', sender, 'C06TXXXX', 'ham')
+        other = coalescer.add('C06TYYYY', 'egg')
+
+        assert_that(passed.result(1)).is_equal_to(2)
+        assert_that(text.result()).is_equal_to(1)
+        assert_that(other.done()) \
+            .described_as("Other key's batch stays open") \
+            .is_false()
+        assert_that(sender.sent).is_equal_to([('C06TXXXX', 'spam'),
+                                              ('C06TXXXX', 'ham')])
+        assert_that(coalescer.metrics()).contains_entry({'passed': 1})
+        coalescer.close()
+
+    def test_failed_send(self):
+        def send(key, text):
+            raise ValueError('full')
+
+        coalescer = MessageCoalescer(send, window=0)
+        future = coalescer.add('C06TXXXX', 'spam')
+
+        with pytest.raises(ValueError):
+            future.result(1)
+        assert_that(coalescer.metrics()).contains_entry({'failed': 1})
+        coalescer.close()
+
+    def test_close(self):
+        sender = Sender()
+        coalescer = MessageCoalescer(sender, window=60)
+        coalescer.add('C06TXXXX', 'spam')
+        coalescer.close()
+
+        assert_that(sender.sent).is_equal_to([('C06TXXXX', 'spam')])
+        with pytest.raises(RuntimeError):
+            coalescer.add('C06TXXXX', 'ham')
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from assertpy import assert_that
+
+from sarah.bot.command_index import CommandIndex
+from sarah.bot.values import Command
+
+
+def _command(name, module_name='spam.ham'):
+    return Command(name, lambda msg, config: name, module_name, {})
+
+
+class TestFind(object):
+    def test_longest_match(self):
+        index = CommandIndex()
+        index.add(_command('.count'))
+        index.add(_command('.reset'))
+        index.add(_command('.reset_count'))
+
+        assert_that(index.find('.reset_count spam')) \
+            .described_as("Longer name is preferred over its prefix") \
+            .has_name('.reset_count')
+        assert_that(index.find('.reset spam')).has_name('.reset')
+        assert_that(index.find('.count')).has_name('.count')
+
+    def test_no_match(self):
+        index = CommandIndex()
+        index.add(_command('.count'))
+
+        assert_that(index.find('count')).is_none()
+        assert_that(index.find('.cou')).is_none()
+        assert_that(index.find('')).is_none()
+
+
+class TestUpdate(object):
+    def test_replace(self):
+        index = CommandIndex()
+        index.add(_command('.echo', 'spam.ham'))
+        index.add(_command('.echo', 'spam.egg'))
+
+        assert_that(index).is_length(1)
+        assert_that(index.find('.echo spam')).has_module_name('spam.egg')
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from assertpy import assert_that
+import pytest
+
+from sarah.bot.context import MemoryContextStore, ShardedContextStore, \
+    SQLiteContextStore, dump_context, load_context
+from sarah.bot.slack import Slack, SlackMessage
+from sarah.bot.values import UserContext, InputOption
+
+
+def _context(message='spam'):
+    return UserContext(message=message,
+                       help_message='ham',
+                       input_options=())
+
+
+# noinspection PyUnusedLocal
+def _next_step(msg, config):
+    return 'egg'
+
+
+def _conversation(message='spam'):
+    return UserContext(message=message,
+                       help_message='ham',
+                       input_options=(InputOption('egg', _next_step),))
+
+
+class TestMemoryContextStore(object):
+    def test_get_set_pop(self):
+        store = MemoryContextStore()
+        context = _context()
+        store['U06TXXXXX'] = context
+
+        assert_that(store).is_length(1)
+        assert_that(store.get('U06TXXXXX')).is_equal_to(context)
+        assert_that(store.get('U06TYYYYY')).is_none()
+        assert_that('U06TXXXXX' in store).is_true()
+
+        assert_that(store.pop('U06TXXXXX')).is_equal_to(context)
+        assert_that(store.pop('U06TXXXXX', None)).is_none()
+        with pytest.raises(KeyError):
+            store.pop('U06TXXXXX')
+
+    def test_lru_eviction(self):
+        store = MemoryContextStore(max_size=2, ttl=None)
+        store['spam'] = _context('spam')
+        store['ham'] = _context('ham')
+
+        # Touch "spam" so "ham" becomes the least recently used one
+        store.get('spam')
+        store['egg'] = _context('egg')
+
+        assert_that(store.get('ham')).is_none()
+        assert_that(store.get('spam')).is_not_none()
+        assert_that(store.get('egg')).is_not_none()
+        assert_that(store.metrics()) \
+            .contains_entry({'size': 2}) \
+            .contains_entry({'evicted_lru': 1}) \
+            .contains_entry({'evicted_ttl': 0})
+
+    def test_ttl_eviction(self, clock):
+        store = MemoryContextStore(ttl=10, clock=clock)
+        store['spam'] = _context('spam')
+        store['ham'] = _context('ham')
+
+        clock.now = 5
+        store.get('ham')
+
+        clock.now = 12
+        assert_that(store.get('spam')) \
+            .described_as("Idle for longer than TTL") \
+            .is_none()
+        assert_that(store.get('ham')).is_not_none()
+
+        # Abandoned entries are swept on later writes
+        clock.now = 30
+        store['egg'] = _context('egg')
+        assert_that(store).is_length(1)
+        assert_that(store.metrics()).contains_entry({'evicted_ttl': 2})
+
+
+class TestShardedContextStore(object):
+    def test_get_set_pop(self):
+        store = ShardedContextStore(shards=4)
+        contexts = dict(('U%04d' % i, _context()) for i in range(100))
+        for user_key, context in contexts.items():
+            store[user_key] = context
+
+        assert_that(store).is_length(100)
+        assert_that(store.get('U0042')).is_same_as(contexts['U0042'])
+        assert_that(store.pop('U0042')).is_same_as(contexts['U0042'])
+        assert_that(store.get('U0042')).is_none()
+        assert_that(store.metrics()) \
+            .contains_entry({'size': 99}) \
+            .contains_entry({'shards': 4})
+
+    def test_shards_limited_by_max_size(self):
+        store = ShardedContextStore(shards=16, max_size=5)
+
+        assert_that(store.shards).is_equal_to(5)
+
+    def test_concurrent_access(self):
+        store = ShardedContextStore(shards=16)
+        contexts = [_context(message=str(i)) for i in range(100)]
+        users = 64
+
+        def converse(user_index):
+            # Each user goes through get, set and pop just like respond()
+            user_key = 'U%04d' % user_index
+            for i, context in enumerate(contexts):
+                assert_that(store.get(user_key)).is_none()
+                store[user_key] = context
+                assert_that(store.get(user_key)).is_same_as(context)
+                if i % 2:
+                    store.pop(user_key)
+                else:
+                    assert_that(store.pop(user_key)).is_same_as(context)
+            return len(contexts)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            handled = sum(executor.map(converse, range(users)))
+        elapsed = time.monotonic() - started
+
+        assert_that(handled).is_equal_to(users * len(contexts))
+        assert_that(store).is_length(0)
+        assert_that(elapsed) \
+            .described_as("%d steps in %fs" % (handled, elapsed)) \
+            .is_less_than(10)
+
+
+class TestSerialization(object):
+    def test_round_trip(self):
+        context = _conversation()
+        restored = load_context(dump_context(context))
+
+        assert_that(restored.message).is_equal_to('spam')
+        assert_that(restored.help_message).is_equal_to('ham')
+        assert_that(restored.input_options).is_length(1)
+        assert_that(restored.input_options[0].next_step) \
+            .is_same_as(_next_step)
+        assert_that(restored.input_options[0].match('egg')).is_true()
+
+    def test_rich_message(self):
+        message = SlackMessage(text='spam')
+        restored = load_context(dump_context(_conversation(message)))
+
+        assert_that(restored.message).is_equal_to(message)
+
+    def test_local_function(self):
+        # noinspection PyUnusedLocal
+        def next_step(msg, config):
+            pass
+
+        context = UserContext(message='spam',
+                              help_message='ham',
+                              input_options=(InputOption('egg', next_step),))
+        with pytest.raises(ValueError):
+            dump_context(context)
+
+
+class TestSQLiteContextStore(object):
+    def test_persistence(self, tmpdir):
+        path = str(tmpdir.join('context.db'))
+        store = SQLiteContextStore(path=path, flush_interval=60)
+        store['U06TXXXXX'] = _conversation()
+        store['U06TYYYYY'] = _conversation('ham')
+        store.pop('U06TYYYYY')
+
+        assert_that(store.metrics()).contains_entry({'pending': 2})
+        store.close()
+
+        restarted = SQLiteContextStore(path=path)
+        context = restarted.get('U06TXXXXX')
+        assert_that(context.message).is_equal_to('spam')
+        assert_that(context.input_options[0].next_step).is_same_as(_next_step)
+        assert_that(restarted.get('U06TYYYYY')).is_none()
+        assert_that(restarted).is_length(1)
+        assert_that(restarted.metrics()).contains_entry({'loaded': 1})
+        restarted.close()
+
+    def test_miss_without_stored_context(self, tmpdir):
+        path = str(tmpdir.join('context.db'))
+        store = SQLiteContextStore(path=path)
+        store['U06TXXXXX'] = _conversation()
+        store.close()
+
+        restarted = SQLiteContextStore(path=path)
+        statements = []
+        # noinspection PyUnresolvedReferences
+        restarted._SQLiteContextStore__connection.set_trace_callback(
+            statements.append)
+        assert_that(restarted.metrics()).contains_entry({'stored': 1})
+
+        assert_that(restarted.get('U06TYYYYY')).is_none()
+        assert_that(statements) \
+            .described_as("User without stored context doesn't reach DB") \
+            .is_empty()
+
+        assert_that(restarted.get('U06TXXXXX').message).is_equal_to('spam')
+        assert_that(statements).is_length(1)
+
+        restarted.pop('U06TXXXXX')
+        restarted.flush()
+        assert_that(restarted.metrics()).contains_entry({'stored': 0})
+        restarted.close()
+
+    def test_write_behind(self):
+        store = SQLiteContextStore(flush_interval=60, batch_size=10)
+        for i in range(9):
+            store['U%04d' % i] = _conversation()
+        assert_that(store.metrics()).contains_entry({'flushed': 0})
+
+        # Reaching batch_size wakes the writer up
+        store['U0009'] = _conversation()
+        for _ in range(100):
+            if store.metrics()['flushed'] == 10:
+                break
+            time.sleep(.01)
+        assert_that(store.metrics()) \
+            .contains_entry({'flushed': 10}) \
+            .contains_entry({'pending': 0})
+        store.close()
+
+    def test_evicted_before_flush(self):
+        store = SQLiteContextStore(max_size=1, flush_interval=60)
+        store['U06TXXXXX'] = _conversation()
+        store['U06TYYYYY'] = _conversation('ham')
+
+        assert_that(store.get('U06TXXXXX').message) \
+            .described_as("Restored from pending write") \
+            .is_equal_to('spam')
+        store.close()
+
+    def test_ttl(self, clock):
+        clock.now = 1000
+        store = SQLiteContextStore(ttl=10, clock=clock)
+        store['U06TXXXXX'] = _conversation()
+        store.flush()
+
+        clock.now = 1011
+        assert_that(store.get('U06TXXXXX')).is_none()
+        store.close()
+
+    def test_unserializable(self):
+        store = SQLiteContextStore(flush_interval=60)
+
+        # noinspection PyUnusedLocal
+        def next_step(msg, config):
+            pass
+
+        context = UserContext(message='spam',
+                              help_message='ham',
+                              input_options=(InputOption('egg', next_step),))
+        store['U06TXXXXX'] = context
+
+        assert_that(store.get('U06TXXXXX')) \
+            .described_as("Still available in memory") \
+            .is_same_as(context)
+        assert_that(store.metrics()).contains_entry({'serialize_errors': 1})
+        store.close()
+
+
+class TestBotIntegration(object):
+    def test_config(self):
+        slack = Slack(token='spam_ham_egg',
+                      context_config={'max_size': 5, 'ttl': 60})
+
+        assert_that(slack.user_context_map) \
+            .is_instance_of(ShardedContextStore) \
+            .has_max_size(5) \
+            .has_ttl(60)
+
+    def test_config_without_shards(self):
+        slack = Slack(token='spam_ham_egg',
+                      context_config={'max_size': 5, 'shards': 1})
+
+        assert_that(slack.user_context_map) \
+            .is_instance_of(MemoryContextStore) \
+            .has_max_size(5)
+
+    def test_config_sqlite(self, tmpdir):
+        path = str(tmpdir.join('context.db'))
+        slack = Slack(token='spam_ham_egg',
+                      context_config={'backend': 'sqlite', 'path': path})
+
+        assert_that(slack.user_context_map) \
+            .is_instance_of(SQLiteContextStore) \
+            .has_path(path)
+        slack.user_context_map.close()
+
+    def test_config_unknown_backend(self):
+        with pytest.raises(ValueError):
+            Slack(token='spam_ham_egg', context_config={'backend': 'spam'})
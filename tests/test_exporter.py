@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from assertpy import assert_that
+import pytest
+
+from sarah.exporter import MetricsExporter, render
+from sarah.metrics import Histogram
+
+
+class TestRender(object):
+    def test_nested(self):
+        text = render({'worker': {'queue_depth': 3, 'max_workers': None},
+                       'connection': {'connected': True,
+                                      'downtime': 1.5},
+                       'message_worker': {'lane_depths': [1, 0]},
+                       'queue_depths': {'C06TXXXX': 2},
+                       'latency': [.5],
+                       'profile': {'command:.echo': {'calls': 2}},
+                       'startup': {'deferred_plugins': ['spam']}},
+                      labels={'adapter': 'slack'})
+
+        assert_that(text.splitlines()).contains(
+            '# TYPE sarah_worker_queue_depth untyped',
+            'sarah_worker_queue_depth{adapter="slack"} 3',
+            'sarah_connection_connected{adapter="slack"} 1',
+            'sarah_connection_downtime{adapter="slack"} 1.5',
+            'sarah_message_worker_lane_depths{adapter="slack",lane="1"} 0',
+            'sarah_queue_depths{adapter="slack",destination="C06TXXXX"} 2',
+            'sarah_latency{adapter="slack",index="0"} 0.5',
+            'sarah_profile_calls{adapter="slack",name="command:.echo"} 2')
+        assert_that(text) \
+            .does_not_contain('max_workers') \
+            .does_not_contain('deferred_plugins')
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(.1, 1))
+        histogram.observe(.05)
+        histogram.observe(.5)
+
+        text = render({'dispatch_latency': histogram.snapshot()})
+        assert_that(text.splitlines()).contains(
+            '# TYPE sarah_dispatch_latency histogram',
+            'sarah_dispatch_latency_bucket{le="0.1"} 1',
+            'sarah_dispatch_latency_bucket{le="1.0"} 2',
+            'sarah_dispatch_latency_bucket{le="+Inf"} 2',
+            'sarah_dispatch_latency_sum 0.55',
+            'sarah_dispatch_latency_count 2')
+
+    def test_escape(self):
+        text = render({'dropped_events': {'spam"\n': 1}})
+        assert_that(text).contains(
+            'sarah_dropped_events{type="spam\\"\\n"} 1')
+
+
+class TestMetricsExporter(object):
+    @pytest.fixture
+    def exporter(self):
+        exporter = MetricsExporter(lambda: {'messages': {'received': 5}},
+                                   port=0)
+        exporter.start()
+        yield exporter
+        exporter.stop()
+
+    def test_scrape(self, exporter):
+        response = urlopen('http://127.0.0.1:%d/metrics' % exporter.port)
+
+        assert_that(response.status).is_equal_to(200)
+        assert_that(response.read().decode('utf-8')) \
+            .contains('sarah_messages_received 5')
+        assert_that(exporter.scrapes).is_equal_to(1)
+
+    def test_not_found(self, exporter):
+        with pytest.raises(HTTPError) as e:
+            urlopen('http://127.0.0.1:%d/' % exporter.port)
+
+        assert_that(e.value.code).is_equal_to(404)
+
+    def test_collect_error(self):
+        def collect():
+            raise ValueError('spam')
+
+        exporter = MetricsExporter(collect, port=0)
+        exporter.start()
+        with pytest.raises(HTTPError) as e:
+            urlopen('http://127.0.0.1:%d/metrics' % exporter.port)
+        exporter.stop()
+
+        assert_that(e.value.code).is_equal_to(500)
+        assert_that(exporter.scrape_errors).is_equal_to(1)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from assertpy import assert_that
+
+from sarah.inflight import InFlightTable
+
+
+class TestInFlightTable(object):
+    def test_ack(self, clock):
+        table = InFlightTable(clock=clock)
+        table.add(1, 'spam')
+        table.add(2, 'ham', attempts=2)
+
+        clock.now = .02
+        assert_that(table.ack(2, ok=False)).is_equal_to(('ham', 2))
+        assert_that(table.ack(1)).is_equal_to(('spam', 1))
+        assert_that(table.ack(1)) \
+            .described_as("Acknowledged only once") \
+            .is_none()
+
+        assert_that(table).is_length(0)
+        assert_that(table.metrics()) \
+            .contains_entry({'acknowledged': 1}) \
+            .contains_entry({'failed': 1}) \
+            .contains_entry({'unknown': 1}) \
+            .contains_entry({'latency_p50': .02})
+
+    def test_expire(self, clock):
+        table = InFlightTable(timeout=10, clock=clock)
+        table.add(1, 'spam')
+        clock.now = 5
+        table.add(2, 'ham')
+
+        clock.now = 11
+        assert_that(table.expire()).is_equal_to([('spam', 1)])
+        assert_that(table).is_length(1)
+        assert_that(table.metrics()).contains_entry({'timed_out': 1})
+
+    def test_bounded(self):
+        table = InFlightTable(max_size=2)
+        for i in range(5):
+            table.add(i, 'spam')
+
+        assert_that(table).is_length(2)
+        assert_that(table.ack(4)).is_not_none()
+        assert_that(table.ack(0)).is_none()
+        assert_that(table.metrics()).contains_entry({'evicted': 3})
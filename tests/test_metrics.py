@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from assertpy import assert_that
+import pytest
+
+from sarah.metrics import Counter, Histogram, RollingWindow
+
+
+class TestCounter(object):
+    def test_inc(self):
+        counter = Counter()
+        assert_that(counter.value).is_equal_to(0)
+
+        for _ in range(3):
+            counter.inc()
+
+        assert_that(counter.value).is_equal_to(3)
+
+
+class TestHistogram(object):
+    def test_observe(self):
+        histogram = Histogram(buckets=(1, 2, 5))
+        for value in (.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+
+        assert_that(histogram.count).is_equal_to(5)
+        assert_that(histogram.snapshot()) \
+            .contains_entry({'count': 5}) \
+            .contains_entry({'sum': 16}) \
+            .contains_entry({'max': 10}) \
+            .contains_entry({'buckets': [(1, 2),
+                                         (2, 3),
+                                         (5, 4),
+                                         (float('inf'), 5)]})
+
+    def test_percentile(self):
+        histogram = Histogram(buckets=(1, 2, 5))
+        assert_that(histogram.percentile(50)).is_none()
+
+        for value in (.1, .2, .3, 1.5, 4):
+            histogram.observe(value)
+        assert_that(histogram.percentile(50)).is_equal_to(1)
+        assert_that(histogram.percentile(99)) \
+            .described_as("Not larger than observed maximum") \
+            .is_equal_to(4)
+
+    def test_unsorted_buckets(self):
+        with pytest.raises(ValueError):
+            Histogram(buckets=(2, 1))
+
+
+class TestRollingWindow(object):
+    def test_percentiles(self):
+        window = RollingWindow(size=100)
+        assert_that(window.percentiles(50, 99)).is_equal_to([None, None])
+
+        for value in range(1, 101):
+            window.observe(value)
+        assert_that(window.percentiles(50, 99)).is_equal_to([51, 100])
+
+    def test_rolling(self):
+        window = RollingWindow(size=3)
+        for value in (100, 1, 2, 3):
+            window.observe(value)
+
+        assert_that(window).is_length(3)
+        assert_that(window.percentile(100)) \
+            .described_as("Oldest value is dropped") \
+            .is_equal_to(3)
+
+    def test_invalid_size(self):
+        with pytest.raises(ValueError):
+            RollingWindow(size=0)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from assertpy import assert_that
+import pytest
+
+from sarah.profiling import Profiler
+
+
+def spam(value):
+    return sum(range(value))
+
+
+class TestProfiler(object):
+    def test_call(self):
+        profiler = Profiler(window=10)
+        assert_that(profiler.call('command', '.spam', spam, 10)) \
+            .is_equal_to(45)
+        profiler.call('command', '.spam', spam, 10)
+
+        summary = profiler.summary()
+        assert_that(summary).contains_key('command:.spam')
+        assert_that(summary['command:.spam']) \
+            .contains_entry({'calls': 2}) \
+            .contains_entry({'errors': 0}) \
+            .contains_entry({'profiled_calls': 0})
+        assert_that(summary['command:.spam']['wall_p99']).is_not_none()
+        assert_that(summary['command:.spam']['cpu_p99']).is_not_none()
+
+    def test_error(self):
+        profiler = Profiler()
+
+        def ham():
+            raise ValueError('ham')
+
+        with pytest.raises(ValueError):
+            profiler.call('schedule', 'ham', ham)
+
+        stats = profiler.summary()['schedule:ham']
+        assert_that(stats).contains_entry({'calls': 1}) \
+            .contains_entry({'errors': 1}) \
+            .contains_entry({'last_error': "ValueError('ham')"})
+
+    def test_sample(self):
+        profiler = Profiler(sample_every=3)
+        assert_that(profiler.profile_report('command', '.spam')).is_none()
+
+        for _ in range(7):
+            profiler.call('command', '.spam', spam, 10)
+
+        assert_that(profiler.summary()['command:.spam']) \
+            .contains_entry({'profiled_calls': 2})
+        assert_that(profiler.profile_report('command', '.spam')) \
+            .contains('spam')
+
+    def test_hook(self):
+        calls = []
+        profiler = Profiler(hooks=(lambda *args: calls.append(args),))
+        profiler.call('send', 'post', spam, 10)
+
+        assert_that(calls).is_length(1)
+        assert_that(calls[0][:2]).is_equal_to(('send', 'post'))
+        assert_that(calls[0][4]).is_none()
+
+    def test_slowest(self):
+        profiler = Profiler()
+        profiler.call('command', '.fast', lambda: None)
+        profiler.call('command', '.slow', spam, 100000)
+
+        assert_that([name for name, _ in profiler.slowest(1)]) \
+            .is_equal_to(['command:.slow'])
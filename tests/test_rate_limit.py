@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from assertpy import assert_that
+from mock import MagicMock
+
+from sarah.bot.slack import Slack
+from sarah.rate_limit import TokenBucket, RateLimiter
+
+
+class TestTokenBucket(object):
+    def test_reserve(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+        assert_that(bucket.reserve()).is_equal_to(0)
+        assert_that(bucket.reserve()).is_equal_to(0)
+        assert_that(bucket.reserve()) \
+            .described_as("Waits for the next token") \
+            .is_equal_to(.5)
+        assert_that(bucket.reserve()) \
+            .described_as("Queued behind the previous caller") \
+            .is_equal_to(1)
+
+        clock.now = 10
+        assert_that(bucket.tokens) \
+            .described_as("Refilled up to capacity") \
+            .is_equal_to(2)
+
+
+class TestRateLimiter(object):
+    def test_per_key(self, clock):
+        limiter = RateLimiter(key_rate=1,
+                              key_burst=1,
+                              clock=clock,
+                              sleep=clock.sleep)
+
+        assert_that(limiter.acquire('C06TXXXX')).is_equal_to(0)
+        assert_that(limiter.acquire('C06TYYYY')) \
+            .described_as("Other channel has its own bucket") \
+            .is_equal_to(0)
+        assert_that(limiter.acquire('C06TXXXX')).is_equal_to(1)
+        assert_that(clock.now).is_equal_to(1)
+
+        assert_that(limiter.metrics()) \
+            .contains_entry({'acquired': 3}) \
+            .contains_entry({'delayed': 1}) \
+            .contains_entry({'total_delay': 1}) \
+            .contains_entry({'keys': 2}) \
+            .contains_entry({'tokens': None})
+
+    def test_workspace(self, clock):
+        limiter = RateLimiter(rate=10,
+                              burst=2,
+                              key_rate=1,
+                              key_burst=5,
+                              clock=clock,
+                              sleep=clock.sleep)
+
+        delays = [limiter.acquire('C06T%04d' % i) for i in range(4)]
+        assert_that(delays).is_equal_to([0, 0, .1, .1])
+
+
+class TestBotIntegration(object):
+    def test_enqueue(self):
+        slack = Slack(token='spam_ham_egg',
+                      rate_limit_config={'key_rate': 1, 'key_burst': 1})
+        slack.connect = lambda: True
+        slack.run()
+        slack.rate_limiter.reserve = MagicMock(return_value=0)
+        send = MagicMock()
+
+        future = slack.enqueue_sending_message(send,
+                                               'C06TXXXX',
+                                               'spam',
+                                               destination='C06TXXXX')
+        future.result(1)
+
+        assert_that(slack.rate_limiter.reserve.call_count).is_equal_to(1)
+        assert_that(slack.rate_limiter.reserve.call_args[0]) \
+            .is_equal_to(('C06TXXXX',))
+        assert_that(send.call_count).is_equal_to(1)
+
+        slack.message_worker.shutdown()
+        slack.scheduler.shutdown()
+
+    def test_throttled_destination_does_not_block_lane(self):
+        slack = Slack(token='spam_ham_egg',
+                      message_worker_config={'lanes': 1},
+                      rate_limit_config={'key_rate': 20, 'key_burst': 1})
+        slack.connect = lambda: True
+        slack.run()
+        sent = []
+
+        futures = [slack.enqueue_sending_message(sent.append,
+                                                 ('C06TXXXX', i),
+                                                 destination='C06TXXXX')
+                   for i in range(5)]
+        futures.append(slack.enqueue_sending_message(sent.append,
+                                                     ('C06TYYYY', 0),
+                                                     destination='C06TYYYY'))
+        assert_that(slack.throttled_count()).is_equal_to(4)
+        for future in futures:
+            future.result(2)
+
+        assert_that(sent[:2]) \
+            .described_as("Other channel in the same lane is not delayed") \
+            .is_equal_to([('C06TXXXX', 0), ('C06TYYYY', 0)])
+        assert_that([i for channel, i in sent if channel == 'C06TXXXX']) \
+            .described_as("Throttled ones are sent in order") \
+            .is_equal_to([0, 1, 2, 3, 4])
+        assert_that(slack.throttled_count()).is_equal_to(0)
+
+        slack.message_worker.shutdown()
+        slack.scheduler.shutdown()
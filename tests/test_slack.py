@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import logging
+import os
+import queue
+import sys
+import threading
+import time
 import types
+from urllib.request import urlopen
 
 from assertpy import assert_that
 
@@ -8,7 +15,10 @@ import pytest
 from mock import patch, MagicMock, call
 
 import sarah
-from sarah.bot.slack import Slack, SlackClient, SarahSlackException
+from sarah.bot.values import CommandMessage
+from sarah.bot.slack import Slack, SlackClient, SarahSlackException, \
+    SarahSlackRateLimited, FanOutResult, SlackDirectory, SlackMessage
+from sarah.thread import LaneExecutor
 
 
 class TestInit(object):
@@ -92,7 +102,8 @@ class TestInit(object):
     def test_connection_ok(self):
         slack = Slack(token='spam_ham_egg',
                       plugins=(('spam.ham.egg.onion', {}),),
-                      max_workers=1)
+                      max_workers=1,
+                      reconnect_config={'max_attempts': 0})
 
         with patch.object(slack.client,
                           'get',
@@ -105,6 +116,936 @@ class TestInit(object):
                 assert_that(mock_connect.call_count).is_equal_to(1)
 
 
+class TestReconnect(object):
+    def test_reconnect(self):
+        slack = Slack(token='spam_ham_egg',
+                      reconnect_config={'max_attempts': 2,
+                                        'initial_delay': .001})
+        responses = [{'url': 'ws://localhost:80/'}] * 3 + [{}] * 2
+
+        def run_forever(ws, *args, **kwargs):
+            # Connection is established, and then dropped
+            slack.on_open(ws)
+
+        with patch.object(slack.client, 'get', side_effect=responses), \
+                patch.object(sarah.bot.slack.WebSocketApp,
+                             'run_forever',
+                             autospec=True,
+                             side_effect=run_forever) as mock_connect:
+            slack.connect()
+
+        assert_that(mock_connect.call_count).is_equal_to(3)
+        assert_that(slack.connection_metrics()) \
+            .contains_entry({'connected': False}) \
+            .contains_entry({'reconnects': 2}) \
+            .contains_entry({'failed_reconnects': 2})
+        assert_that(slack.connection_metrics()['downtime']).is_positive()
+
+    def test_reconnect_delay(self):
+        slack = Slack(token='spam_ham_egg',
+                      reconnect_config={'initial_delay': 1, 'max_delay': 5})
+
+        for attempt in range(10):
+            assert_that(slack.reconnect_delay(attempt)) \
+                .is_between(0, min(5, 2 ** attempt))
+
+    def test_send_during_outage(self):
+        slack = Slack(token='spam_ham_egg')
+        slack.ws = MagicMock()
+
+        sending = threading.Thread(target=slack.send_message,
+                                   args=('C06TXXXX', 'spam'))
+        sending.start()
+        sending.join(.1)
+
+        assert_that(sending.is_alive()) \
+            .described_as("Waits for reconnection") \
+            .is_true()
+        assert_that(slack.connection_metrics()) \
+            .contains_entry({'waiting_sends': 1})
+        assert_that(slack.ws.send.call_count).is_equal_to(0)
+
+        slack.on_open(slack.ws)
+        sending.join(1)
+        assert_that(sending.is_alive()).is_false()
+        assert_that(slack.ws.send.call_count).is_equal_to(1)
+
+
+class TestHandshake(object):
+    def test_rtm_connect(self):
+        slack = Slack(token='spam_ham_egg',
+                      handshake='rtm.connect',
+                      reconnect_config={'max_attempts': 0})
+
+        with patch.object(slack.client,
+                          'get',
+                          return_value={'ok': True,
+                                        'url': 'ws://localhost:80/'}) \
+                as mock_get, \
+                patch.object(sarah.bot.slack.WebSocketApp, 'run_forever'):
+            slack.connect()
+
+        assert_that(mock_get.call_args[0][0]).is_equal_to('rtm.connect')
+
+    def test_unknown_handshake(self):
+        with pytest.raises(ValueError):
+            Slack(token='spam_ham_egg', handshake='rtm.spam')
+
+
+class TestDirectory(object):
+    @staticmethod
+    def client():
+        pages = {None: {'ok': True,
+                        'members': [{'id': 'U06TXXXXX', 'name': 'spam'}],
+                        'response_metadata': {'next_cursor': 'dXNlcjpV'}},
+                 'dXNlcjpV': {'ok': True,
+                              'members': [{'id': 'U06TYYYYY', 'name': 'ham'}],
+                              'response_metadata': {'next_cursor': ''}}}
+
+        def get(method, params):
+            if method == 'users.list':
+                return pages[params.get('cursor', None)]
+            elif method == 'users.info':
+                return {'ok': True,
+                        'user': {'id': params['user'], 'name': 'egg'}}
+            return {'ok': False, 'error': 'unknown_method'}
+
+        client = MagicMock()
+        client.get = MagicMock(side_effect=get)
+        return client
+
+    def test_lazy_pagination(self):
+        client = self.client()
+        directory = SlackDirectory(client)
+        assert_that(client.get.call_count) \
+            .described_as("Nothing is fetched until needed") \
+            .is_equal_to(0)
+
+        assert_that(directory.user_name('U06TXXXXX')).is_equal_to('spam')
+        assert_that(directory.user_name('U06TYYYYY')).is_equal_to('ham')
+        assert_that(client.get.call_count).is_equal_to(2)
+
+        assert_that(directory.user_name('U06TZZZZZ')) \
+            .described_as("Fetched individually on miss") \
+            .is_equal_to('egg')
+        directory.user_name('U06TZZZZZ')
+        assert_that(client.get.call_count).is_equal_to(3)
+        assert_that(directory.metrics()) \
+            .contains_entry({'users': 3}) \
+            .contains_entry({'hits': 3}) \
+            .contains_entry({'misses': 1})
+
+    def test_ttl(self, clock):
+        client = self.client()
+        directory = SlackDirectory(client, ttl=60, clock=clock)
+        directory.user('U06TXXXXX')
+
+        clock.now = 61
+        assert_that(directory.user_name('U06TXXXXX')) \
+            .described_as("Stale entry is served while refreshing") \
+            .is_equal_to('spam')
+        for _ in range(100):
+            if client.get.call_count == 4:
+                break
+            time.sleep(.01)
+        assert_that(client.get.call_count).is_equal_to(4)
+
+    def test_error(self):
+        client = MagicMock()
+        client.get = MagicMock(return_value={'ok': False,
+                                             'error': 'not_authed'})
+        directory = SlackDirectory(client)
+
+        assert_that(directory.channel_name('C06TXXXX', 'unknown')) \
+            .is_equal_to('unknown')
+
+    def test_not_found(self, clock):
+        client = MagicMock()
+        client.get = MagicMock(return_value={'ok': False,
+                                             'error': 'user_not_found'})
+        directory = SlackDirectory(client, ttl=60, clock=clock)
+
+        assert_that(directory.user('U06TXXXXX')).is_none()
+        requests = client.get.call_count
+        assert_that(directory.user('U06TXXXXX')).is_none()
+        assert_that(client.get.call_count) \
+            .described_as("Unknown ID is remembered until ttl") \
+            .is_equal_to(requests)
+        assert_that(directory.metrics()) \
+            .contains_entry({'not_found': 1}) \
+            .contains_entry({'not_found_hits': 1}) \
+            .contains_entry({'misses': 1})
+
+        clock.now = 61
+        directory.user('U06TXXXXX')
+        assert_that(directory.metrics()).contains_entry({'misses': 2})
+
+    def test_connection_failure_not_remembered(self):
+        client = MagicMock()
+        client.get = MagicMock(side_effect=Exception('timeout'))
+        directory = SlackDirectory(client)
+
+        directory.user('U06TXXXXX')
+        directory.user('U06TXXXXX')
+        assert_that(directory.metrics()) \
+            .contains_entry({'not_found': 0}) \
+            .contains_entry({'misses': 2})
+
+    def test_instance(self):
+        slack = Slack(token='spam_ham_egg')
+
+        assert_that(Slack.instance()).is_same_as(slack)
+        assert_that(Slack.instance().directory).is_same_as(slack.directory)
+
+
+class StubSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    client_ports = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.client_ports.append(self.client_address[1])
+
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestClient(object):
+    @pytest.fixture
+    def server(self, request):
+        StubSlackHandler.client_ports = []
+        server = HTTPServer(('127.0.0.1', 0), StubSlackHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        request.addfinalizer(server.shutdown)
+        return server
+
+    def test_init(self):
+        client = SlackClient(token='spam_ham_egg',
+                             pool_size=4,
+                             max_retries=2,
+                             timeout=[1, 5])
+
+        adapter = client.session.get_adapter('https://slack.com/api/')
+        assert_that(adapter).has__pool_maxsize(4)
+        assert_that(adapter.max_retries).has_total(2)
+        assert_that(client.timeout).is_equal_to((1, 5))
+
+    def test_keep_alive(self, server):
+        client = SlackClient(
+            token='spam_ham_egg',
+            base_url='http://127.0.0.1:%d/api/' % server.server_port)
+
+        for _ in range(5):
+            assert_that(client.post('chat.postMessage',
+                                    data={'channel': 'C06TXXXX',
+                                          'text': 'spam'})) \
+                .is_equal_to({'ok': True})
+
+        assert_that(StubSlackHandler.client_ports) \
+            .described_as("Connection is re-used") \
+            .is_length(5)
+        assert_that(set(StubSlackHandler.client_ports)).is_length(1)
+
+
+class TestRateLimit(object):
+    @staticmethod
+    def response(status_code, retry_after=None):
+        response = MagicMock(status_code=status_code,
+                             headers={'Retry-After': retry_after}
+                             if retry_after is not None else {},
+                             content=b'{"ok": true}')
+        return response
+
+    def test_retry_after(self):
+        client = SlackClient(token='spam_ham_egg')
+
+        with patch.object(client.session,
+                          'request',
+                          side_effect=[self.response(429, '0.1'),
+                                       self.response(200)]) as mock_request:
+            started = time.monotonic()
+            assert_that(client.post('chat.postMessage')) \
+                .is_equal_to({'ok': True})
+
+            assert_that(mock_request.call_count).is_equal_to(2)
+            assert_that(time.monotonic() - started) \
+                .described_as("Waited as told by Retry-After header") \
+                .is_greater_than_or_equal_to(0.1)
+
+    def test_give_up(self):
+        client = SlackClient(token='spam_ham_egg', max_rate_limit_retries=1)
+
+        with patch.object(client.session,
+                          'request',
+                          return_value=self.response(429, '0')):
+            with pytest.raises(SarahSlackRateLimited):
+                client.post('chat.postMessage')
+
+
+class TestFanOut(object):
+    def test_parallel(self):
+        slack = Slack(token='spam_ham_egg', fan_out_workers=10)
+        channels = ['C06T%04d' % i for i in range(10)]
+
+        def post(method, data=None):
+            time.sleep(.1)
+            if data['channel'] == 'C06T0000':
+                raise Exception('spam')
+            if data['channel'] == 'C06T0001':
+                return {'ok': False, 'error': 'channel_not_found'}
+            return {'ok': True}
+
+        with patch.object(slack.client,
+                          'post',
+                          side_effect=post) as mock_post:
+            result = slack.fan_out('chat.postMessage',
+                                   channels,
+                                   {'text': 'spam'})
+
+            assert_that(mock_post.call_count).is_equal_to(10)
+            assert_that(mock_post.call_args_list) \
+                .contains(call('chat.postMessage',
+                               data={'channel': 'C06T0009', 'text': 'spam'}))
+
+        assert_that(isinstance(result, FanOutResult)).is_true()
+        assert_that(result) \
+            .has_method('chat.postMessage') \
+            .has_succeeded(8) \
+            .has_failed(2)
+        assert_that(result.elapsed) \
+            .described_as("Sent concurrently") \
+            .is_less_than(.5)
+
+
+class TestRichReply(object):
+    def test_not_blocking_receiver(self):
+        slack = Slack(token='spam_ham_egg',
+                      rate_limit_config={'key_rate': 10, 'key_burst': 1})
+        slack.message_worker = LaneExecutor()
+
+        # noinspection PyUnusedLocal
+        @Slack.command('.rich')
+        def rich(msg, config):
+            return SlackMessage(text='spam')
+
+        with patch.object(slack.client,
+                          'post',
+                          return_value={'ok': True}) as mock_post:
+            started = time.monotonic()
+            futures = [slack.handle_message({'type': 'message',
+                                             'channel': 'C06TXXXX',
+                                             'user': 'U06TXXXXX',
+                                             'text': '.rich',
+                                             'ts': '1438477080.000004'})
+                       for _ in range(3)]
+            assert_that(time.monotonic() - started) \
+                .described_as("Receiving thread doesn't wait for tokens") \
+                .is_less_than(.1)
+
+            for future in futures:
+                assert_that(future.result(1)).is_equal_to({'ok': True})
+            assert_that(time.monotonic() - started) \
+                .described_as("Rate limited on message worker") \
+                .is_greater_than_or_equal_to(.19)
+
+        assert_that(mock_post.call_count).is_equal_to(3)
+        slack.message_worker.shutdown()
+
+
+class TestRespond(object):
+    @pytest.fixture
+    def slack(self):
+        slack = Slack(token='spam_ham_egg')
+
+        # noinspection PyUnusedLocal
+        @Slack.command('.b.w')
+        def arguments(msg, config):
+            return repr(msg.arguments)
+
+        # noinspection PyUnusedLocal
+        @Slack.command('.b.w_text')
+        def text(msg, config):
+            return msg.text
+
+        return slack
+
+    def test_arguments(self, slack):
+        assert_that(slack.respond('U06TXXXXX', '.b.w spam "ham egg"  onion')) \
+            .is_equal_to("('spam', 'ham egg', 'onion')")
+        assert_that(slack.respond('U06TXXXXX', '.b.w')).is_equal_to('()')
+
+    def test_text(self, slack):
+        assert_that(slack.respond('U06TXXXXX', '.b.w_text  spam ham')) \
+            .described_as("Longest name matches, and leading spaces are "
+                          "stripped from arguments") \
+            .is_equal_to('spam ham')
+        assert_that(slack.respond('U06TXXXXX', '.bxw spam')) \
+            .described_as("Command name is not a regular expression") \
+            .is_none()
+
+
+class TestMessage(object):
+    @pytest.fixture
+    def slack(self):
+        slack = Slack(token='spam_ham_egg')
+        slack.handle_message = MagicMock()
+        return slack
+
+    def test_ignored_event(self, slack):
+        with patch('sarah.bot.slack.decode_event') as decode:
+            slack.message(None, '{"type": "user_typing", "channel": '
+                                '"C06TXXXX", "user": "U06TXXXXX"}')
+
+        assert_that(decode.call_count) \
+            .described_as("Dropped before decoding") \
+            .is_equal_to(0)
+        assert_that(slack.dropped_events).is_equal_to({'user_typing': 1})
+
+    def test_type_not_first(self, slack):
+        slack.message(None, '{"channel": "C06TXXXX", "type": "user_typing"}')
+        slack.message(None, '{"channel": {"type": "user_typing"}, '
+                            '"type": "message", "user": "U06TXXXXX", '
+                            '"text": "spam"}')
+
+        assert_that(slack.dropped_events).is_equal_to({'user_typing': 1})
+        assert_that(slack.handle_message.call_count).is_equal_to(1)
+        assert_that(slack.handle_message.call_args[0][0]) \
+            .contains_entry({'text': 'spam'})
+
+    def test_unknown_event(self, slack):
+        slack.message(None, '{"type": "spam"}')
+        slack.message(None, '{"type": "spam"}')
+
+        assert_that(slack.dropped_events).is_equal_to({'spam': 2})
+        assert_that(slack.handle_message.call_count).is_equal_to(0)
+
+
+class TestReply(object):
+    @pytest.fixture
+    def slack(self):
+        slack = Slack(token='spam_ham_egg',
+                      reply_config={'timeout': 10, 'max_retries': 1})
+        slack.ws = MagicMock()
+        slack.connected.set()
+        slack.enqueue_sending_message = MagicMock()
+        return slack
+
+    def test_ack(self, slack):
+        slack.send_message('C06TXXXX', 'spam')
+        slack.send_message('C06TXXXX', 'ham')
+        slack.message(None, '{"ok": true, "reply_to": 1, "ts": "1.0"}')
+        slack.message(None, '{"ok": false, "reply_to": 2, '
+                            '"error": {"code": 2, "msg": "spam"}}')
+
+        assert_that(slack.metrics()['replies']) \
+            .contains_entry({'in_flight': 0}) \
+            .contains_entry({'acknowledged': 1}) \
+            .contains_entry({'failed': 1})
+        assert_that(slack.metrics()['replies']['latency']) \
+            .contains_entry({'count': 2})
+
+    def test_retry(self, slack):
+        slack.send_message('C06TXXXX', 'spam')
+        slack.send_message('C06TXXXX', 'ham', attempts=2)
+
+        slack.in_flight.clock = lambda: time.monotonic() + 11
+        slack.check_in_flight()
+
+        assert_that(slack.enqueue_sending_message.call_count) \
+            .described_as("Retried up to max_retries") \
+            .is_equal_to(1)
+        assert_that(slack.enqueue_sending_message.call_args) \
+            .is_equal_to(call(slack.send_message,
+                              'C06TXXXX',
+                              'spam',
+                              'message',
+                              attempts=2,
+                              destination='C06TXXXX',
+                              block=False))
+        assert_that(slack.in_flight.metrics()).contains_entry({'timed_out': 2})
+
+    def test_expire_on_quiet_connection(self):
+        slack = Slack(token='spam_ham_egg',
+                      reply_config={'timeout': .05, 'max_retries': 1},
+                      reconnect_config={'ping_interval': 0})
+        slack.ws = MagicMock()
+        slack.connected.set()
+        slack.enqueue_sending_message = MagicMock()
+        slack.send_message('C06TXXXX', 'spam')
+
+        watchdog = threading.Thread(target=slack.watch_connection)
+        watchdog.start()
+        for _ in range(100):
+            if slack.enqueue_sending_message.called:
+                break
+            time.sleep(.01)
+        slack._Slack__stopping.set()
+        watchdog.join(1)
+
+        assert_that(slack.enqueue_sending_message.call_count) \
+            .described_as("Retried without receiving any frame") \
+            .is_equal_to(1)
+
+    def test_retry_dropped_on_full_lane(self, slack):
+        slack.enqueue_sending_message = MagicMock(side_effect=queue.Full)
+        slack.send_message('C06TXXXX', 'spam')
+
+        slack.in_flight.clock = lambda: time.monotonic() + 11
+        slack.check_in_flight()
+
+        assert_that(slack.metrics()['replies']) \
+            .contains_entry({'dropped_retries': 1})
+
+
+class TestCoalesce(object):
+    def test_send_text(self):
+        slack = Slack(token='spam_ham_egg',
+                      rate_limit_config={},
+                      coalesce_config={'window': .05})
+        slack.connect = lambda: True
+        slack.run()
+        slack.ws = MagicMock()
+        slack.connected.set()
+
+        futures = [slack.send_text('C06TXXXX', text)
+                   for text in ('spam', 'ham', 'egg')]
+        for future in futures:
+            future.result(1)
+
+        assert_that(slack.ws.send.call_count).is_equal_to(1)
+        assert_that(slack.ws.send.call_args[0][0]).contains('spam\\nham\\negg')
+        assert_that(slack.coalescer.metrics()).contains_entry({'merged': 2})
+        slack.stop()
+
+    def test_rich_reply_after_text(self):
+        slack = Slack(token='spam_ham_egg',
+                      rate_limit_config={},
+                      coalesce_config={'window': 60})
+        slack.connect = lambda: True
+        slack.run()
+        sent = []
+        slack.ws = MagicMock()
+        slack.ws.send = MagicMock(side_effect=lambda _: sent.append('text'))
+        slack.connected.set()
+
+        # noinspection PyUnusedLocal
+        @Slack.command('.rich')
+        def rich(msg, config):
+            return SlackMessage(text='ham')
+
+        def post(*args, **kwargs):
+            sent.append('rich')
+            return {'ok': True}
+
+        with patch.object(slack.client, 'post', side_effect=post):
+            text = slack.send_text('C06TXXXX', 'spam')
+            future = slack.handle_message({'type': 'message',
+                                           'channel': 'C06TXXXX',
+                                           'user': 'U06TXXXXX',
+                                           'text': '.rich',
+                                           'ts': '1438477080.000004'})
+            assert_that(future.result(1)).is_equal_to({'ok': True})
+            text.result(1)
+
+        assert_that(sent) \
+            .described_as("Rich reply doesn't overtake merged text") \
+            .is_equal_to(['text', 'rich'])
+        assert_that(slack.coalescer.metrics()).contains_entry({'passed': 1})
+        slack.stop()
+
+    def test_full_lane_does_not_block_flush(self):
+        slack = Slack(token='spam_ham_egg',
+                      rate_limit_config={},
+                      coalesce_config={'window': 0})
+        slack.connect = lambda: True
+        slack.run()
+        slack.message_worker.shutdown()
+        slack.message_worker = LaneExecutor(lanes=1, max_queue_size=1)
+        release = threading.Event()
+        slack.message_worker.submit(release.wait, 5)
+        time.sleep(.1)
+        slack.message_worker.submit(lambda: None)
+
+        with pytest.raises(queue.Full):
+            slack.send_text('C06TXXXX', 'spam').result(1)
+        assert_that(slack.coalescer.metrics()).contains_entry({'failed': 1})
+
+        release.set()
+        slack.stop()
+
+
+PLUGIN = """# -*- coding: utf-8 -*-
+from sarah.bot.slack import Slack
+
+
+@Slack.command('.reload_spam')
+def spam(msg, config):
+    return '%(version)s'
+%(extra)s
+"""
+
+
+SCHEDULE_EXTRA = """
+@Slack.schedule('reload_schedule')
+def schedule(config):
+    return 'scheduled'
+"""
+
+
+@pytest.fixture
+def plugin(tmpdir, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmpdir))
+    module_name = 'reload_plugin_%d' % id(tmpdir)
+    path = tmpdir.join(module_name + '.py')
+
+    def write(version, extra='', content=None):
+        mtime = path.mtime() if path.check() else 0
+        path.write(content if content is not None else
+                   PLUGIN % {'version': version, 'extra': extra})
+        # Make sure mtime differs even within timestamp resolution
+        os.utime(str(path), (mtime + 1, mtime + 1))
+
+    write('v1')
+    tmpdir.join(module_name + '_static.py').write(
+        'from sarah.bot.slack import Slack\n'
+        'Slack.command(".reload_static")(lambda msg, config: "static")\n')
+    yield module_name, write
+    sys.modules.pop(module_name, None)
+    sys.modules.pop(module_name + '_static', None)
+
+
+class TestReload(object):
+    def test_reload_changed(self, plugin):
+        module_name, write = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,), (module_name + '_static',)))
+        slack.load_plugins()
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .is_equal_to('v1')
+        assert_that(slack.reload_plugins()).is_empty()
+
+        write('v2', extra='''
+@Slack.command('.reload_ham')
+def ham(msg, config):
+    return 'ham'
+''')
+        assert_that(slack.changed_plugins()).is_equal_to([module_name])
+        assert_that(slack.reload_plugins()).is_equal_to([module_name])
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .is_equal_to('v2')
+        assert_that(slack.respond('U06TXXXXX', '.reload_ham')) \
+            .is_equal_to('ham')
+        assert_that([c.name for c in slack.commands]) \
+            .is_equal_to(['.reload_spam', '.reload_ham', '.reload_static'])
+
+    def test_broken_module(self, plugin):
+        module_name, write = plugin
+        slack = Slack(token='spam_ham_egg', plugins=((module_name,),))
+        slack.load_plugins()
+
+        write('v2', extra='raise ValueError("spam")')
+        assert_that(slack.reload_plugins()).is_empty()
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .described_as("Previous commands are kept") \
+            .is_equal_to('v1')
+
+    def test_removed_command(self, plugin):
+        module_name, write = plugin
+        slack = Slack(token='spam_ham_egg', plugins=((module_name,),))
+        slack.load_plugins()
+
+        write(None, content='# -*- coding: utf-8 -*-\n')
+
+        assert_that(slack.reload_plugins()).is_equal_to([module_name])
+        assert_that(slack.commands).is_empty()
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')).is_none()
+
+    def test_respond_while_reloading(self, plugin):
+        module_name, write = plugin
+        slack = Slack(token='spam_ham_egg', plugins=((module_name,),))
+        slack.load_plugins()
+        responses = []
+        done = threading.Event()
+
+        def respond():
+            while not done.is_set():
+                responses.append(slack.respond('U06TXXXXX', '.reload_spam'))
+
+        responding = threading.Thread(target=respond)
+        responding.start()
+        for i in range(20):
+            write('v%d' % (i + 2))
+            slack.reload_plugins()
+        done.set()
+        responding.join()
+
+        assert_that(responses).is_not_empty()
+        assert_that([r for r in responses if not r.startswith('v')]) \
+            .described_as("Command is always found") \
+            .is_empty()
+
+
+class TestDeferredPlugin(object):
+    def test_load_on_first_call(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name, {}, ('.reload_spam',)),))
+        slack.connect = lambda: True
+        slack.run()
+
+        assert_that(sys.modules).does_not_contain_key(module_name)
+        assert_that(slack.deferred_plugins).contains(module_name)
+        assert_that(slack.startup_time).is_not_none()
+        assert_that(slack.metrics()['startup']) \
+            .contains_entry({'deferred_plugins': [module_name]})
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .is_equal_to('v1')
+        assert_that(sys.modules).contains_key(module_name)
+        assert_that(slack.deferred_plugins).is_empty()
+        assert_that(slack.commands[0].function.__name__) \
+            .described_as("Stand-in is replaced") \
+            .is_equal_to('spam')
+        slack.stop()
+
+    def test_schedule_config_not_deferred(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,
+                                {'channels': 'C06TXXXX'},
+                                ('.reload_spam',)),))
+        with patch.object(logging, 'warning') as warning:
+            slack.load_plugins()
+
+        assert_that(sys.modules).contains_key(module_name)
+        assert_that(slack.deferred_plugins).is_empty()
+        assert_that(warning.call_count).is_equal_to(1)
+
+    def test_warn_deferred_schedule(self, plugin):
+        module_name, write = plugin
+        write('v1', extra=SCHEDULE_EXTRA)
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,
+                                {'spam': 'ham'},
+                                ('.reload_spam',)),))
+        slack.load_plugins()
+        assert_that(slack.deferred_plugins).contains(module_name)
+
+        with patch.object(logging, 'warning') as warning:
+            slack.respond('U06TXXXXX', '.reload_spam')
+
+        assert_that([c[0][0] for c in warning.call_args_list]) \
+            .contains('Deferred %s registers schedules, which did not run '
+                      'until now. Don\'t declare its commands to load it '
+                      'on startup.' % module_name)
+
+    def test_undeclared_command(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name, {}, ('.reload_ham',)),))
+        slack.load_plugins()
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_ham')) \
+            .starts_with('Something went wrong')
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .described_as("Actually registered one is available") \
+            .is_equal_to('v1')
+
+
+class TestStats(object):
+    def test_stats(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,),),
+                      profile_config={'sample_every': 2,
+                                      'admins': ['U06TXXXXX']})
+        slack.load_plugins()
+        assert_that([c.name for c in slack.commands]) \
+            .is_equal_to(['.reload_spam', '.stats'])
+
+        for _ in range(2):
+            slack.respond('U06TXXXXX', '.reload_spam')
+
+        assert_that(slack.respond('U06TXXXXX', '.stats')) \
+            .starts_with('command:.reload_spam: 2 calls, 0 errors')
+        assert_that(slack.respond('U06TXXXXX', '.stats .reload_spam')) \
+            .contains('profile of 1 sampled calls')
+        assert_that(slack.respond('U06TXXXXX', '.stats .reload_ham')) \
+            .is_equal_to('No stats for .reload_ham.')
+        assert_that(slack.respond('U06TYYYYY', '.stats')) \
+            .is_equal_to('Only admins can see the stats.')
+        assert_that(slack.metrics()['profile']) \
+            .contains_key('command:.reload_spam', 'command:.stats')
+
+    def test_no_admins(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,),),
+                      profile_config={})
+        slack.load_plugins()
+
+        assert_that([c.name for c in slack.commands]) \
+            .described_as("Nobody can see the stats without admins") \
+            .does_not_contain('.stats')
+        assert_that(slack.respond('U06TXXXXX', '.stats')).is_none()
+        assert_that(slack.metrics()['profile']).is_not_none()
+
+    def test_disabled(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg', plugins=((module_name,),))
+        slack.load_plugins()
+
+        assert_that(slack.respond('U06TXXXXX', '.stats')).is_none()
+        assert_that(slack.metrics()['profile']).is_none()
+
+
+class TestMetricsExporter(object):
+    def test_scrape(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,),),
+                      metrics_config={'port': 0})
+        slack.connect = lambda: True
+        slack.run()
+        slack.respond('U06TXXXXX', '.reload_spam')
+
+        port = slack.metrics_exporter.port
+        text = urlopen('http://127.0.0.1:%d/metrics' % port) \
+            .read().decode('utf-8')
+        slack.stop()
+
+        assert_that(text.splitlines()).contains(
+            'sarah_messages_received{adapter="slack"} 1',
+            'sarah_dispatch_latency_count{adapter="slack"} 1',
+            'sarah_connection_reconnects{adapter="slack"} 0',
+            'sarah_context_size{adapter="slack"} 0')
+
+    def test_disabled(self):
+        slack = Slack(token='spam_ham_egg')
+        slack.connect = lambda: True
+        slack.run()
+        slack.stop()
+
+        assert_that(slack.metrics_exporter).is_none()
+
+
+SLOW_PLUGIN = """# -*- coding: utf-8 -*-
+import threading
+
+from sarah.bot.slack import Slack
+
+release = threading.Event()
+
+
+@Slack.command('.reload_slow')
+def slow(msg, config):
+    release.wait()
+    return 'slow'
+
+
+@Slack.command('.reload_spam')
+def spam(msg, config):
+    raise TimeoutError('spam')
+"""
+
+
+class TestTimeout(object):
+    def test_timeout(self, plugin):
+        module_name, write = plugin
+        write(None, content=SLOW_PLUGIN)
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name,
+                                {'timeouts': {'.reload_slow': .1}}),))
+        slack.load_plugins()
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_slow')) \
+            .is_equal_to('".reload_slow" did not finish in 0.1 seconds')
+        assert_that(slack.timeout_metrics()) \
+            .contains_entry({'timed_out': 1}) \
+            .contains_entry({'abandoned_running': 1}) \
+            .contains_entry({'abandoned_finished': 0}) \
+            .contains_entry({'by_command': {'.reload_slow': 1}})
+
+        sys.modules[module_name].release.set()
+        slack.timeout_worker.shutdown(wait=True)
+        assert_that(slack.timeout_metrics()) \
+            .contains_entry({'abandoned_running': 0}) \
+            .contains_entry({'abandoned_finished': 1})
+
+    def test_command_raises_timeout_error(self, plugin):
+        module_name, write = plugin
+        write(None, content=SLOW_PLUGIN)
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name, {'timeout': 1}),))
+        slack.load_plugins()
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .described_as("Not mistaken for timeout") \
+            .starts_with('Something went wrong')
+        assert_that(slack.timeout_metrics()) \
+            .contains_entry({'timed_out': 0})
+
+    def test_no_timeout(self, plugin):
+        module_name, _ = plugin
+        slack = Slack(token='spam_ham_egg', plugins=((module_name,),))
+        slack.load_plugins()
+        slack.timeout_worker.shutdown()
+
+        assert_that(slack.respond('U06TXXXXX', '.reload_spam')) \
+            .described_as("Run on the calling thread") \
+            .is_equal_to('v1')
+
+
+class TestCache(object):
+    def test_cached_command(self, plugin):
+        module_name, write = plugin
+        write(None, content="""# -*- coding: utf-8 -*-
+from sarah.bot.slack import Slack
+
+calls = []
+
+
+@Slack.command('.reload_spam', cache={'ttl': 60})
+def spam(msg, config):
+    calls.append(msg.text)
+    return 'spam %s %s' % (msg.text, config['suffix'])
+""")
+        slack = Slack(token='spam_ham_egg',
+                      plugins=((module_name, {'suffix': '!'}),))
+        slack.load_plugins()
+
+        for user_key in ('U06TXXXXX', 'U06TYYYYY'):
+            assert_that(slack.respond(user_key, '.reload_spam ham')) \
+                .is_equal_to('spam ham !')
+        assert_that(sys.modules[module_name].calls).is_equal_to(['ham'])
+        assert_that(slack.metrics()['cache']['.reload_spam']) \
+            .contains_entry({'hits': 1}) \
+            .contains_entry({'misses': 1})
+        assert_that(sys.modules[module_name].spam(
+            CommandMessage('.reload_spam ham', 'ham', 'U06TXXXXX'),
+            {'suffix': '?'})) \
+            .described_as("Decorated function itself is not cached") \
+            .is_equal_to('spam ham ?')
+
+    def test_coroutine(self):
+        Slack(token='spam_ham_egg')
+        with pytest.raises(ValueError):
+            @Slack.command('.spam', cache={})
+            async def spam(msg, config):
+                return 'spam'
+
+
 class TestSchedule(object):
     def test_missing_config(self):
         logging.warning = MagicMock()
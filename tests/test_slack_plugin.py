@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import subprocess
+import sys
+
 from assertpy import assert_that
 from sarah.bot.slack import SlackMessage
 from sarah.bot.values import CommandMessage
@@ -86,3 +89,20 @@ class TestBMWQuotes(object):
                              sender='U06TXXXXX')
         # assert_that(slack_quote(msg, {})).is_instance_of(SlackMessage)
         assert_that(isinstance(slack_quote(msg, {}), SlackMessage)).is_true()
+
+
+class TestAdapterImport(object):
+    def test_other_adapter_not_imported(self):
+        # Run in a fresh interpreter since other tests may import HipChat
+        code = ('import sys\n'
+                'from sarah.bot.slack import Slack\n'
+                'names = ("echo", "hello", "simple_counter", "bmw_quotes")\n'
+                'plugins = [("sarah.bot.plugins." + n,) for n in names]\n'
+                'slack = Slack(token="spam_ham_egg", plugins=plugins)\n'
+                'slack.load_plugins()\n'
+                'print(sorted(c.name for c in slack.commands))\n'
+                'print("sarah.bot.hipchat" in sys.modules)\n')
+        output = subprocess.check_output([sys.executable, '-c', code])
+
+        assert_that(output.decode().splitlines()).is_equal_to(
+            ["['.bmw', '.count', '.echo', '.reset_count']", 'False'])
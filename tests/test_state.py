@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from assertpy import assert_that
+import pytest
+
+from sarah.bot.state import StripedLock, UserStore
+
+
+class TestStripedLock(object):
+    def test_same_key_same_lock(self):
+        lock = StripedLock(stripes=4)
+
+        assert_that(lock('U06TXXXXX')).is_same_as(lock('U06TXXXXX'))
+        assert_that(set(id(lock('U%04d' % i)) for i in range(100))) \
+            .is_length(4)
+
+    def test_invalid_stripes(self):
+        with pytest.raises(ValueError):
+            StripedLock(stripes=0)
+
+    def test_all(self):
+        lock = StripedLock(stripes=4)
+        acquired = []
+
+        def acquire(i):
+            with lock('U%04d' % i):
+                acquired.append(i)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            with lock.all():
+                futures = [executor.submit(acquire, i) for i in range(4)]
+                time.sleep(.05)
+                assert_that(acquired) \
+                    .described_as("Every stripe is held") \
+                    .is_empty()
+            for future in futures:
+                future.result(1)
+
+        assert_that(sorted(acquired)).is_equal_to([0, 1, 2, 3])
+
+
+class TestUserStore(object):
+    def test_get_set_pop(self):
+        store = UserStore()
+        store.set('U06TXXXXX', 'spam', 1)
+        store.set('U06TXXXXX', 'ham', 2)
+
+        assert_that(store.get('U06TXXXXX', 'spam')).is_equal_to(1)
+        assert_that(store.get('U06TYYYYY', 'spam', 0)).is_equal_to(0)
+        assert_that(store.items('U06TXXXXX')) \
+            .is_equal_to({'spam': 1, 'ham': 2})
+
+        assert_that(store.pop('U06TXXXXX', 'spam')).is_equal_to(1)
+        assert_that(store.pop('U06TXXXXX', 'ham')).is_equal_to(2)
+        assert_that(store) \
+            .described_as("User without values is removed") \
+            .does_not_contain('U06TXXXXX')
+
+    def test_shared_data(self):
+        data = {}
+        store = UserStore(data)
+        store.update('U06TXXXXX', 'spam', lambda cnt: cnt + 1, 0)
+
+        assert_that(data).is_equal_to({'U06TXXXXX': {'spam': 1}})
+
+        store.clear()
+        assert_that(data).is_empty()
+
+    def test_clear_with_concurrent_update(self):
+        store = UserStore(stripes=8)
+
+        def update(i):
+            store.update('U%04d' % (i % 100), 'count', lambda cnt: cnt + 1, 0)
+            if i % 50 == 0:
+                store.clear()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(update, range(10000)))
+
+        assert_that(len(store)).is_less_than_or_equal_to(100)
+
+    def test_concurrent_update(self):
+        store = UserStore(stripes=8)
+        users = 16
+        increments = 2000
+
+        def increment(i):
+            # Python's thread switch happens between reading and writing the
+            # value without lock, so lost updates show up here.
+            user_key = 'U%04d' % (i % users)
+            store.update(user_key, 'count', lambda cnt: cnt + 1, 0)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(increment, range(users * increments)))
+        elapsed = time.monotonic() - started
+
+        assert_that(len(store)).is_equal_to(users)
+        for i in range(users):
+            assert_that(store.get('U%04d' % i, 'count')) \
+                .is_equal_to(increments)
+        assert_that(elapsed) \
+            .described_as("%d updates in %fs" % (users * increments,
+                                                 elapsed)) \
+            .is_less_than(10)
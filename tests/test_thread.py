@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import wait
+import threading
+import time
+
+from assertpy import assert_that
+import pytest
+
+from sarah.thread import LaneExecutor, KeyedThreadPoolExecutor
+
+
+class TestLaneExecutor(object):
+    def test_order_within_key(self):
+        executor = LaneExecutor(lanes=4)
+        results = []
+
+        futures = [executor.submit_to('C06TXXXX', results.append, i)
+                   for i in range(100)]
+        wait(futures, 5)
+
+        assert_that(results).is_equal_to(list(range(100)))
+        executor.shutdown()
+
+    def test_slow_lane_does_not_block_others(self):
+        executor = LaneExecutor(lanes=2)
+        # String hash is randomized per process
+        keys = ['C%04d' % i for i in range(100)]
+        slow_key = next(k for k in keys if executor.lane_of(k) == 0)
+        fast_key = next(k for k in keys if executor.lane_of(k) == 1)
+        release = threading.Event()
+
+        executor.submit_to(slow_key, release.wait, 5)
+        fast = executor.submit_to(fast_key, lambda: 'done')
+
+        assert_that(fast.result(1)).is_equal_to('done')
+        assert_that(executor.queue_depths()).is_equal_to([0, 0])
+
+        release.set()
+        executor.shutdown()
+
+    def test_backpressure(self):
+        executor = LaneExecutor(lanes=1, max_queue_size=1)
+        release = threading.Event()
+
+        # One is being executed, and the other one fills the queue
+        executor.submit(release.wait, 5)
+        time.sleep(.1)
+        executor.submit(lambda: None)
+        assert_that(executor.metrics()) \
+            .contains_entry({'lane_depths': [1]}) \
+            .contains_entry({'max_queue_size': 1})
+
+        blocked = threading.Thread(target=executor.submit,
+                                   args=(lambda: None,))
+        blocked.start()
+        blocked.join(.1)
+        assert_that(blocked.is_alive()) \
+            .described_as("Submission waits for room in the queue") \
+            .is_true()
+
+        release.set()
+        blocked.join(1)
+        assert_that(blocked.is_alive()).is_false()
+        executor.shutdown()
+
+    def test_shutdown(self):
+        executor = LaneExecutor(lanes=2)
+        executor.shutdown()
+
+        with pytest.raises(RuntimeError):
+            executor.submit(lambda: None)
+
+    def test_shutdown_full_lane(self):
+        executor = LaneExecutor(lanes=1, max_queue_size=1)
+        release = threading.Event()
+        executed = []
+        executor.submit(release.wait, 5)
+        time.sleep(.1)
+        executor.submit(executed.append, 'spam')
+
+        stopping = threading.Thread(target=executor.shutdown,
+                                    kwargs={'wait': False})
+        stopping.start()
+        stopping.join(1)
+        assert_that(stopping.is_alive()) \
+            .described_as("Doesn't wait for room in the queue") \
+            .is_false()
+
+        release.set()
+        executor._threads[0].join(1)
+        assert_that(executor._threads[0].is_alive()) \
+            .described_as("Worker exits after draining the queue") \
+            .is_false()
+        assert_that(executed).is_equal_to(['spam'])
+
+    def test_submit_racing_shutdown(self):
+        executor = LaneExecutor(lanes=1, max_queue_size=10)
+        futures = []
+
+        def submit():
+            while True:
+                try:
+                    futures.append(executor.submit(lambda: None))
+                except RuntimeError:
+                    return
+
+        submitting = threading.Thread(target=submit)
+        submitting.start()
+        time.sleep(.05)
+        executor.shutdown()
+        submitting.join(1)
+
+        assert_that(futures).is_not_empty()
+        assert_that([f for f in futures if not f.done()]) \
+            .described_as("Every accepted item runs") \
+            .is_empty()
+
+    def test_bounded_by_default(self):
+        executor = LaneExecutor(lanes=1)
+        assert_that(executor.metrics()) \
+            .contains_entry({'max_queue_size': 1000})
+        executor.shutdown()
+
+
+class TestKeyedThreadPoolExecutor(object):
+    def test_order_within_key(self):
+        executor = KeyedThreadPoolExecutor(max_workers=8)
+        results = []
+
+        def append(i):
+            # Later ones finish earlier if they are not serialized
+            time.sleep((10 - i) / 1000)
+            results.append(i)
+
+        futures = [executor.submit_keyed('U06TXXXXX', append, i)
+                   for i in range(10)]
+        wait(futures, 5)
+
+        assert_that(results).is_equal_to(list(range(10)))
+        assert_that(executor.metrics()).contains_entry({'active_keys': 0})
+        executor.shutdown()
+
+    def test_busy_key_does_not_block_others(self):
+        executor = KeyedThreadPoolExecutor(max_workers=2)
+        release = threading.Event()
+
+        executor.submit_keyed('U06TXXXXX', release.wait, 5)
+        queued = executor.submit_keyed('U06TXXXXX', lambda: 'queued')
+        other = executor.submit_keyed('U06TYYYYY', lambda: 'done')
+
+        assert_that(other.result(1)).is_equal_to('done')
+        assert_that(queued.done()).is_false()
+        assert_that(executor.metrics()) \
+            .contains_entry({'active_keys': 1}) \
+            .contains_entry({'waiting_keyed_items': 1})
+
+        release.set()
+        assert_that(queued.result(1)).is_equal_to('queued')
+        executor.shutdown()
+
+    def test_exception(self):
+        executor = KeyedThreadPoolExecutor(max_workers=1)
+
+        failed = executor.submit_keyed('spam', lambda: 1 / 0)
+        succeeded = executor.submit_keyed('spam', lambda: 'ham')
+
+        with pytest.raises(ZeroDivisionError):
+            failed.result(1)
+        assert_that(succeeded.result(1)) \
+            .described_as("Following item runs even if preceding one fails") \
+            .is_equal_to('ham')
+        executor.shutdown()
+
+    def test_shutdown(self):
+        executor = KeyedThreadPoolExecutor(max_workers=1)
+        release = threading.Event()
+
+        executor.submit_keyed('spam', release.wait, 5)
+        queued = executor.submit_keyed('spam', lambda: None)
+        executor.shutdown(wait=False)
+        release.set()
+
+        with pytest.raises(RuntimeError):
+            queued.result(1)
+        with pytest.raises(RuntimeError):
+            executor.submit_keyed('ham', lambda: None)
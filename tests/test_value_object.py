@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from assertpy import assert_that
 import pytest
+from mock import patch
 from typing import Union, AnyStr, Pattern
-from sarah import ValueObject
+from sarah import ValueObject, CompactValueObject
 import re
 
 
@@ -55,3 +56,70 @@ class TestMalformedClassDeclaration(object):
 
     assert_that(e.value.args[0]) \
         .is_equal_to("__init__ with *args or **kwargs are not allowed")
+
+
+class TestFieldLayout(object):
+    class MyValue(ValueObject):
+        def __init__(self, key1, key2="ham", key3=None):
+            pass
+
+    def test_layout(self):
+        assert_that(self.MyValue._fields) \
+            .is_equal_to(('key1', 'key2', 'key3'))
+        assert_that(self.MyValue._defaults) \
+            .is_equal_to({'key2': "ham", 'key3': None})
+
+    def test_no_introspection_on_instantiation(self):
+        with patch('sarah.value_object.getfullargspec') as mock_argspec:
+            obj = self.MyValue("spam", key3="egg")
+
+            assert_that(repr(obj)).is_equal_to("MyValue('spam', 'egg')")
+            assert_that(sorted(obj.keys())) \
+                .is_equal_to(['key1', 'key2', 'key3'])
+            assert_that(mock_argspec.call_count).is_equal_to(0)
+
+
+class TestCompact(object):
+    class MyCompactValue(CompactValueObject):
+        def __init__(self, key1, pattern: Union[Pattern, AnyStr]=None,
+                     key3=None):
+            if isinstance(pattern, str):
+                self['pattern'] = re.compile(pattern)
+
+    def test_init(self):
+        obj = self.MyCompactValue("spam", pattern="str")
+
+        assert_that(obj["key1"]).is_equal_to("spam")
+        assert_that(obj["pattern"]).is_equal_to(re.compile("str"))
+        assert_that(obj["key3"]).is_none()
+        assert_that(list(obj.keys())).is_equal_to(['key1', 'pattern', 'key3'])
+        assert_that(repr(obj)) \
+            .is_equal_to("MyCompactValue('spam', re.compile('str'))")
+
+        # No per-instance dictionary
+        assert_that(hasattr(obj, '__dict__')).is_false()
+
+    def test_equality(self):
+        obj1 = self.MyCompactValue("spam", pattern="str")
+        obj2 = self.MyCompactValue(key1="spam", pattern=re.compile("str"))
+
+        assert_that(obj1).is_equal_to(obj2)
+        assert_that(hash(obj1)).is_equal_to(hash(obj2))
+        assert_that(obj1).is_not_equal_to(self.MyCompactValue("ham"))
+        assert_that({obj1: True}).contains_key(obj2)
+
+    def test_unhashable_value(self):
+        obj1 = self.MyCompactValue("spam", key3={'ham': 1})
+        obj2 = self.MyCompactValue("spam", key3={'ham': 1})
+
+        assert_that(hash(obj1)).is_equal_to(hash(obj2))
+
+    def test_immutable(self):
+        obj = self.MyCompactValue("spam")
+
+        with pytest.raises(TypeError):
+            obj['key1'] = "ham"
+
+    def test_unknown_keyword(self):
+        with pytest.raises(TypeError):
+            self.MyCompactValue("spam", egg="ham")